@@ -0,0 +1,289 @@
+"""
+Streaming product ingestion pipeline with bounded memory.
+
+The indexing notebook loads every scraped document into memory, then tags, embeds and adds
+the whole list in one shot. This module indexes the catalog as a stream of fixed-size chunks
+(`config.indexer_chunk_size`) flowing through the stages:
+
+    pages -> parse -> normalize price and attributes -> categorize -> embed -> upsert
+
+Each stage runs on its own thread with its own worker pool, and the stages are connected by
+bounded queues (`config.indexer_queue_size`), so a slow stage applies backpressure to the
+previous ones. Only a few chunks are in flight at any time, and peak memory stays flat
+regardless of the catalog size.
+
+After each chunk is upserted, the run is checkpointed (`config.indexer_checkpoint_path`).
+A run that fails midway resumes from the last committed chunk. Products are upserted with ids
+derived from their URL, so re-indexing a chunk is idempotent. The products indexed from the
+same URL under another id, e.g. the random ids of older indexing notebook runs, are deleted
+when their page is indexed, so that indexing into an existing collection migrates it instead
+of duplicating its products. A product whose classification fails fails its chunk, rather
+than being indexed with the error message as its category. With
+`config.enable_category_partitions`, each chunk is also upserted into the collections of the
+categories of its products (see category_partitions.py).
+
+The LLM calls of the categorize stage run in the background priority class of the LLM queue
+(see llm_scheduler.py), so indexing does not slow down the searches served meanwhile.
+
+Dependencies:
+    - catalog_ingestion.py (iter_pages, parse_product_page)
+    - product_category.py (get_product_category)
+    - price_parser.py (parse_price)
+    - product_attributes.py (extract_product_attributes)
+    - product_retriever.py (embeddings)
+    - tenants.py (vector store location and category schema of the catalog)
+    - category_partitions.py (per-category collections, kept in sync when enabled)
+
+Example Usage:
+    ```python
+    indexed = index_catalog(config.sitemap_url)
+    print(f"{indexed} products indexed")
+    ```
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from uuid import uuid5, NAMESPACE_URL
+from catalog_ingestion import ProductRecord, iter_pages, parse_product_page, load_http_cache, save_http_cache
+from product_category import get_product_category, is_classification_error
+from price_parser import parse_price
+from product_attributes import extract_product_attributes
+from tenants import get_tenant
+from category_partitions import get_category_partitions
+from llm_scheduler import background_calls
+import chromadb
+import json
+import os
+import queue
+import threading
+import product_retriever
+import config
+
+_END_OF_STREAM = object()
+
+class _Chunk:
+    """A chunk of the catalog flowing through the stages."""
+
+    def __init__(self, index: int, pages: list):
+        self.index = index
+        self.pages = pages
+        self.records = []
+        self.validators = {}
+        self.vectors = []
+
+class _ChunkFailure:
+    """A chunk whose processing failed, carrying the error to the committing thread."""
+
+    def __init__(self, index: int | None, error: Exception):
+        self.index = index
+        self.error = error
+
+def _parse(chunk: _Chunk, parse_pool: ProcessPoolExecutor):
+    products = parse_pool.map(parse_product_page, [page for _, _, page, _ in chunk.pages])
+    chunk.records = [
+        ProductRecord(source, product, position)
+        for (position, source, _, _), product in zip(chunk.pages, products)
+    ]
+    chunk.validators = {source: validators for _, source, _, validators in chunk.pages}
+    chunk.pages = None  # Release the raw pages
+
+def _normalize_metadata(chunk: _Chunk, normalize_pool: ThreadPoolExecutor, gender: str | None = "women"):
+    prices = normalize_pool.map(parse_price, [record.product.price_regular for record in chunk.records])
+    attributes = normalize_pool.map(extract_product_attributes, [record.document.page_content for record in chunk.records])
+    for record, price, product_attributes in zip(chunk.records, prices, attributes):
+        record.document.metadata["key"] = record.position
+        record.document.metadata["title"] = record.product.title
+        if gender is not None:
+            record.document.metadata["gender"] = gender
+        if price is not None:
+            record.document.metadata["price_regular"] = price
+        record.document.metadata.update(product_attributes)
+
+def _background_product_category(document: str, tenant: str | None) -> str | None:
+    # Indexing yields the LLM backend to the searches, without latency budget
+    with background_calls():
+        return get_product_category(document, tenant)
+
+def _categorize(chunk: _Chunk, category_pool: ThreadPoolExecutor, tenant: str | None = None):
+    documents = [record.document.page_content for record in chunk.records]
+    categories = category_pool.map(_background_product_category, documents, [tenant] * len(documents))
+    for record, category in zip(chunk.records, categories):
+        if is_classification_error(category):
+            # The chunk is retried by the next run, resumed from its checkpoint
+            raise RuntimeError(f"Classification of {record.source} failed: {category}")
+        if category is not None:
+            record.document.metadata["category"] = category
+
+def _embed(chunk: _Chunk, embed_pool: ThreadPoolExecutor):
+    if chunk.records:
+        texts = [record.document.page_content for record in chunk.records]
+        chunk.vectors = embed_pool.submit(product_retriever.embeddings.embed_documents, texts).result()
+
+def _upsert(chunk: _Chunk, collection, partitions=None):
+    if chunk.records:
+        ids = [str(uuid5(NAMESPACE_URL, record.source)) for record in chunk.records]
+        documents = [record.document.page_content for record in chunk.records]
+        metadatas = [record.document.metadata for record in chunk.records]
+        # The products already indexed from these pages, under their URL id or another id
+        ids_by_source = {record.source: product_id for record, product_id in zip(chunk.records, ids)}
+        indexed = collection.get(where={"source": {"$in": list(ids_by_source)}}, include=["metadatas"])
+        previous_categories = {}
+        replaced = {}  # Id of another indexing run -> its category
+        for indexed_id, metadata in zip(indexed["ids"], indexed["metadatas"]):
+            product_id = ids_by_source.get((metadata or {}).get("source"))
+            if product_id is None:
+                continue
+            previous_categories[product_id] = (metadata or {}).get("category")
+            if indexed_id != product_id:
+                replaced[indexed_id] = previous_categories[product_id]
+        collection.upsert(ids=ids, embeddings=chunk.vectors, documents=documents, metadatas=metadatas)
+        if replaced:
+            collection.delete(ids=list(replaced))
+        if partitions is not None:
+            partitions.upsert(ids, chunk.vectors, documents, metadatas, previous_categories)
+            partitions.delete(replaced)
+
+def _run_stage(function, pool, inbox: queue.Queue, outbox: queue.Queue, stop: threading.Event):
+    """Applies a stage to every chunk of the inbox and passes it on to the outbox."""
+    while True:
+        chunk = inbox.get()
+        if chunk is _END_OF_STREAM:
+            outbox.put(_END_OF_STREAM)
+            return
+        if not stop.is_set() and isinstance(chunk, _Chunk):
+            try:
+                function(chunk, pool)
+            except Exception as e:
+                chunk = _ChunkFailure(chunk.index, e)
+        outbox.put(chunk)
+
+def _feed(chunks, outbox: queue.Queue, stop: threading.Event):
+    """Puts the chunks of the source in the first queue, blocking while the pipeline is full."""
+    try:
+        for chunk in chunks:
+            if stop.is_set():
+                break
+            outbox.put(chunk)
+    except Exception as e:
+        outbox.put(_ChunkFailure(None, e))
+    outbox.put(_END_OF_STREAM)
+
+def _load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_checkpoint(path: str, checkpoint: dict):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+def index_catalog(source: str | None = None, chunk_size: int | None = None, resume: bool = True, conditional: bool = True, tenant: str | None = None) -> int:
+    """Indexes the product catalog into the vector store as a stream of chunks.
+
+    Args:
+        source (str, optional): A sitemap URL or a directory of saved HTML pages.
+            Defaults to `config.sitemap_url`.
+        chunk_size (int, optional): The number of pages per chunk. Defaults to `config.indexer_chunk_size`.
+        resume (bool, optional): Whether to resume an interrupted run from its last committed chunk.
+            Defaults to True.
+        conditional (bool, optional): Whether to skip the pages unchanged since the previous run,
+            when scraping the website. Defaults to True.
+        tenant (str, optional): The brand catalog to index into (see tenants.py), with its
+            gender and category schema. Defaults to `config.default_tenant`.
+
+    Returns:
+        int: The number of products indexed by this run.
+
+    Raises:
+        RuntimeError: If a chunk failed. The chunks committed before it are kept, and the
+            next run resumes from the failed chunk.
+    """
+    source = source or config.sitemap_url
+    chunk_size = chunk_size or config.indexer_chunk_size
+    checkpoint_path = config.indexer_checkpoint_path
+    catalog = get_tenant(tenant)
+
+    checkpoint = _load_checkpoint(checkpoint_path) if resume else {}
+    if checkpoint.get("source") != source or checkpoint.get("chunk_size") != chunk_size or checkpoint.get("tenant", config.default_tenant) != catalog.name:
+        checkpoint = {"source": source, "chunk_size": chunk_size, "tenant": catalog.name, "committed_chunks": 0}
+    start_chunk = checkpoint["committed_chunks"]
+    if start_chunk > 0:
+        print(f"Resuming indexing from chunk {start_chunk}")
+
+    http_cache = load_http_cache(config.ingestion_http_cache_path) if conditional else None
+
+    client = chromadb.PersistentClient(path=catalog.persist_directory)
+    collection = client.get_or_create_collection(name=catalog.collection_name, embedding_function=product_retriever.embeddings)
+    partitions = get_category_partitions(catalog.name) if config.enable_category_partitions else None
+
+    chunks = (
+        _Chunk(index, pages)
+        for index, pages in enumerate(iter_pages(source, chunk_size, start_chunk, http_cache), start_chunk)
+    )
+
+    pools = [
+        ProcessPoolExecutor(max_workers=config.ingestion_parse_processes),
+        ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-normalize"),
+        ThreadPoolExecutor(max_workers=config.indexer_category_workers, thread_name_prefix="index-category"),
+        ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-embed"),
+    ]
+    stages = [_parse, partial(_normalize_metadata, gender=catalog.gender), partial(_categorize, tenant=catalog.name), _embed]
+    queues = [queue.Queue(maxsize=config.indexer_queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    threads = [threading.Thread(target=_feed, args=(chunks, queues[0], stop), daemon=True)]
+    for i, (stage, pool) in enumerate(zip(stages, pools)):
+        threads.append(threading.Thread(target=_run_stage, args=(stage, pool, queues[i], queues[i + 1], stop), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    # Upsert and commit the chunks in order on this thread
+    indexed = 0
+    failure = None
+    finished = False
+    try:
+        while True:
+            chunk = queues[-1].get()
+            if chunk is _END_OF_STREAM:
+                finished = True
+                break
+            if stop.is_set():
+                continue
+            if isinstance(chunk, _ChunkFailure):
+                failure = chunk
+                stop.set()
+                continue
+            try:
+                _upsert(chunk, collection, partitions)
+            except Exception as e:
+                failure = _ChunkFailure(chunk.index, e)
+                stop.set()
+                continue
+            indexed += len(chunk.records)
+            checkpoint["committed_chunks"] = chunk.index + 1
+            _save_checkpoint(checkpoint_path, checkpoint)
+            if http_cache is not None:
+                http_cache.update(chunk.validators)
+                save_http_cache(config.ingestion_http_cache_path, http_cache)
+            print(f"Committed chunk {chunk.index} ({indexed} products indexed)")
+    finally:
+        stop.set()
+        # Drain the pipeline so that no stage stays blocked on a full queue
+        while not finished:
+            finished = queues[-1].get() is _END_OF_STREAM
+        for thread in threads:
+            thread.join()
+        for pool in pools:
+            pool.shutdown()
+        if indexed:
+            product_retriever.notify_catalog_change()
+
+    if failure is not None:
+        raise RuntimeError(f"Indexing failed at chunk {failure.index}: {failure.error}") from failure.error
+
+    # The run is complete, the next one starts from the beginning
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return indexed
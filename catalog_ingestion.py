@@ -0,0 +1,295 @@
+"""
+Concurrent catalog ingestion from the Soeur Paris product sitemap.
+
+This module scrapes the product pages listed in the product sitemap and parses them into
+products and their documents for indexing:
+
+- Pages are fetched by an asynchronous fetcher with bounded concurrency
+  (`config.ingestion_max_concurrency`).
+- Pages are parsed with lxml in a process pool (`config.ingestion_parse_processes`),
+  overlapping with the fetching of the next pages.
+- Each product is returned together with its document in a `ProductRecord`, so the
+  products and the documents cannot get out of alignment.
+- Conditional GETs (ETag / Last-Modified) skip the pages unchanged since the previous
+  run. The validators are kept in `config.ingestion_http_cache_path`.
+- A directory of saved HTML pages can be ingested instead of the website, for offline runs.
+- `iter_pages` yields the raw pages in fixed-size chunks, for the streaming indexer
+  (see catalog_indexer.py).
+
+Dependencies:
+    - aiohttp (for the asynchronous HTTP client)
+    - lxml (for HTML parsing)
+    - langchain_core (for the Document class)
+
+Example Usage:
+    ```python
+    product_records = load_products(config.sitemap_url)
+    documents = [record.document for record in product_records]
+    ```
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.documents import Document
+from typing import Iterator
+import aiohttp
+import asyncio
+import html
+import json
+import lxml.html
+import os
+import re
+import config
+
+class Product:
+    """A product scraped from a product page.
+
+    Attributes:
+        title (str): The product name.
+        price_regular (str): The regular price, as displayed on the page.
+        description (str): The product description.
+        fabrication (str): The fabrication details (materials, care, origin).
+    """
+
+    def __init__(self, title, price_regular, description, fabrication):
+        self.title = title
+        self.price_regular = price_regular
+        self.description = description
+        self.fabrication = fabrication
+
+    def as_string(self):
+        return str(getattr(self, "title", "null") + "|" + getattr(self, "price_regular", "null") + "|" + getattr(self, "description", "null") + "|" + getattr(self, "fabrication", "null"))
+
+class ProductRecord:
+    """A scraped product together with the document indexed for it.
+
+    Attributes:
+        source (str): The URL or file the product was parsed from.
+        product (Product): The parsed product.
+        document (Document): The document to index, with the product as page content.
+        position (int | None): The position of the page in the sitemap or directory.
+    """
+
+    def __init__(self, source: str, product: Product, position: int | None = None):
+        self.source = source
+        self.product = product
+        self.position = position
+        self.document = Document(page_content=product.as_string(), metadata={"source": source, "loc": source})
+
+    def __repr__(self) -> str:
+        return f"ProductRecord(source={self.source!r}, title={self.product.title!r})"
+
+def sanitize_text(value: str | None) -> str:
+    """Normalizes a text extracted from a page for the pipe-separated product string."""
+    if value is None:
+        return "null"
+    return value.strip().replace("|", " ").replace("\u00A0", " ").replace("\n", " ").replace("\r", " ")
+
+def _has_class(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+# XPath of each product field in a product page
+product_xpaths = {
+    "title": f"//div[{_has_class('product__title')}]",
+    "price_regular": f"//span[{_has_class('price-item')} and {_has_class('price-item--regular')}]",
+    "description": f"//div[{_has_class('tab')} and @data-target='description']",
+    "fabrication": f"//div[{_has_class('tab')} and @data-target='fabrication']",
+}
+
+def parse_product_page(page: str) -> Product:
+    """Parses a product page into a product.
+
+    Args:
+        page (str): The HTML of the product page.
+
+    Returns:
+        Product: The product, with "null" for the fields not found in the page.
+    """
+    fields = dict.fromkeys(product_xpaths, "null")
+    if page.strip():
+        tree = lxml.html.fromstring(page)
+        for field, xpath in product_xpaths.items():
+            elements = tree.xpath(xpath)
+            if elements:
+                fields[field] = sanitize_text(elements[0].text_content())
+    return Product(**fields)
+
+def load_http_cache(path: str | None) -> dict:
+    """Loads the ETag / Last-Modified validators of the previous run."""
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_http_cache(path: str | None, http_cache: dict):
+    """Saves the ETag / Last-Modified validators for the next run."""
+    if path is None:
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(http_cache, f)
+
+async def _fetch(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, url: str, http_cache: dict | None) -> tuple:
+    """Fetches a page, returning the page and its validators.
+
+    The page is None if it is unchanged since the previous run or failed.
+    """
+    headers = {}
+    validators = http_cache.get(url, {}) if http_cache is not None else {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last_modified" in validators:
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    try:
+        async with semaphore:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    return None, validators
+                response.raise_for_status()
+                page = await response.text()
+    except Exception as e:
+        print(f"Error fetching {url}: {e}")
+        return None, validators
+
+    validators = {}
+    if "ETag" in response.headers:
+        validators["etag"] = response.headers["ETag"]
+    if "Last-Modified" in response.headers:
+        validators["last_modified"] = response.headers["Last-Modified"]
+    return page, validators
+
+def _client_session() -> aiohttp.ClientSession:
+    headers = {"User-Agent": os.environ["USER_AGENT"]} if "USER_AGENT" in os.environ else None
+    return aiohttp.ClientSession(headers=headers)
+
+async def fetch_sitemap_urls(session: aiohttp.ClientSession, sitemap_url: str, url_pattern: str) -> list:
+    """Returns the URLs of the sitemap matching the URL pattern, in sitemap order."""
+    async with session.get(sitemap_url) as response:
+        response.raise_for_status()
+        sitemap = await response.text()
+    urls = [html.unescape(url) for url in re.findall(r"<loc>\s*(.*?)\s*</loc>", sitemap)]
+    return [url for url in urls if re.match(url_pattern, url)]
+
+async def scrape_products(sitemap_url: str | None = None, url_pattern: str | None = None, conditional: bool = True) -> list:
+    """Scrapes and parses the product pages listed in a sitemap.
+
+    Args:
+        sitemap_url (str, optional): The sitemap URL. Defaults to `config.sitemap_url`.
+        url_pattern (str, optional): The regex the product page URLs match. Defaults to `config.product_url_pattern`.
+        conditional (bool, optional): Whether to skip the pages unchanged since the previous run. Defaults to True.
+
+    Returns:
+        list: The ProductRecord of each changed product page, in sitemap order.
+    """
+    sitemap_url = sitemap_url or config.sitemap_url
+    url_pattern = url_pattern or config.product_url_pattern
+    http_cache = load_http_cache(config.ingestion_http_cache_path) if conditional else None
+    semaphore = asyncio.Semaphore(config.ingestion_max_concurrency)
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(max_workers=config.ingestion_parse_processes) as parse_pool:
+        async with _client_session() as session:
+            urls = await fetch_sitemap_urls(session, sitemap_url, url_pattern)
+
+            async def fetch_and_parse(position: int, url: str) -> ProductRecord | None:
+                page, validators = await _fetch(session, semaphore, url, http_cache)
+                if page is None:
+                    return None
+                if http_cache is not None:
+                    http_cache[url] = validators
+                product = await loop.run_in_executor(parse_pool, parse_product_page, page)
+                return ProductRecord(url, product, position)
+
+            product_records = await asyncio.gather(*(fetch_and_parse(position, url) for position, url in enumerate(urls)))
+
+    if http_cache is not None:
+        save_http_cache(config.ingestion_http_cache_path, http_cache)
+    return [product_record for product_record in product_records if product_record is not None]
+
+def _saved_page_paths(directory: str) -> list:
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.endswith((".html", ".htm"))
+    )
+
+def load_products_from_directory(directory: str) -> list:
+    """Parses a directory of saved product pages, for offline ingestion.
+
+    Args:
+        directory (str): The directory containing the `.html` product pages.
+
+    Returns:
+        list: The ProductRecord of each page, sorted by file name.
+    """
+    paths = _saved_page_paths(directory)
+    pages = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            pages.append(f.read())
+
+    with ProcessPoolExecutor(max_workers=config.ingestion_parse_processes) as parse_pool:
+        products = parse_pool.map(parse_product_page, pages, chunksize=16)
+        return [ProductRecord(path, product, position) for position, (path, product) in enumerate(zip(paths, products))]
+
+def load_products(source: str | None = None, conditional: bool = True) -> list:
+    """Loads the products from the website sitemap or from a directory of saved pages.
+
+    Args:
+        source (str, optional): A sitemap URL or a directory of saved HTML pages.
+            Defaults to `config.sitemap_url`.
+        conditional (bool, optional): Whether to skip the pages unchanged since the previous
+            run, when scraping the website. Defaults to True.
+
+    Returns:
+        list: The ProductRecord of each product.
+    """
+    if source is not None and os.path.isdir(source):
+        return load_products_from_directory(source)
+    return asyncio.run(scrape_products(source, conditional=conditional))
+
+
+async def _fetch_chunk(urls: list, http_cache: dict | None) -> list:
+    semaphore = asyncio.Semaphore(config.ingestion_max_concurrency)
+    async with _client_session() as session:
+        return await asyncio.gather(*(_fetch(session, semaphore, url, http_cache) for url in urls))
+
+async def _fetch_urls(sitemap_url: str, url_pattern: str) -> list:
+    async with _client_session() as session:
+        return await fetch_sitemap_urls(session, sitemap_url, url_pattern)
+
+def iter_pages(source: str | None = None, chunk_size: int = 64, start_chunk: int = 0, http_cache: dict | None = None) -> Iterator[list]:
+    """Yields the raw product pages in fixed-size chunks, fetching one chunk at a time.
+
+    Only one chunk of pages is held in memory at a time. The pages unchanged since the
+    previous run (per the validators in `http_cache`) and the pages that failed are left
+    out of their chunk, so a chunk may hold fewer pages than `chunk_size`.
+
+    Args:
+        source (str, optional): A sitemap URL or a directory of saved HTML pages.
+            Defaults to `config.sitemap_url`.
+        chunk_size (int, optional): The number of pages per chunk. Defaults to 64.
+        start_chunk (int, optional): The index of the first chunk to yield, to resume a run. Defaults to 0.
+        http_cache (dict, optional): The validators of the previous run for conditional GETs.
+            It is not modified: the validators of each page are yielded with it.
+
+    Yields:
+        list: The (position, source, page, validators) tuple of each page of the chunk.
+    """
+    if source is not None and os.path.isdir(source):
+        paths = _saved_page_paths(source)
+        for start in range(start_chunk * chunk_size, len(paths), chunk_size):
+            chunk = []
+            for position, path in enumerate(paths[start:start + chunk_size], start):
+                with open(path, encoding="utf-8") as f:
+                    chunk.append((position, path, f.read(), {}))
+            yield chunk
+        return
+
+    urls = asyncio.run(_fetch_urls(source or config.sitemap_url, config.product_url_pattern))
+    for start in range(start_chunk * chunk_size, len(urls), chunk_size):
+        chunk_urls = urls[start:start + chunk_size]
+        responses = asyncio.run(_fetch_chunk(chunk_urls, http_cache))
+        yield [
+            (position, url, page, validators)
+            for position, (url, (page, validators)) in enumerate(zip(chunk_urls, responses), start)
+            if page is not None
+        ]
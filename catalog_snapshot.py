@@ -0,0 +1,197 @@
+"""
+Immutable, memory-mapped catalog snapshot shared by the worker processes.
+
+Every process that opens the Chroma store keeps its own copy of the documents and metadata
+it reads. This module exports the whole catalog once into a read-only snapshot directory
+that the workers memory-map without copying, so the catalog has a single physical copy in
+the page cache and a worker is ready as soon as the files are mapped:
+
+- The vector files of the quantized store (see quantized_store.py): the float32 vectors,
+  their int8 or float16 codes, the ids and the filter columns.
+- One `.npy` column per other metadata field (`title`, `source`, ...).
+- `documents.bin`: the UTF-8 documents packed back to back, with `document_offsets.npy`,
+  the offset of each document in the blob (one more offset than documents).
+
+Each snapshot is written to a new versioned directory next to the snapshot path
+(`<path>.v1`, `<path>.v2`, ...), and the snapshot path is a symlink to the current version,
+swapped in with an atomic rename. A process opening the snapshot resolves the symlink once,
+so it never sees a partially written snapshot, nor files of two versions, and the snapshot
+path always exists. The previous version is kept for the processes opening it during the
+swap; the older ones are deleted. Retrieval is served from
+the snapshot when `config.catalog_snapshot_path` is set (see `product_retriever`).
+
+Dependencies:
+    - numpy
+    - quantized_store.py
+    - product_retriever.py (for the export from the Chroma collection)
+
+Example Usage:
+    ```python
+    export_catalog_snapshot("./catalog_snapshot")
+    snapshot = CatalogSnapshot("./catalog_snapshot")
+    print(snapshot.documents(snapshot.rows_by_key([12, 40])))
+    ```
+"""
+
+from quantized_store import QuantizedVectorStore, filter_columns, metadata_column, write_quantized_store
+import json
+import mmap
+import os
+import shutil
+import numpy as np
+import config
+
+def _column_dtype(values: list):
+    """Infers the column type of a metadata field: float for numbers, str otherwise."""
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        return np.float64
+    return str
+
+def _snapshot_versions(path: str) -> list:
+    """Returns the version numbers of the directories written for a snapshot path, in ascending order."""
+    directory, name = os.path.split(path)
+    prefix = name + ".v"
+    return sorted(
+        int(entry[len(prefix):])
+        for entry in os.listdir(directory or ".")
+        if entry.startswith(prefix) and entry[len(prefix):].isdigit()
+    )
+
+def write_catalog_snapshot(path: str, ids: list, vectors, documents: list, metadatas: list, vector_format: str = "float16"):
+    """Writes a catalog snapshot, replacing the previous snapshot at the same path.
+
+    The snapshot is written to a new versioned directory, then the `path` symlink is
+    atomically replaced to point to it, so processes opening the snapshot concurrently
+    get either the previous or the new version, never a missing or partial one.
+
+    Args:
+        path (str): The snapshot path, a symlink to the current version directory.
+        ids (list): The Chroma id of each product.
+        vectors: The full-precision vectors, one per row.
+        documents (list): The document of each product.
+        metadatas (list): The metadata dict of each product.
+        vector_format (str, optional): "int8" or "float16". Defaults to "float16".
+    """
+    path = os.path.normpath(path)
+    versions = _snapshot_versions(path)
+    new_path = f"{path}.v{versions[-1] + 1 if versions else 1}"
+    write_quantized_store(new_path, ids, vectors, metadatas, vector_format)
+
+    # Columnar metadata for the fields that are not filter columns
+    metadata_fields = sorted({field for metadata in metadatas if metadata for field in metadata} - set(filter_columns))
+    for field in metadata_fields:
+        values = [metadata.get(field) if metadata else None for metadata in metadatas]
+        np.save(os.path.join(new_path, f"{field}.npy"), metadata_column(values, _column_dtype(values)))
+
+    # Packed documents with their offsets
+    offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+    with open(os.path.join(new_path, "documents.bin"), "wb") as f:
+        for row, document in enumerate(documents):
+            data = (document or "").encode("utf-8")
+            f.write(data)
+            offsets[row + 1] = offsets[row] + len(data)
+    np.save(os.path.join(new_path, "document_offsets.npy"), offsets)
+
+    with open(os.path.join(new_path, "snapshot.json"), "w", encoding="utf-8") as f:
+        json.dump({"metadata_fields": metadata_fields}, f)
+
+    # A snapshot written as a plain directory becomes the previous version
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.rename(path, f"{path}.v0")
+        os.symlink(os.path.basename(f"{path}.v0"), path)
+    previous_path = os.path.realpath(path) if os.path.islink(path) else None
+
+    # Swap the new snapshot in by replacing the symlink, relative so that the snapshots can be moved
+    link_path = path + ".link"
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.basename(new_path), link_path)
+    os.replace(link_path, path)
+
+    # Processes that mapped the files of an old version keep reading them after the deletion
+    for version in _snapshot_versions(path):
+        version_path = f"{path}.v{version}"
+        if version_path != new_path and os.path.realpath(version_path) != previous_path:
+            shutil.rmtree(version_path, ignore_errors=True)
+
+def export_catalog_snapshot(path: str | None = None, vector_format: str | None = None) -> int:
+    """Exports the Chroma collection to a catalog snapshot.
+
+    Args:
+        path (str, optional): The snapshot directory. Defaults to `config.catalog_snapshot_path`.
+        vector_format (str, optional): "int8" or "float16". Defaults to `config.vector_store_format`
+            if it is one of them, otherwise "float16".
+
+    Returns:
+        int: The number of exported products.
+
+    Raises:
+        ValueError: If no path is given and `config.catalog_snapshot_path` is not set.
+    """
+    from product_retriever import get_collection
+
+    path = path or config.catalog_snapshot_path
+    if path is None:
+        raise ValueError("No catalog snapshot path: set config.catalog_snapshot_path")
+    if vector_format is None:
+        vector_format = config.vector_store_format if config.vector_store_format in ("int8", "float16") else "float16"
+    catalog = get_collection().get(include=["embeddings", "documents", "metadatas"])
+    write_catalog_snapshot(path, catalog["ids"], np.asarray(catalog["embeddings"]), catalog["documents"], catalog["metadatas"], vector_format)
+    return len(catalog["ids"])
+
+class CatalogSnapshot(QuantizedVectorStore):
+    """A read-only, memory-mapped catalog snapshot: vectors, metadata columns and documents.
+
+    Attributes:
+        metadata_fields (list): The metadata fields stored as columns, besides the filter columns.
+    """
+
+    def __init__(self, path: str):
+        """Memory-maps a snapshot directory written by `write_catalog_snapshot`.
+
+        Args:
+            path (str): The snapshot path.
+        """
+        # Resolve the symlink once, so that every file comes from the same version
+        path = os.path.realpath(path)
+        super().__init__(path)
+        with open(os.path.join(path, "snapshot.json"), encoding="utf-8") as f:
+            self.metadata_fields = json.load(f)["metadata_fields"]
+        for field in self.metadata_fields:
+            self.columns[field] = np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(path, "document_offsets.npy"), mmap_mode="r")
+        with open(os.path.join(path, "documents.bin"), "rb") as f:
+            # An empty file cannot be memory-mapped
+            self._documents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._offsets[-1] > 0 else b""
+
+    def document(self, row: int) -> str:
+        """Returns the document of a row."""
+        return self._documents[self._offsets[row]:self._offsets[row + 1]].decode("utf-8")
+
+    def documents(self, rows) -> list:
+        """Returns the documents of rows, in the order of the rows."""
+        return [self.document(row) for row in np.asarray(rows).tolist()]
+
+    def metadata(self, row: int) -> dict:
+        """Returns the metadata dict of a row, without the missing fields."""
+        metadata = {}
+        for field, column in self.columns.items():
+            value = column[row].item()
+            if value == "" or value != value or (field == "key" and value == -1):
+                continue
+            metadata[field] = value
+        return metadata
+
+    def rows_by_key(self, keys: list) -> np.ndarray:
+        """Returns the rows of the products with the given keys, in the order of their first occurrence.
+
+        The keys are converted to the type of the key column, so that e.g. "12" matches 12.
+        """
+        key_column = self.columns["key"]
+        keys = np.asarray(keys, dtype=key_column.dtype)
+        rows = np.flatnonzero(np.isin(key_column, keys))
+        position = {}
+        for index, key in enumerate(keys.tolist()):
+            position.setdefault(key, index)
+        return rows[np.argsort([position[key] for key in key_column[rows].tolist()], kind="stable")]
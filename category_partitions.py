@@ -0,0 +1,240 @@
+"""
+Category-partitioned Chroma collections for the category-filtered queries.
+
+Most searches carry a category filter (see product_category.py), but Chroma searches the
+global HNSW graph of the catalog and filters the neighbors afterwards: for a selective
+category (e.g. "Gloves" or "Belts") most of the graph walk is wasted, and fewer than
+`n_results` products may be returned. This module keeps, next to the global collection of a
+tenant, one small collection per category (a partition), holding the same ids, embeddings,
+documents and metadata:
+
+- A category-filtered query searches the partition of its category only, with the other
+  filters (price, gender) as its `where` clause (see product_retriever.py). The queries
+  without category, and the categories without partition, are served by the global collection;
+  a missing partition is looked up again after a few seconds, so partitions built meanwhile
+  by another process are picked up without a restart.
+- The catalog indexer upserts each chunk into the partitions too, and removes a product from
+  the partition of its previous category when its category changed (see catalog_indexer.py).
+- `build_category_partitions()` rebuilds the partitions of a tenant from its global collection,
+  e.g. before enabling `config.enable_category_partitions` on an existing store.
+
+The memory-mapped stores (quantized store, catalog snapshot) do not need partitions: they
+only score the rows of the `where` mask.
+
+Dependencies:
+    - chromadb
+    - product_retriever.py (embeddings)
+    - tenants.py (vector store location of the catalog)
+
+Example Usage:
+    ```python
+    build_category_partitions()
+    config.enable_category_partitions = True
+    candidates = retrieve_candidates(ProductQuery("leather gloves", {"category": "Gloves"}), 8)
+    ```
+"""
+
+from product_retriever import embeddings, notify_catalog_change
+from tenants import get_tenant, on_tenant_close
+import chromadb
+import os
+import re
+import threading
+import time
+import config
+
+# Between the global collection name and the category in the partition names
+_PARTITION_INFIX = "-category-"
+
+# Seconds before a category without partition is looked up again, e.g. after build_category_partitions() in another process
+_MISSING_PARTITION_TTL = 30.0
+
+def partition_name(collection_name: str, category: str) -> str:
+    """Returns the name of the Chroma collection of a category partition.
+
+    Args:
+        collection_name (str): The name of the global collection.
+        category (str): The product category.
+
+    Returns:
+        str: The collection name, e.g. "soeur-products-category-coats-jackets" for "Coats & Jackets".
+    """
+    slug = re.sub(r"[^a-z0-9]+", "-", category.lower()).strip("-") or "other"
+    return f"{collection_name}{_PARTITION_INFIX}{slug}"
+
+class CategoryPartitions:
+    """The category partitions of the collection of a tenant."""
+
+    def __init__(self, tenant: str | None = None):
+        """Opens the Chroma store of a tenant.
+
+        Args:
+            tenant (str, optional): The tenant name (see tenants.py). Defaults to `config.default_tenant`.
+        """
+        catalog = get_tenant(tenant)
+        self.collection_name = catalog.collection_name
+        self.client = chromadb.PersistentClient(path=catalog.persist_directory)
+        self._partitions = {}  # Category -> collection
+        self._missing = {}  # Category without partition -> time of its next lookup
+        self._lock = threading.Lock()
+
+    def get(self, category: str):
+        """Returns the partition collection of a category, or None if it was never built.
+
+        A missing partition is looked up again after `_MISSING_PARTITION_TTL` seconds, so the
+        serving processes pick up the partitions built meanwhile by another process.
+
+        Args:
+            category (str): The product category.
+        """
+        with self._lock:
+            partition = self._partitions.get(category)
+            if partition is not None:
+                return partition
+            if self._missing.get(category, 0.0) > time.monotonic():
+                return None
+            try:
+                partition = self.client.get_collection(
+                    name=partition_name(self.collection_name, category), embedding_function=embeddings
+                )
+            except Exception:
+                self._missing[category] = time.monotonic() + _MISSING_PARTITION_TTL
+                return None
+            self._partitions[category] = partition
+            self._missing.pop(category, None)
+            return partition
+
+    def _get_or_create(self, category: str):
+        with self._lock:
+            partition = self._partitions.get(category)
+            if partition is None:
+                partition = self.client.get_or_create_collection(
+                    name=partition_name(self.collection_name, category), embedding_function=embeddings
+                )
+                self._partitions[category] = partition
+                self._missing.pop(category, None)
+            return partition
+
+    def upsert(self, ids: list, vectors: list, documents: list, metadatas: list, previous_categories: dict | None = None):
+        """Upserts products into the partitions of their categories.
+
+        Args:
+            ids (list): The product ids.
+            vectors (list): The product embeddings.
+            documents (list): The product documents.
+            metadatas (list): The product metadata. The products without category are only
+                removed from their previous partition.
+            previous_categories (dict, optional): The category of the products already indexed,
+                by id, to remove the products whose category changed from their previous partition.
+        """
+        moved = {}
+        groups = {}
+        for product_id, vector, document, metadata in zip(ids, vectors, documents, metadatas):
+            category = (metadata or {}).get("category")
+            previous_category = (previous_categories or {}).get(product_id)
+            if previous_category is not None and previous_category != category:
+                moved.setdefault(previous_category, []).append(product_id)
+            if category is not None:
+                group = groups.setdefault(category, ([], [], [], []))
+                for values, value in zip(group, (product_id, vector, document, metadata)):
+                    values.append(value)
+
+        for category, product_ids in moved.items():
+            partition = self.get(category)
+            if partition is not None:
+                partition.delete(ids=product_ids)
+        for category, (product_ids, category_vectors, category_documents, category_metadatas) in groups.items():
+            self._get_or_create(category).upsert(
+                ids=product_ids, embeddings=category_vectors, documents=category_documents, metadatas=category_metadatas
+            )
+
+    def delete(self, categories: dict):
+        """Removes products from the partitions of their categories.
+
+        Args:
+            categories (dict): The category of each product, by id.
+        """
+        ids_by_category = {}
+        for product_id, category in categories.items():
+            if category is not None:
+                ids_by_category.setdefault(category, []).append(product_id)
+        for category, product_ids in ids_by_category.items():
+            partition = self.get(category)
+            if partition is not None:
+                partition.delete(ids=product_ids)
+
+    def rebuild(self, collection) -> dict:
+        """Deletes the partitions and builds them again from the global collection.
+
+        Args:
+            collection: The global Chroma collection of the tenant.
+
+        Returns:
+            dict: The number of products of each partition.
+        """
+        prefix = self.collection_name + _PARTITION_INFIX
+        with self._lock:
+            for existing in self.client.list_collections():
+                # Chroma returns collection objects, or names since 0.6
+                name = getattr(existing, "name", existing)
+                if name.startswith(prefix):
+                    self.client.delete_collection(name=name)
+            self._partitions.clear()
+            self._missing.clear()
+
+        catalog = collection.get(include=["embeddings", "documents", "metadatas"])
+        self.upsert(catalog["ids"], list(catalog["embeddings"]), catalog["documents"], catalog["metadatas"])
+        counts = {}
+        for metadata in catalog["metadatas"]:
+            category = (metadata or {}).get("category")
+            if category is not None:
+                counts[category] = counts.get(category, 0) + 1
+        notify_catalog_change()
+        return counts
+
+# Partitions of each tenant, opened again in a forked process like the Chroma clients
+_category_partitions = {}
+_category_partitions_pid = None
+_category_partitions_lock = threading.Lock()
+
+def _reset_category_partitions_lock():
+    global _category_partitions_lock
+    _category_partitions_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_category_partitions_lock)
+
+def _close_category_partitions(tenant: str):
+    # The Chroma system of a closed tenant is stopped (see tenants.py), its partitions are opened again on next use
+    with _category_partitions_lock:
+        _category_partitions.pop(tenant, None)
+
+on_tenant_close(_close_category_partitions)
+
+def get_category_partitions(tenant: str | None = None) -> CategoryPartitions:
+    """Returns the category partitions of a tenant, opening them on first use.
+
+    Args:
+        tenant (str, optional): The tenant name. Defaults to `config.default_tenant`.
+    """
+    global _category_partitions_pid
+    name = tenant or config.default_tenant
+    with _category_partitions_lock:
+        if _category_partitions_pid != os.getpid():
+            _category_partitions.clear()
+            _category_partitions_pid = os.getpid()
+        if name not in _category_partitions:
+            _category_partitions[name] = CategoryPartitions(name)
+        return _category_partitions[name]
+
+def build_category_partitions(tenant: str | None = None) -> dict:
+    """Rebuilds the category partitions of a tenant from its global collection.
+
+    Args:
+        tenant (str, optional): The tenant name. Defaults to `config.default_tenant`.
+
+    Returns:
+        dict: The number of products of each partition.
+    """
+    from product_retriever import get_collection
+    return get_category_partitions(tenant).rebuild(get_collection(tenant))
@@ -1,4 +1,193 @@
+import json
+import os
+import types
+
 # Configuration flag
 enable_purchase_history = True  # Set to False to disable personalization
 enable_metadata_extraction = True
-enable_query_transformation = True
\ No newline at end of file
+enable_query_transformation = True
+
+# Batch search (offline re-ranking and evaluation jobs)
+batch_max_concurrency = 4  # Maximum number of concurrent LLM calls per batch stage
+
+# Process-pool worker mode (multi-core serving)
+worker_processes = 4  # Number of pre-forked search worker processes
+worker_max_pending = 32  # Maximum number of in-flight requests before the dispatcher applies backpressure
+
+# HTTP search service
+service_host = "127.0.0.1"
+service_port = 8000
+service_request_timeout = 60.0  # Seconds before a request is cancelled
+service_max_workers = 8  # Threads running the blocking pipeline stages
+
+# Stage latency budgets in seconds, after which a stage degrades to its fallback:
+# - comparison_operator: regex-only price extraction
+# - product_category: no category filter
+# - query_transformation: original query
+# - purchase_history: no personalization
+stage_timeouts = {
+    "comparison_operator": 3.0,
+    "product_category": 3.0,
+    "query_transformation": 3.0,
+    "purchase_history": 10.0,
+}
+hedge_base_url = None  # Second Ollama backend for hedged requests, e.g. "http://localhost:11435"
+hedge_delay = 1.0  # Seconds to wait for the primary backend before sending a hedged request
+
+# LLM admission control and priority queueing (see llm_scheduler.py), per process
+llm_max_concurrency = 2  # LLM calls running on the Ollama backend at once; the others wait in priority order
+llm_background_max_concurrency = 1  # Of which background calls (preference precomputation, indexing)
+llm_shed_queue_depth = 8  # Waiting interactive LLM calls beyond which new searches skip the LLM stages (retrieval-only response)
+# Priority class of the LLM calls of each stage: "generation", then "query_understanding", then "background"
+llm_stage_priorities = {
+    "response": "generation",
+    "comparison_operator": "query_understanding",
+    "product_category": "query_understanding",
+    "query_transformation": "query_understanding",
+    "purchase_history": "query_understanding",
+}
+
+
+# Pipeline graph (see pipeline.py)
+pipeline_max_workers = 4  # Maximum number of stages running in parallel
+pipeline_memoize_size = 1024  # Maximum number of memoized stage outputs
+pipeline_memoize_ttl = 600.0  # Seconds a memoized stage output is served, e.g. the candidates after another process re-indexed the catalog
+pipeline_stage_functions = {}  # Stage implementations to swap in, e.g. {"search_results": "my_module:my_retriever"}
+
+# Brand catalogs served by this process (see tenants.py)
+default_tenant = "soeur"  # Tenant of the product queries without one
+tenants = {
+    "soeur": {
+        "collection_name": "soeur-products",
+        "persist_directory": "./chroma_products_souer",
+        "gender": "women",  # Gender filter of the filtered queries; None for no gender filter
+        "product_categories": None,  # Category schema; None for the categories of product_category.py
+    },
+}
+max_open_tenants = 8  # Collections of the other tenants kept open per process, least recently used closed first
+
+# Catalog ingestion (see catalog_ingestion.py)
+sitemap_url = "https://www.soeur.fr/en/sitemap_products_1.xml?from=5151806455948&to=14995974619510"
+product_url_pattern = r"https?://[^/]+/en/products/[^/]+"
+ingestion_max_concurrency = 8  # Maximum number of product pages fetched concurrently
+ingestion_parse_processes = 4  # Processes parsing the product pages
+ingestion_http_cache_path = "./ingestion_http_cache.json"  # ETag / Last-Modified of the scraped pages
+
+# Streaming indexer (see catalog_indexer.py)
+indexer_chunk_size = 64  # Number of product pages per chunk
+indexer_queue_size = 2  # Maximum number of chunks waiting between two stages
+indexer_category_workers = 4  # Concurrent LLM calls of the categorize stage
+indexer_checkpoint_path = "./indexer_checkpoint.json"  # Last committed chunk, to resume a failed run
+
+# Quantized vector store (see quantized_store.py)
+vector_store_format = "chroma"  # "chroma", or "int8" / "float16" to serve retrieval from the quantized store
+quantized_store_path = "./catalog_vectors"  # Directory of the memory-mapped quantized store
+quantized_rescore_candidates = 32  # Top approximate candidates re-scored with the full-precision vectors
+retrieval_truncate_dim = None  # e.g. 256: first-stage search on the truncated (Matryoshka) vectors; None for the full width
+query_embedding_cache_size = 4096  # Query embeddings kept in memory (as float16) per process
+
+# Read-only catalog snapshot (see catalog_snapshot.py)
+catalog_snapshot_path = None  # Directory of the memory-mapped catalog snapshot to serve retrieval from; None to use Chroma
+
+# Category partitions of the Chroma collections (see category_partitions.py)
+enable_category_partitions = False  # Serve the category-filtered queries from per-category collections kept in sync by the indexer; build them first with build_category_partitions()
+
+# Faceted search (see product_retriever.search_with_facets)
+facet_price_buckets = [0, 50, 100, 200, 300, 500, 1000]  # Lower edges of the price histogram buckets; the last one is open-ended
+facet_columns_ttl = 600.0  # Seconds the facet columns built from the Chroma metadata are reused, e.g. after another process re-indexed the catalog
+
+# Result pagination (see result_pages.py)
+page_size = 4  # Products per page
+page_max_results = 64  # Depth of the ranked list cached for the following pages
+page_cache_ttl = 300.0  # Seconds a ranked list is kept after its last page was served
+page_cache_size = 1024  # Maximum number of ranked lists cached per process
+
+# Post-retrieval re-ranking (see reranking.py)
+enable_reranking = False  # Re-rank over-fetched candidates with vector, BM25, price and customer features
+rerank_candidates = 16  # Candidates retrieved per query before re-ranking
+rerank_weights = {"vector": 1.0, "bm25": 0.3, "price": 0.3, "category": 0.3, "price_band": 0.2}
+
+# Customer affinity vectors (see customer_affinity.py)
+enable_customer_affinity = False  # Blend the customer's affinity vector into the query vector at retrieval
+customer_affinity_path = "./customer_affinity"  # Directory of the precomputed customer affinity store
+customer_affinity_weight = 0.2  # Weight of the affinity vector in the blended query vector
+
+# Purchase history compaction (see purchase_history.compact_purchase_history)
+compact_purchase_history = False  # Summarize the purchase history by category instead of pasting every product document
+purchase_history_token_budget = 512  # Approximate maximum number of tokens of the summarized purchase history
+purchase_history_top_attributes = 3  # Most frequent colors and fabrics kept per category
+
+# Customer preferences cache and background precomputation (see preference_worker.py)
+preference_cache_size = 10000  # Extracted customer preferences kept in memory per process
+preference_cache_ttl = 3600.0  # Seconds the extracted preferences are served before being extracted again
+enable_preference_precompute = False  # Extract the preferences of active and purchasing customers ahead of their searches
+preference_precompute_rate = 0.2  # Maximum number of background extractions per second
+preference_precompute_idle = 2.0  # Seconds without interactive LLM calls before a background extraction starts
+preference_precompute_queue_size = 1000  # Maximum number of queued customers, the lowest priority dropped first
+
+# Ollama prompt caching and model residency (see prompt_templates.py)
+llm_keep_alive = "30m"  # How long Ollama keeps a model loaded after a request, so that bursts do not reload it
+# ChatOllama options per stage (model, num_ctx, num_predict, ...). Stages sharing a model should use the same
+# num_ctx: Ollama reloads the model when it changes
+stage_llm_options = {
+    "comparison_operator": {"model": "llama3.2", "num_ctx": 24576},
+    "product_category": {"model": "llama3.2", "num_ctx": 24576},
+    "query_transformation": {"model": "llama3.2", "num_ctx": 24576},
+    "purchase_history": {"model": "llama3.2", "num_ctx": 24576},
+    "response": {"model": "llama3.2", "num_ctx": 24576},
+}
+# The classification stages only read a short query and write a few tokens, so they can run on a small model
+# with a small context: set to True after `ollama pull llama3.2:1b` to override their options with these
+enable_stage_model_routing = False
+routed_stage_llm_options = {
+    "comparison_operator": {"model": "llama3.2:1b", "num_ctx": 2048, "num_predict": 16},
+    "product_category": {"model": "llama3.2:1b", "num_ctx": 2048, "num_predict": 32},
+    "query_transformation": {"model": "llama3.2:1b", "num_ctx": 2048, "num_predict": 64},
+}
+# How the classification stages constrain their output: "json_schema" (grammar-constrained decoding of the
+# response schema by Ollama) or "function_calling" (tool calling, unconstrained)
+structured_output_method = "json_schema"
+
+# Persistent LLM response cache of the temperature-0 stages (see llm_cache.py)
+enable_llm_cache = False  # Serve repeated LLM calls of the cached stages from disk
+llm_cache_path = "./llm_cache.sqlite"  # SQLite file shared by the processes
+llm_cache_max_entries = 100000  # Maximum number of cached responses, least recently used evicted first
+llm_cache_stages = ["comparison_operator", "product_category", "query_transformation"]  # Stages whose LLM calls are cached
+
+def load_config(path: str | None = None):
+    """Overrides the configuration from a JSON file and from environment variables.
+
+    The file is read from `path`, or from the `RAG_CONFIG_FILE` environment variable.
+    Each setting can then be overridden by an environment variable named after it with
+    the `RAG_` prefix, e.g. `RAG_ENABLE_PURCHASE_HISTORY=false`. Values are parsed as
+    JSON when possible, and used as plain strings otherwise.
+
+    Args:
+        path (str, optional): The path of a JSON file mapping setting names to values.
+
+    Raises:
+        KeyError: If the file contains an unknown setting.
+    """
+    settings = {
+        name for name, value in globals().items()
+        if not name.startswith("_") and not callable(value) and not isinstance(value, types.ModuleType)
+    }
+
+    path = path or os.environ.get("RAG_CONFIG_FILE")
+    if path:
+        with open(path, encoding="utf-8") as f:
+            overrides = json.load(f)
+        for name, value in overrides.items():
+            if name not in settings:
+                raise KeyError(f"Unknown setting in {path}: {name}")
+            globals()[name] = value
+
+    for name in settings:
+        value = os.environ.get("RAG_" + name.upper())
+        if value is not None:
+            try:
+                globals()[name] = json.loads(value)
+            except json.JSONDecodeError:
+                globals()[name] = value
+
+load_config()
@@ -0,0 +1,159 @@
+"""
+Persistent cache of the LLM responses of the deterministic stages.
+
+The classification and query transformation stages call the LLM with `temperature=0`, so
+their response only depends on the model, its parameters and the messages. This module
+provides a LangChain cache backed by a SQLite file (`config.llm_cache_path`), set on the
+ChatOllama clients of the stages of `config.llm_cache_stages` (see
+`prompt_templates.stage_llm_kwargs`):
+
+- Entries are keyed by a hash of the LangChain LLM string (model and parameters) and the
+  messages, and store the generations serialized with `langchain_core.load`.
+- The file survives restarts and is shared by the worker processes: SQLite runs in WAL
+  mode, and each process and thread opens its own connection.
+- At most `config.llm_cache_max_entries` entries are kept: the least recently used ones
+  are evicted.
+- The file is only created by the first cached call, and the cache is disabled by default
+  (`config.enable_llm_cache`).
+- The responses served from the cache carry `response_metadata["llm_cache_hit"]`, so that
+  the Ollama timing stored with them is not counted as a backend call (see
+  `prompt_templates.record_timing`).
+
+Re-indexing the catalog or re-running an evaluation then only calls the LLM for the
+products and queries it has not seen. The key includes the model tag, not its weights:
+clear the cache (`get_llm_cache().clear()`) after pulling a new version of a model.
+
+Example Usage:
+    ```python
+    llm = ChatOllama(model="llama3.2", temperature=0, cache=get_llm_cache())
+    ```
+"""
+
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import config
+
+class SQLiteLLMCache(BaseCache):
+    """A size-bounded LangChain LLM cache stored in a SQLite file shared by processes."""
+
+    # Updates between two checks of the number of entries
+    eviction_interval = 64
+
+    def __init__(self, path: str, max_entries: int):
+        """Creates a cache of a file, opened (or created) by the first cached call.
+
+        Args:
+            path (str): The SQLite file.
+            max_entries (int): The maximum number of cached responses.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._updates = 0
+        self._updates_lock = threading.Lock()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _create_schema(self, connection: sqlite3.Connection):
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+            connection.commit()
+            self._schema_ready = True
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections are not shared across threads nor across a fork
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            if not self._schema_ready:
+                self._create_schema(connection)
+        return connection
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE | None:
+        """Returns the cached generations of a prompt for an LLM configuration, if any."""
+        key = self._key(prompt, llm_string)
+        connection = self._connection()
+        row = connection.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            generations = loads(row[0])
+        except Exception as e:
+            print(f"Error reading cached LLM response: {e}")
+            return None
+        for generation in generations:
+            # The stored Ollama timing is the one of the original call, not of this one
+            message = getattr(generation, "message", None)
+            if message is not None:
+                message.response_metadata["llm_cache_hit"] = True
+        connection.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        connection.commit()
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        """Caches the generations of a prompt for an LLM configuration."""
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, last_used) VALUES (?, ?, ?)",
+            (self._key(prompt, llm_string), dumps(list(return_val)), time.time())
+        )
+        connection.commit()
+        with self._updates_lock:
+            self._updates += 1
+            evict = self._updates % self.eviction_interval == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """Deletes the least recently used entries beyond `max_entries`.
+
+        Returns:
+            int: The number of entries deleted.
+        """
+        connection = self._connection()
+        excess = connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - self.max_entries
+        if excess <= 0:
+            return 0
+        connection.execute(
+            "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)", (excess,)
+        )
+        connection.commit()
+        return excess
+
+    def clear(self, **kwargs) -> None:
+        """Deletes every cached response."""
+        connection = self._connection()
+        connection.execute("DELETE FROM llm_cache")
+        connection.commit()
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+def get_llm_cache() -> SQLiteLLMCache:
+    """Returns the LLM response cache of `config.llm_cache_path`, whose file is opened by the first cached call."""
+    global _llm_cache
+    if _llm_cache is None:
+        with _llm_cache_lock:
+            if _llm_cache is None:
+                _llm_cache = SQLiteLLMCache(config.llm_cache_path, config.llm_cache_max_entries)
+    return _llm_cache
@@ -0,0 +1,191 @@
+"""
+Admission control and priority queueing of the LLM calls.
+
+The CPU-only Ollama backend is the scarcest resource of the search: under a burst, every
+request launches its 4-5 LLM calls at once and the latency collapses for everyone. This
+module bounds the LLM calls running on the backend (`config.llm_max_concurrency`); the other
+calls wait in a priority queue, served in order of their priority class, then of arrival:
+
+1. "generation": the response of an interactive search, the last stage before the answer.
+2. "query_understanding": the pre-retrieval and personalization stages of the searches.
+3. "background": the preference precomputation (see preference_worker.py) and the catalog
+   indexing, which also run at most `config.llm_background_max_concurrency` calls at once.
+
+The class of a stage is set in `config.llm_stage_priorities`. The calls of the
+`background_calls()` blocks, and the background calls of `invoke_with_budget`, are in the
+background class. A queued call with a latency budget gives up when its budget is exceeded,
+so it never occupies the backend for a stage that already degraded (see stage_budget.py).
+
+The time each call waited in the queue is recorded per class (`queue_summary()`). When more
+than `config.llm_shed_queue_depth` interactive calls are waiting, the new searches shed load
+early: they skip the LLM stages and answer with the retrieved products only (see pipeline.py
+and search_service.py).
+
+The limit applies per process: with pre-forked workers (see search_workers.py), divide the
+capacity of the backend by the number of workers.
+
+Example Usage:
+    ```python
+    with llm_slot("response"):
+        response = llm.invoke(messages)
+    print(queue_summary())
+    ```
+"""
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import heapq
+import itertools
+import os
+import threading
+import time
+import numpy as np
+import config
+
+PRIORITY_GENERATION = 0
+PRIORITY_QUERY_UNDERSTANDING = 1
+PRIORITY_BACKGROUND = 2
+
+_priority_classes = {"generation": PRIORITY_GENERATION, "query_understanding": PRIORITY_QUERY_UNDERSTANDING, "background": PRIORITY_BACKGROUND}
+_class_names = {priority: name for name, priority in _priority_classes.items()}
+
+# Queue times kept per class for the summary
+_QUEUE_TIME_WINDOW = 1024
+
+_condition = threading.Condition()
+_waiting = []  # Heap of the (priority, sequence) of the queued calls
+_sequence = itertools.count()
+_running = Counter()  # Running calls by priority
+_queue_times = {priority: deque(maxlen=_QUEUE_TIME_WINDOW) for priority in _class_names}
+_shed_requests = 0
+_local = threading.local()
+
+def _reset_after_fork():
+    global _condition, _waiting, _running, _shed_requests
+    # The calls queued or running in the parent are not running in the child
+    _condition = threading.Condition()
+    _waiting = []
+    _running = Counter()
+    _shed_requests = 0
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+@contextmanager
+def background_calls():
+    """Runs the LLM calls of the current thread in the background class, without latency budget."""
+    previous = getattr(_local, "background", False)
+    _local.background = True
+    try:
+        yield
+    finally:
+        _local.background = previous
+
+def stage_priority(stage: str, background: bool = False) -> int:
+    """Returns the priority of the LLM calls of a stage.
+
+    Args:
+        stage (str): The stage name, a key of `config.llm_stage_priorities`.
+        background (bool, optional): Whether the call is a background call. Defaults to False.
+
+    Returns:
+        int: PRIORITY_GENERATION, PRIORITY_QUERY_UNDERSTANDING or PRIORITY_BACKGROUND.
+    """
+    if background or getattr(_local, "background", False):
+        return PRIORITY_BACKGROUND
+    return _priority_classes[config.llm_stage_priorities.get(stage, "query_understanding")]
+
+def _has_capacity(priority: int) -> bool:
+    if sum(_running.values()) >= config.llm_max_concurrency:
+        return False
+    return priority != PRIORITY_BACKGROUND or _running[PRIORITY_BACKGROUND] < config.llm_background_max_concurrency
+
+def acquire(priority: int, timeout: float | None = None) -> bool:
+    """Waits for a slot on the LLM backend, after the queued calls of higher or equal priority.
+
+    Args:
+        priority (int): The priority of the call (see `stage_priority`).
+        timeout (float, optional): The maximum number of seconds to wait. Defaults to no limit.
+
+    Returns:
+        bool: Whether the call was admitted. An admitted call must call `release`.
+    """
+    entry = (priority, next(_sequence))
+    start = time.monotonic()
+    deadline = start + timeout if timeout is not None else None
+    with _condition:
+        heapq.heappush(_waiting, entry)
+        while _waiting[0] != entry or not _has_capacity(priority):
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                _waiting.remove(entry)
+                heapq.heapify(_waiting)
+                _condition.notify_all()
+                return False
+            _condition.wait(remaining)
+        heapq.heappop(_waiting)
+        _running[priority] += 1
+        _queue_times[priority].append(time.monotonic() - start)
+        # The next queued call may fit in the remaining capacity
+        _condition.notify_all()
+    return True
+
+def release(priority: int):
+    """Frees the slot of an admitted call."""
+    with _condition:
+        _running[priority] -= 1
+        _condition.notify_all()
+
+@contextmanager
+def llm_slot(stage: str):
+    """Holds a slot on the LLM backend for a call of a stage, waiting for it in the queue."""
+    priority = stage_priority(stage)
+    acquire(priority)
+    try:
+        yield
+    finally:
+        release(priority)
+
+def should_shed() -> bool:
+    """Whether the queue of interactive LLM calls is deep enough for new searches to skip the LLM stages."""
+    with _condition:
+        waiting = sum(1 for priority, _ in _waiting if priority != PRIORITY_BACKGROUND)
+    return waiting > config.llm_shed_queue_depth
+
+def record_shed():
+    """Counts a search answered without its LLM stages."""
+    global _shed_requests
+    with _condition:
+        _shed_requests += 1
+
+def queue_summary() -> dict:
+    """Returns the state of the LLM queue and the queue times of each priority class.
+
+    Returns:
+        dict: The running and waiting calls per class, for each class the number of calls
+            admitted and their mean, 95th percentile and maximum queue time (ms) over the last
+            admitted calls, and the number of searches that shed their LLM stages.
+    """
+    with _condition:
+        running = {_class_names[priority]: _running[priority] for priority in _class_names}
+        waiting = Counter(_class_names[priority] for priority, _ in _waiting)
+        queue_times = {priority: np.array(times) * 1000 for priority, times in _queue_times.items()}
+        shed_requests = _shed_requests
+    summary = {"running": running, "waiting": {name: waiting[name] for name in _priority_classes}, "queue_ms": {}, "shed_requests": shed_requests}
+    for priority, times in queue_times.items():
+        if times.size:
+            summary["queue_ms"][_class_names[priority]] = {
+                "calls": int(times.size),
+                "mean_ms": float(times.mean()),
+                "p95_ms": float(np.percentile(times, 95)),
+                "max_ms": float(times.max()),
+            }
+    return summary
+
+def reset_queue_summary():
+    """Clears the recorded queue times and shed searches."""
+    global _shed_requests
+    with _condition:
+        for times in _queue_times.values():
+            times.clear()
+        _shed_requests = 0
@@ -0,0 +1,301 @@
+"""
+Configurable stage graph for the modular RAG pipeline.
+
+Each stage declares the values it reads and produces one value named after the stage:
+
+    query, tenant ──┬─> product_metadata ──┐
+                    └─> transformed_query ─┴─> product_query ───┐
+    customer_id ─┬────> customer_affinity ──────────────────────┴─> candidates ─┐
+                 ├──────────────────────────────────────────────────────────────┴─> search_results ─┐
+                 └────> customer_preferences ─────────────────────────────────────────────────────┴─> response
+
+`product_metadata` is the raw query with the extracted filters set as ProductQuery fields.
+The retrieval and ranking stages also read `max_results`, the number of search results
+(4 by default). A value given as input is used as is, and the stage producing it is not run.
+
+The scheduler runs every stage as soon as its inputs are available, so independent stages
+(metadata extraction, query transformation and personalization) run in parallel.
+`iter_pipeline` yields each stage output as soon as it is produced, for callers reporting
+progress, and `run_pipeline` returns all of them. A stage
+disabled in `config` is short-circuited to its fallback value without running, and only the
+stages needed for the requested outputs are run. The outputs of deterministic stages are
+memoized by input for `config.pipeline_memoize_ttl` seconds, except the outputs degraded to
+a fallback by a slow or failed LLM call (see stage_budget.py); the memoized candidates are
+cleared when the catalog changes in the process (see `product_retriever.notify_catalog_change`),
+and expire with the TTL when another process re-indexes it. When the LLM queue is deep (see llm_scheduler.py), the stages calling
+the LLM are short-circuited to their fallback too, down to a retrieval-only response. The
+candidates are retrieved with the customer affinity vector when
+`config.enable_customer_affinity` is set (see customer_affinity.py), and re-ranked for the
+customer when `config.enable_reranking` is set (see reranking.py).
+
+The graph can be changed without code edits: the `enable_*` flags toggle the optional
+stages, and `config.pipeline_stage_functions` swaps a stage implementation for another
+function given as "module:function". Both can be loaded from a file or the environment
+(see `config.load_config`).
+
+Example Usage:
+    ```python
+    outputs = run_pipeline({"query": "Elegant navy evening gown below 250", "customer_id": 3})
+    print(outputs["response"])
+    ```
+"""
+
+from collections import OrderedDict
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pre_retrieval_metadata import extract_metadata
+from pre_retrieval_query_transformation import remove_price_from_query
+from product_retriever import Candidates, ProductQuery, on_catalog_change, retrieve_candidates
+from purchase_history import extract_fashion_preferences
+from reranking import candidate_count, rank_candidates
+from customer_affinity import CustomerAffinity, get_customer_affinity
+from response_generation import generate_response, retrieval_only_response
+from llm_scheduler import record_shed, should_shed
+from stage_budget import track_degradation
+import importlib
+import threading
+import time
+import config
+
+class Stage:
+    """A pipeline stage producing one value from the values it reads.
+
+    Attributes:
+        name (str): The stage name, which is also the name of the value it produces.
+        function (callable): The stage implementation, called with the input values in order.
+        inputs (tuple): The names of the values the stage reads.
+        enabled_flag (str | None): The `config` flag enabling the stage, or None if always enabled.
+        fallback (callable | None): Called with the input values to produce the output of a disabled stage.
+        memoize (bool): Whether the outputs are memoized by input.
+        uses_llm (bool): Whether the stage calls the LLM, and is short-circuited to its
+            fallback when the LLM backend sheds load.
+    """
+
+    def __init__(self, name: str, function, inputs: tuple, enabled_flag: str | None = None, fallback=None, memoize: bool = False, uses_llm: bool = False):
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.enabled_flag = enabled_flag
+        self.fallback = fallback
+        self.memoize = memoize
+        self.uses_llm = uses_llm
+
+    def is_enabled(self, shed: bool = False) -> bool:
+        """Returns whether the stage is enabled in the configuration, and not shed with the LLM stages."""
+        if shed and self.uses_llm:
+            return False
+        return self.enabled_flag is None or bool(getattr(config, self.enabled_flag))
+
+    def __repr__(self) -> str:
+        return f"Stage(name={self.name!r}, inputs={self.inputs!r})"
+
+def _extract_product_metadata(query: str, tenant: str | None) -> ProductQuery:
+    return extract_metadata(ProductQuery(query, tenant=tenant))
+
+def _transform_query(query: str) -> str:
+    return remove_price_from_query(ProductQuery(query)).query
+
+def _build_product_query(transformed_query: str, product_metadata: ProductQuery, tenant: str | None) -> ProductQuery:
+    return product_metadata.replace(query=transformed_query, tenant=tenant)
+
+def _retrieve_candidates(product_query: ProductQuery, customer_affinity: CustomerAffinity | None, max_results: int) -> Candidates:
+    affinity_vector = customer_affinity.vector if customer_affinity is not None else None
+    return retrieve_candidates(product_query, candidate_count(max_results), affinity_vector)
+
+def _rank_search_results(product_query: ProductQuery, candidates: Candidates, customer_id, max_results: int) -> list:
+    return rank_candidates(product_query, candidates, customer_id, max_results)
+
+def _generate_response(product_query: ProductQuery, search_results: list, customer_preferences: str | None) -> str:
+    return generate_response(product_query, "\n\n".join(search_results), customer_preferences)
+
+def _retrieval_only_response(product_query: ProductQuery, search_results: list, customer_preferences: str | None) -> str:
+    return retrieval_only_response(product_query, "\n\n".join(search_results))
+
+# The default stage graph of the product search
+default_stages = [
+    Stage("product_metadata", _extract_product_metadata, ("query", "tenant"),
+          enabled_flag="enable_metadata_extraction", fallback=lambda query, tenant: ProductQuery(query, tenant=tenant), memoize=True, uses_llm=True),
+    Stage("transformed_query", _transform_query, ("query",),
+          enabled_flag="enable_query_transformation", fallback=lambda query: query, memoize=True, uses_llm=True),
+    Stage("product_query", _build_product_query, ("transformed_query", "product_metadata", "tenant")),
+    Stage("customer_affinity", get_customer_affinity, ("customer_id",),
+          enabled_flag="enable_customer_affinity", fallback=lambda customer_id: None),
+    Stage("candidates", _retrieve_candidates, ("product_query", "customer_affinity", "max_results"), memoize=True),
+    Stage("search_results", _rank_search_results, ("product_query", "candidates", "customer_id", "max_results")),
+    Stage("customer_preferences", extract_fashion_preferences, ("customer_id",),
+          enabled_flag="enable_purchase_history", fallback=lambda customer_id: None, uses_llm=True),
+    Stage("response", _generate_response, ("product_query", "search_results", "customer_preferences"),
+          fallback=_retrieval_only_response, uses_llm=True),
+]
+
+# The initial values a pipeline run defaults to
+_DEFAULT_INPUTS = {"tenant": None, "max_results": 4}
+
+_executor = ThreadPoolExecutor(max_workers=config.pipeline_max_workers, thread_name_prefix="pipeline-stage")
+
+_memo = OrderedDict()  # Key -> (output, memoization time)
+_memo_lock = threading.Lock()
+
+def _freeze(value):
+    """Converts a stage input into a hashable memoization key."""
+    if isinstance(value, ProductQuery):
+        return value  # Immutable and hashable
+    if isinstance(value, CustomerAffinity):
+        return ("CustomerAffinity", value.customer_id)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+def _resolve_function(stage: Stage):
+    """Returns the configured implementation of a stage."""
+    spec = config.pipeline_stage_functions.get(stage.name)
+    if spec is None:
+        return stage.function
+    module_name, _, function_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+def _run_stage(stage: Stage, function, args: tuple):
+    """Runs a stage, serving its output from the memoization cache when possible."""
+    if not stage.memoize:
+        return function(*args)
+
+    key = (stage.name, function, _freeze(args))
+    with _memo_lock:
+        entry = _memo.get(key)
+        if entry is not None:
+            output, memoized_at = entry
+            if time.monotonic() - memoized_at < config.pipeline_memoize_ttl:
+                _memo.move_to_end(key)
+                return output
+            del _memo[key]
+
+    with track_degradation() as degradation:
+        output = function(*args)
+    if degradation["degraded"]:
+        # A fallback output would keep the query degraded after the backend recovers
+        return output
+
+    with _memo_lock:
+        _memo[key] = (output, time.monotonic())
+        while len(_memo) > config.pipeline_memoize_size:
+            _memo.popitem(last=False)
+    return output
+
+def _required_stages(stages: list, outputs: tuple, given) -> list:
+    """Returns the stages needed to produce the requested outputs, in declaration order."""
+    stages_by_name = {stage.name: stage for stage in stages}
+    required = set()
+    pending = list(outputs)
+    while pending:
+        name = pending.pop()
+        stage = stages_by_name.get(name)
+        # A value given as input is not produced again
+        if stage is None or name in required or name in given:
+            continue
+        required.add(name)
+        # The fallback of a shed stage reads the same inputs
+        if stage.is_enabled():
+            pending.extend(stage.inputs)
+    return [stage for stage in stages if stage.name in required]
+
+def iter_pipeline(inputs: dict, stages: list | None = None, outputs: tuple = ("response",), shed: bool | None = None) -> Iterator[tuple]:
+    """Runs the stage graph, yielding the output of each stage as soon as it is produced.
+
+    Independent stages run in parallel. Closing the iterator stops the pipeline: the stages
+    already running complete, but no further stage is started.
+
+    Args:
+        inputs (dict): The initial values, e.g. `query` and `customer_id`. `tenant` defaults
+            to None, for the default tenant (see tenants.py), and `max_results` to 4. A stage
+            whose value is given is not run.
+        stages (list, optional): The stage graph. Defaults to `default_stages`.
+        outputs (tuple, optional): The values to produce. Defaults to ("response",).
+        shed (bool, optional): Whether to short-circuit the LLM stages to their fallback.
+            Defaults to whether the LLM queue is deep (see llm_scheduler.py).
+
+    Yields:
+        tuple: The name and value of `degraded` first, True if the LLM stages are shed, then
+            the name and output of every stage that runs, in completion order.
+
+    Raises:
+        ValueError: If a stage reads a value that no stage produces.
+    """
+    if shed is None:
+        shed = should_shed()
+        if shed:
+            record_shed()
+    stages = _required_stages(stages if stages is not None else default_stages, outputs, inputs)
+    values = {**_DEFAULT_INPUTS, **inputs, "degraded": shed}
+    waiting = list(stages)
+    running = {}
+    yield "degraded", shed
+
+    while waiting or running:
+        # Short-circuit disabled stages and start every stage whose inputs are ready
+        pending_names = {stage.name for stage in waiting} | {stage.name for stage in running.values()}
+        for stage in list(waiting):
+            if not stage.is_enabled(shed):
+                if not any(name in pending_names for name in stage.inputs):
+                    waiting.remove(stage)
+                    args = tuple(values.get(name) for name in stage.inputs)
+                    values[stage.name] = stage.fallback(*args) if stage.fallback is not None else None
+                    yield stage.name, values[stage.name]
+            elif all(name in values for name in stage.inputs):
+                waiting.remove(stage)
+                args = tuple(values[name] for name in stage.inputs)
+                running[_executor.submit(_run_stage, stage, _resolve_function(stage), args)] = stage
+
+        if not running:
+            if waiting:
+                waiting_names = {stage.name for stage in waiting}
+                missing = {name for stage in waiting for name in stage.inputs if name not in values and name not in waiting_names}
+                raise ValueError(f"No stage produces the values: {', '.join(sorted(missing))}")
+            break
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage = running.pop(future)
+            values[stage.name] = future.result()
+            yield stage.name, values[stage.name]
+
+def run_pipeline(inputs: dict, stages: list | None = None, outputs: tuple = ("response",), shed: bool | None = None) -> dict:
+    """Runs the stage graph, executing independent stages in parallel.
+
+    Args:
+        inputs (dict): The initial values, e.g. `query` and `customer_id`. `tenant` defaults
+            to None, for the default tenant (see tenants.py), and `max_results` to 4. A stage
+            whose value is given is not run.
+        stages (list, optional): The stage graph. Defaults to `default_stages`.
+        outputs (tuple, optional): The values to produce. Defaults to ("response",).
+        shed (bool, optional): Whether to short-circuit the LLM stages to their fallback.
+            Defaults to whether the LLM queue is deep (see llm_scheduler.py).
+
+    Returns:
+        dict: The initial values and the outputs of every stage that ran. `degraded` is True
+            if the LLM stages were shed.
+
+    Raises:
+        ValueError: If a stage reads a value that no stage produces.
+    """
+    values = {**_DEFAULT_INPUTS, **inputs}
+    values.update(iter_pipeline(inputs, stages, outputs, shed))
+    return values
+
+def clear_memo(stage: str | None = None):
+    """Clears the memoized stage outputs.
+
+    Args:
+        stage (str, optional): The stage whose outputs are cleared. Defaults to every stage.
+    """
+    with _memo_lock:
+        if stage is None:
+            _memo.clear()
+        else:
+            for key in [key for key in _memo if key[0] == stage]:
+                del _memo[key]
+
+# The candidates retrieved from a previous catalog are stale after a re-index or a snapshot swap
+on_catalog_change(lambda: clear_memo("candidates"))
+
@@ -22,13 +22,16 @@ Example Usage:
     ```
 """
 
-from product_category import get_product_category 
+from product_category import get_product_category, is_classification_error
 from decimal import Decimal
 from pydantic import BaseModel
 from typing import Literal
 from langchain.output_parsers import PydanticOutputParser
 from langchain_ollama import ChatOllama
 from product_retriever import ProductQuery
+from stage_budget import invoke_with_budget, hedge_llm
+from price_parser import extract_price_amounts
+from prompt_templates import PromptTemplate, stage_llm_kwargs, structured_output
 import re
 
 # Define the response model for structured output
@@ -36,7 +39,8 @@ class PriceResponse(BaseModel):
     price: Decimal | None  # The extracted price as a Decimal or None if not found
 
 # Llama3.2 model 
-llm = ChatOllama(model="llama3.2", temperature=0, num_ctx = 24576)
+llm = ChatOllama(**stage_llm_kwargs("comparison_operator", model="llama3.2", temperature=0))
+llm_hedge = hedge_llm(**stage_llm_kwargs("comparison_operator", model="llama3.2", temperature=0))
 
 def extract_price_amount(query: str) -> Decimal | None:
     """Extracts the price amount from a query string.
@@ -47,8 +51,12 @@ def extract_price_amount(query: str) -> Decimal | None:
     Returns:
         Decimal | None: The extracted price amount as a Decimal, or None if no price is found.
     """
-    values = re.findall(r"\d+\.?\d*", query) # Supports integers and decimals
-    return Decimal(max(values)) if len(values) != 0 else None
+    values = extract_price_amounts(query) # Supports thousands separators, decimals and "k" suffixes
+    if len(values) == 0:
+        return None
+    amount = max(values)
+    # Whole amounts keep the integer format of the metadata, e.g. "250" rather than "250.0"
+    return Decimal(int(amount)) if amount == int(amount) else Decimal(str(amount))
 
 
 # Define the response model with a restricted set of valid operators
@@ -56,7 +64,47 @@ class ComparisonOperatorResponse(BaseModel):
     operator: Literal["$eq", "$ne", "$gt", "$gte", "$lt", "$lte"] | None
 
 # Create an instance of the structured output parser
-llm_operator_extractor = llm.with_structured_output(ComparisonOperatorResponse)
+llm_operator_extractor = structured_output("comparison_operator", llm, ComparisonOperatorResponse)
+llm_operator_extractor_hedge = structured_output("comparison_operator", llm_hedge, ComparisonOperatorResponse)
+
+# Static system prompt first, the query last, for prompt-prefix reuse
+comparison_operator_prompt = PromptTemplate(
+    system=(
+        "You are an AI assistant that extracts number comparison operators from text. "
+        "Identify the operator in the given query and map it to one of the following: "
+        "'$eq' (equal to), '$ne' (not equal to), '$gt' (greater than), "
+        "'$gte' (greater than or equal to), '$lt' (less than), '$lte' (less than or equal to). "
+        "Respond with only the operator. "
+        "If no comparison is found, return null."
+    ),
+    user=["Query: {query}"]
+)
+
+# Keywords mapped to comparison operators, most specific first
+comparison_operator_patterns = [
+    (r"\b(no more than|not more than|at most|up to|maximum|max)\b", "$lte"),
+    (r"\b(no less than|not less than|at least|minimum|min)\b", "$gte"),
+    (r"\b(under|below|less than|lower than|cheaper than|beneath)\b|<", "$lt"),
+    (r"\b(over|above|more than|greater than|higher than|more expensive than)\b|>", "$gt"),
+    (r"\b(not|except|other than)\b", "$ne"),
+    (r"\b(exactly|equal to|for)\b|=", "$eq"),
+]
+
+def extract_comparison_operator_regex(query: str) -> str | None:
+    """Extracts a number comparison operator from a query string using keywords only.
+
+    This is the fallback of `extract_comparison_operator` when the LLM exceeds its latency budget.
+
+    Args:
+        query (str): The input query string containing a potential comparison operator.
+
+    Returns:
+        str | None: The mapped comparison operator or None if not found.
+    """
+    for pattern, operator in comparison_operator_patterns:
+        if re.search(pattern, query, re.IGNORECASE):
+            return operator
+    return None
 
 def extract_comparison_operator(query: str) -> str | None:
     """Extracts a number comparison operator from a query string using Llama3.2.
@@ -67,20 +115,14 @@ def extract_comparison_operator(query: str) -> str | None:
     Returns:
         str | None: The mapped comparison operator ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte') or None if not found.
     """
-    system_instruction = (
-        "You are an AI assistant that extracts number comparison operators from text. "
-        "Identify the operator in the given query and map it to one of the following: "
-        "'$eq' (equal to), '$ne' (not equal to), '$gt' (greater than), "
-        "'$gte' (greater than or equal to), '$lt' (less than), '$lte' (less than or equal to). "
-        "Respond with only the operator. "
-        "If no comparison is found, return null."
-    )
-
     try:
-        response = llm_operator_extractor.invoke([
-            {"role": "system", "content": system_instruction},
-            {"role": "user", "content": f"Query: {query}"}
-        ])
+        response = invoke_with_budget(
+            "comparison_operator",
+            llm_operator_extractor,
+            comparison_operator_prompt.messages(query=query),
+            hedge=llm_operator_extractor_hedge,
+            fallback=lambda: ComparisonOperatorResponse(operator=extract_comparison_operator_regex(query))
+        )
         
         return response.operator if response is not None else None
 
@@ -91,7 +133,7 @@ def extract_comparison_operator(query: str) -> str | None:
 def extract_price_comparison(product_query: ProductQuery) -> ProductQuery:
     """Extracts price and comparison operator from a product search query.
 
-    This function updates the `metadata` of a `ProductQuery` instance with:
+    This function returns a copy of a `ProductQuery` instance with:
     - `price_amount`: Extracted price as a string.
     - `comparison_operator`: Structured comparison operator.
 
@@ -104,9 +146,7 @@ def extract_price_comparison(product_query: ProductQuery) -> ProductQuery:
     price_amount = extract_price_amount(product_query.query)
     comparison_operator = extract_comparison_operator(product_query.query)
     if price_amount is not None and comparison_operator is not None:
-        product_query.metadata['price_amount'] = str(price_amount)
-        product_query.metadata['comparison_operator'] = comparison_operator
-        return product_query
+        return product_query.replace(price_amount=str(price_amount), comparison_operator=comparison_operator)
     else:
         return product_query # Return the original query
 
@@ -114,7 +154,7 @@ def extract_product_category(product_query: ProductQuery) -> ProductQuery:
     """Extracts the product category from a query.
 
     This function classifies a product query into a predefined fashion category 
-    and updates the `metadata` of the `ProductQuery` instance.
+    and returns a copy of the `ProductQuery` instance with this category.
 
     Args:
         product_query (ProductQuery): The product query instance.
@@ -122,9 +162,13 @@ def extract_product_category(product_query: ProductQuery) -> ProductQuery:
     Returns:
         ProductQuery: The updated product query with extracted category metadata.
     """
-    product_category = get_product_category(product_query.query)
+    product_category = get_product_category(product_query.query, product_query.tenant)
+    if is_classification_error(product_category):
+        # e.g. a model that is not pulled: search without category filter rather than with the error message
+        print(f"Error extracting product category: {product_category}")
+        return product_query
     if product_category:
-        product_query.metadata['category'] = product_category
+        return product_query.replace(category=product_category)
     return product_query
 
 def extract_metadata(product_query: ProductQuery) -> ProductQuery:
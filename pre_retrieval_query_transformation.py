@@ -1,8 +1,23 @@
 from langchain_ollama import ChatOllama
 from product_retriever import ProductQuery
+from stage_budget import invoke_with_budget, hedge_llm
+from prompt_templates import PromptTemplate, stage_llm_kwargs
 
 # Create an instance of the llm model
-llm = ChatOllama(model="llama3.2", temperature=0, num_ctx = 24576)
+llm = ChatOllama(**stage_llm_kwargs("query_transformation", model="llama3.2", temperature=0))
+llm_hedge = hedge_llm(**stage_llm_kwargs("query_transformation", model="llama3.2", temperature=0))
+
+# Static system prompt first, the query last, for prompt-prefix reuse
+query_transformation_prompt = PromptTemplate(
+    system=(
+        "You are an AI that processes product search queries. "
+        "Your task is to remove any price-related information from the given query while keeping all other details intact. "
+        "Do not add new words or modify the meaning. "
+        "Example: 'Find jackets under 200 euros' → 'Find jackets'. "
+        "Only return the cleaned query."
+    ),
+    user=["Query: {query}"]
+)
 
 def remove_price_from_query(product_query: ProductQuery) -> ProductQuery:
     """Removes price-related information from a product search query using Llama3.2.
@@ -13,21 +28,16 @@ def remove_price_from_query(product_query: ProductQuery) -> ProductQuery:
     Returns:
         ProductQuery: The query with price-related information removed.
     """
-    system_instruction = (
-        "You are an AI that processes product search queries. "
-        "Your task is to remove any price-related information from the given query while keeping all other details intact. "
-        "Do not add new words or modify the meaning. "
-        "Example: 'Find jackets under 200 euros' → 'Find jackets'. "
-        "Only return the cleaned query."
-    )
-
     try:
-        response = llm.invoke([
-            {"role": "system", "content": system_instruction},
-            {"role": "user", "content": f"Query: {product_query.query}"}
-        ])
-        product_query.query = response.content
-        return product_query
+        response = invoke_with_budget(
+            "query_transformation",
+            llm,
+            query_transformation_prompt.messages(query=product_query.query),
+            hedge=llm_hedge
+        )
+        if response is None:
+            return product_query  # Keep the original query when the transformation is too slow
+        return product_query.replace(query=response.content)
 
     except Exception as e:
         print(f"Error processing query: {e}")
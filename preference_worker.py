@@ -0,0 +1,200 @@
+"""
+Background precomputation of the customer preferences.
+
+The first search of a session pays the full cost of `extract_fashion_preferences`, the
+slowest LLM call of the pipeline. This module extracts the preferences of the customers
+likely to search soon, ahead of their searches, and keeps them in the preferences cache of
+purchase_history.py, where the searches find them:
+
+- Customers are queued by priority: first the customers who just purchased (their previous
+  preferences are stale), then the recently active ones (e.g. a session start, or browsing
+  the result pages). A customer queued twice keeps the highest priority, and when the queue
+  is full (`config.preference_precompute_queue_size`) the most recent customer of the lowest
+  priority is dropped, or the new customer is rejected if no queued customer has a lower priority.
+- A single worker thread extracts the preferences of one customer at a time, and only uses
+  the idle capacity of the Ollama backend: it starts an extraction when no interactive LLM
+  call has run for `config.preference_precompute_idle` seconds (see stage_budget.py), and at
+  most `config.preference_precompute_rate` extractions per second.
+- The customers whose cached preferences are still fresh are skipped without any LLM call.
+
+The precomputation is disabled by default (`config.enable_preference_precompute`). A background
+extraction already running is not interrupted by an interactive request, so the rate should
+leave the backend idle most of the time. The cache is per process: the worker
+runs in the process serving the searches (see search_service.py).
+
+Dependencies:
+    - purchase_history.py (extract_fashion_preferences, cached_fashion_preferences)
+    - stage_budget.py (seconds_since_interactive_call)
+
+Example Usage:
+    ```python
+    notify_purchase(3)
+    notify_activity(5)
+    ```
+"""
+
+from purchase_history import cached_fashion_preferences, extract_fashion_preferences
+from stage_budget import seconds_since_interactive_call
+from collections import OrderedDict
+import heapq
+import itertools
+import threading
+import time
+import config
+
+PRIORITY_PURCHASE = 0  # A customer who just purchased
+PRIORITY_ACTIVE = 1  # A recently active customer
+
+class PreferenceWorker:
+    """A background thread extracting the preferences of the queued customers on the idle backend capacity."""
+
+    def __init__(self, rate: float | None = None, idle_seconds: float | None = None, max_queued: int | None = None):
+        """Creates a stopped worker.
+
+        Args:
+            rate (float, optional): The maximum number of extractions per second.
+                Defaults to `config.preference_precompute_rate`.
+            idle_seconds (float, optional): The seconds without interactive LLM calls before an
+                extraction starts. Defaults to `config.preference_precompute_idle`.
+            max_queued (int, optional): The maximum number of queued customers.
+                Defaults to `config.preference_precompute_queue_size`.
+        """
+        self.rate = rate if rate is not None else config.preference_precompute_rate
+        self.idle_seconds = idle_seconds if idle_seconds is not None else config.preference_precompute_idle
+        self.max_queued = max_queued if max_queued is not None else config.preference_precompute_queue_size
+        self._heap = []
+        self._queued = {}  # Customer id -> (priority, sequence) of its current heap entry
+        self._by_priority = {}  # Priority -> queued customer ids, in arrival order
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._next_start = 0.0
+
+    def submit(self, customer_id, priority: int = PRIORITY_ACTIVE) -> bool:
+        """Queues a customer for the extraction of their preferences.
+
+        Args:
+            customer_id (int): The customer id.
+            priority (int, optional): PRIORITY_PURCHASE or PRIORITY_ACTIVE. Defaults to PRIORITY_ACTIVE.
+
+        Returns:
+            bool: Whether the customer is queued, False if dropped because the queue is full.
+        """
+        with self._condition:
+            queued = self._queued.get(customer_id)
+            if queued is not None and queued[0] <= priority:
+                return True
+            if queued is None and len(self._queued) >= self.max_queued:
+                lowest = max(self._by_priority, default=None)
+                if lowest is None or priority >= lowest:
+                    return False  # No queued customer has a lower priority
+                # Drop the most recent customer of the lowest priority, its heap entry becomes stale
+                self._remove(next(reversed(self._by_priority[lowest])))
+            if queued is not None:
+                self._remove(customer_id)
+            entry = (priority, next(self._sequence))
+            self._queued[customer_id] = entry
+            self._by_priority.setdefault(priority, OrderedDict())[customer_id] = None
+            heapq.heappush(self._heap, (*entry, customer_id))
+            if len(self._heap) > 2 * max(self.max_queued, 1):
+                # Compact the stale entries of the dropped and re-prioritized customers
+                self._heap = [(*entry, queued_id) for queued_id, entry in self._queued.items()]
+                heapq.heapify(self._heap)
+            self._condition.notify()
+            return True
+
+    def _remove(self, customer_id):
+        """Removes a queued customer, leaving its heap entry stale. Called with the condition held."""
+        priority, _ = self._queued.pop(customer_id)
+        customers = self._by_priority[priority]
+        del customers[customer_id]
+        if not customers:
+            del self._by_priority[priority]
+
+    def __len__(self) -> int:
+        return len(self._queued)
+
+    def _pop(self):
+        """Returns the queued customer of the highest priority, skipping the stale heap entries."""
+        with self._condition:
+            while self._heap:
+                priority, sequence, customer_id = heapq.heappop(self._heap)
+                if self._queued.get(customer_id) == (priority, sequence):
+                    self._remove(customer_id)
+                    return customer_id
+            return None
+
+    def _wait_for_idle_capacity(self) -> bool:
+        """Waits until the rate limit and the idle backend allow an extraction, returning False when stopped."""
+        while not self._stop.is_set():
+            delay = max(self._next_start - time.monotonic(), self.idle_seconds - seconds_since_interactive_call())
+            if delay <= 0:
+                return True
+            # Interactive calls may start meanwhile, so the backend idleness is checked again
+            self._stop.wait(min(delay, 0.5))
+        return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._condition:
+                while not self._queued and not self._stop.is_set():
+                    self._condition.wait()
+            if not self._wait_for_idle_capacity():
+                return
+            customer_id = self._pop()
+            if customer_id is None or cached_fashion_preferences(customer_id) is not None:
+                continue
+            self._next_start = time.monotonic() + (1 / self.rate if self.rate > 0 else 0)
+            try:
+                extract_fashion_preferences(customer_id, background=True)
+            except Exception as e:
+                print(f"Error precomputing preferences of customer {customer_id}: {e}")
+
+    def start(self):
+        """Starts the worker thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="preference-worker", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        """Stops the worker thread after its current extraction."""
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+def get_preference_worker() -> PreferenceWorker:
+    """Returns the preference worker of the process, started on first use."""
+    global _worker
+    if _worker is None:
+        with _worker_lock:
+            if _worker is None:
+                _worker = PreferenceWorker()
+                _worker.start()
+    return _worker
+
+def notify_purchase(customer_id) -> bool:
+    """Queues a customer who just purchased, if the precomputation is enabled.
+
+    Returns:
+        bool: Whether the customer is queued.
+    """
+    if not config.enable_preference_precompute or not config.enable_purchase_history or customer_id is None:
+        return False
+    return get_preference_worker().submit(customer_id, PRIORITY_PURCHASE)
+
+def notify_activity(customer_id) -> bool:
+    """Queues a recently active customer, if the precomputation is enabled.
+
+    Returns:
+        bool: Whether the customer is queued.
+    """
+    if not config.enable_preference_precompute or not config.enable_purchase_history or customer_id is None:
+        return False
+    return get_preference_worker().submit(customer_id, PRIORITY_ACTIVE)
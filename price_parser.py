@@ -0,0 +1,132 @@
+"""
+Locale-independent price parsing for catalog prices and query prices.
+
+The functions of this module are pure: they do not depend on the process locale, so they
+are safe to use from parallel ingestion workers, and their results are cached by input.
+They handle:
+
+- Currency symbols and codes: "€290,00", "290 EUR", "$1,250.50", "300 euros".
+- Thousands and decimal separators in both conventions: "1.250,00" and "1,250.00",
+  as well as apostrophes and (non-breaking) spaces as thousands separators.
+- "k" suffixes: "1.5k" is 1500.
+- Several amounts in a displayed price, e.g. a former and a current price ("290€ 250€"): the
+  first complete amount is parsed. Whitespace only groups thousands in the "1 250" shape.
+
+Functions:
+    parse_price(text: str) -> float | None:
+        Parses a displayed price, e.g. a catalog price, into a number.
+
+    parse_prices(texts: Iterable[str]) -> list:
+        Parses many displayed prices at once.
+
+    extract_price_amounts(query: str) -> list:
+        Extracts every price amount mentioned in a free-text query.
+
+Example Usage:
+    ```python
+    parse_price("€1.250,00")                           # 1250.0
+    parse_price("290€ 250€")                           # 290.0
+    extract_price_amounts("dresses between 300 and 1k")  # [300.0, 1000.0]
+    ```
+"""
+
+from functools import lru_cache
+from typing import Iterable
+import re
+
+# Currency symbols and codes removed before parsing a price
+_CURRENCY = re.compile(r"[€$£¥]|\b(?:eur|euros?|usd|dollars?|gbp|pounds?|chf)\b", re.IGNORECASE)
+
+# Whitespace and apostrophes used as thousands separators
+_GROUPING = re.compile(r"[\s'\u2019\u00a0\u202f]")
+
+# A displayed amount: groups of three digits separated by whitespace or apostrophes ("1 250,00"),
+# or digits with '.' and ',' separators ("1.250,00"), and an optional "k" suffix
+_PRICE = re.compile(r"(\d{1,3}(?:[\s'\u2019\u00a0\u202f]\d{3})+(?:[.,]\d+)?(?!\d)|\d[\d.,]*)(\s*k\b)?", re.IGNORECASE)
+
+# A number in a query: digits with optional thousands groups, decimals and "k" suffix.
+# Plain spaces are not accepted as thousands separators in queries, so that "38 300" stays two numbers.
+_QUERY_NUMBER = re.compile(r"(?<![\w.,])(\d+(?:['\u2019\u00a0\u202f.,]\d{3})*(?:[.,]\d+)?)(\s*k\b)?", re.IGNORECASE)
+
+def _parse_number(number: str) -> float | None:
+    """Parses a number whose thousands and decimal separators may be '.' or ','."""
+    if not number:
+        return None
+    last_dot, last_comma = number.rfind("."), number.rfind(",")
+    if last_dot >= 0 and last_comma >= 0:
+        # Both separators: the last one is the decimal separator
+        decimal_separator = "." if last_dot > last_comma else ","
+    elif last_dot >= 0 or last_comma >= 0:
+        separator = "." if last_dot >= 0 else ","
+        digits_after = len(number) - number.rfind(separator) - 1
+        # A single separator followed by exactly three digits groups thousands
+        if number.count(separator) > 1 or digits_after == 3:
+            decimal_separator = None
+        else:
+            decimal_separator = separator
+    else:
+        decimal_separator = None
+
+    if decimal_separator is None:
+        number = number.replace(".", "").replace(",", "")
+    else:
+        thousands_separator = "," if decimal_separator == "." else "."
+        number = number.replace(thousands_separator, "").replace(decimal_separator, ".")
+    try:
+        return float(number)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=65536)
+def parse_price(text: str) -> float | None:
+    """Parses a displayed price into a number.
+
+    Args:
+        text (str): The displayed price, e.g. "€290,00", "1.250,00 €" or "1.5k". Of a text
+            with several amounts, e.g. "290€ 250€", the first one is parsed.
+
+    Returns:
+        float | None: The price, or None if the text is not a price.
+    """
+    if text is None:
+        return None
+    value = _CURRENCY.sub(" ", text).strip()
+    match = _PRICE.match(value)
+    # The amount must end the text or be followed by whitespace, e.g. before a second amount
+    if match is None or (match.end() < len(value) and not value[match.end()].isspace()):
+        return None
+    number = _parse_number(_GROUPING.sub("", match.group(1)))
+    if number is None:
+        return None
+    return number * 1000 if match.group(2) else number
+
+def parse_prices(texts: Iterable[str]) -> list:
+    """Parses many displayed prices at once.
+
+    Args:
+        texts (Iterable[str]): The displayed prices.
+
+    Returns:
+        list: The price of each text, or None for the texts that are not prices.
+    """
+    return [parse_price(text) for text in texts]
+
+@lru_cache(maxsize=65536)
+def _extract_price_amounts(query: str) -> tuple:
+    amounts = []
+    for number, k_suffix in _QUERY_NUMBER.findall(query):
+        amount = _parse_number(_GROUPING.sub("", number))
+        if amount is not None:
+            amounts.append(amount * 1000 if k_suffix else amount)
+    return tuple(amounts)
+
+def extract_price_amounts(query: str) -> list:
+    """Extracts every price amount mentioned in a free-text query.
+
+    Args:
+        query (str): The query, e.g. "dresses between 300 and 1k euros".
+
+    Returns:
+        list: The amounts as numbers, in order of appearance.
+    """
+    return list(_extract_price_amounts(query))
@@ -0,0 +1,87 @@
+"""
+Salient product attributes (colors and fabrics) extracted from the product documents.
+
+The attributes are extracted once, at index time, with keyword matching (no LLM call), and
+stored in the product metadata as comma-separated strings (`colors`, `fabrics`), since
+Chroma metadata values must be scalars. They are used to summarize a customer's purchase
+history compactly (see `purchase_history.compact_purchase_history`).
+
+Functions:
+    extract_colors(text: str) -> list:
+        Extracts the colors mentioned in a text, in order of appearance.
+
+    extract_fabrics(text: str) -> list:
+        Extracts the fabrics mentioned in a text, in order of appearance.
+
+    extract_product_attributes(product_text: str) -> dict:
+        Extracts the colors and fabrics of a product from its pipe-separated document.
+
+Example Usage:
+    ```python
+    extract_product_attributes("felix trousers Black wool trousers|145.00 €|Black woollen trousers|55% POLYESTER 45% NEW WOOL")
+    # {"colors": "black", "fabrics": "polyester, wool"}
+    ```
+"""
+
+import re
+
+# Color names, with their variants mapped to a canonical name
+color_terms = {
+    "black": "black", "white": "white", "off-white": "ecru", "ecru": "ecru", "ivory": "ecru",
+    "cream": "ecru", "beige": "beige", "sand": "beige", "camel": "camel", "brown": "brown",
+    "chocolate": "brown", "grey": "grey", "gray": "grey", "anthracite": "grey",
+    "navy": "navy", "blue": "blue", "indigo": "blue", "red": "red", "burgundy": "burgundy",
+    "bordeaux": "burgundy", "pink": "pink", "green": "green", "khaki": "khaki", "olive": "khaki",
+    "yellow": "yellow", "orange": "orange", "purple": "purple", "lilac": "purple",
+    "gold": "gold", "golden": "gold", "silver": "silver",
+}
+
+# Fabric names, with their variants mapped to a canonical name
+fabric_terms = {
+    "cotton": "cotton", "wool": "wool", "woollen": "wool", "woolen": "wool", "merino": "wool",
+    "cashmere": "cashmere", "alpaca": "alpaca", "mohair": "mohair", "silk": "silk",
+    "linen": "linen", "viscose": "viscose", "polyester": "polyester", "polyamide": "polyamide",
+    "nylon": "polyamide", "elastane": "elastane", "acetate": "acetate", "lyocell": "lyocell",
+    "leather": "leather", "suede": "suede", "denim": "denim", "velvet": "velvet", "tweed": "tweed",
+    "satin": "satin", "poplin": "poplin", "jersey": "jersey", "lace": "lace",
+}
+
+_color_pattern = re.compile(r"\b(" + "|".join(sorted(map(re.escape, color_terms), key=len, reverse=True)) + r")\b", re.IGNORECASE)
+_fabric_pattern = re.compile(r"\b(" + "|".join(sorted(map(re.escape, fabric_terms), key=len, reverse=True)) + r")\b", re.IGNORECASE)
+
+def _extract(pattern: re.Pattern, terms: dict, text: str) -> list:
+    return list(dict.fromkeys(terms[match.lower()] for match in pattern.findall(text or "")))
+
+def extract_colors(text: str) -> list:
+    """Extracts the colors mentioned in a text, in order of appearance, without duplicates."""
+    return _extract(_color_pattern, color_terms, text)
+
+def extract_fabrics(text: str) -> list:
+    """Extracts the fabrics mentioned in a text, in order of appearance, without duplicates."""
+    return _extract(_fabric_pattern, fabric_terms, text)
+
+def extract_product_attributes(product_text: str) -> dict:
+    """Extracts the colors and fabrics of a product from its document.
+
+    The colors are read from the title and description, the fabrics from the fabrication
+    details first (the composition), then from the title and description.
+
+    Args:
+        product_text (str): The pipe-separated product document (title|price|description|fabrication).
+
+    Returns:
+        dict: The comma-separated `colors` and `fabrics` found, for the product metadata.
+            A key is omitted when no attribute is found.
+    """
+    fields = (product_text or "").split("|")
+    title, description = fields[0], fields[2] if len(fields) > 2 else ""
+    fabrication = fields[3] if len(fields) > 3 else ""
+
+    attributes = {}
+    colors = extract_colors(title + " " + description)
+    if colors:
+        attributes["colors"] = ", ".join(colors)
+    fabrics = list(dict.fromkeys(extract_fabrics(fabrication) + extract_fabrics(title + " " + description)))
+    if fabrics:
+        attributes["fabrics"] = ", ".join(fabrics)
+    return attributes
@@ -12,16 +12,20 @@ Attributes:
     product_categories (list): List of predefined product categories.
 
 Functions:
-    get_product_category(product: str) -> str:
-        Classifies a given product into one of the predefined categories.
+    get_product_category(product: str, tenant: str | None = None) -> str:
+        Classifies a given product into one of the predefined categories of a tenant.
 """
 
-from pydantic import BaseModel
+from functools import lru_cache
+from pydantic import BaseModel, create_model
 from langchain.output_parsers import PydanticOutputParser
 from typing import Literal
 from langchain_ollama import ChatOllama
+from stage_budget import invoke_with_budget, hedge_llm
+from prompt_templates import PromptTemplate, stage_llm_kwargs, structured_output
 
-llm = ChatOllama(model="llama3.2", temperature=0, num_ctx = 24576)
+llm = ChatOllama(**stage_llm_kwargs("product_category", model="llama3.2", temperature=0))
+llm_hedge = hedge_llm(**stage_llm_kwargs("product_category", model="llama3.2", temperature=0))
 
 # List of predefined product categories from the brand Soeur Paris
 product_categories = [
@@ -73,9 +77,34 @@ class CategoryResponse(BaseModel):
     ]
 
 # Initialize LLM model with structured output
-llm_product_category = llm.with_structured_output(CategoryResponse)
+llm_product_category = structured_output("product_category", llm, CategoryResponse)
+llm_product_category_hedge = structured_output("product_category", llm_hedge, CategoryResponse)
 
-def get_product_category(product: str) -> str:
+# Static system prompt (with the category list) first, the product last, for prompt-prefix reuse
+product_category_prompt = PromptTemplate(
+    system=f"You are a fashion product classifier. Classify the following product into exactly one of the predefined product categories. Product categories: {product_categories_as_string}. Respond with only the category name, and nothing else.",
+    user=["This is the product: {product}."]
+)
+
+@lru_cache(maxsize=64)
+def _tenant_classifier(categories: tuple) -> tuple:
+    """Builds the structured output runnables and prompt of a category schema, once per schema."""
+    response_model = create_model("TenantCategoryResponse", category=(Literal[categories], ...))
+    prompt = PromptTemplate(
+        system=f"You are a fashion product classifier. Classify the following product into exactly one of the predefined product categories. Product categories: {', '.join(categories)}. Respond with only the category name, and nothing else.",
+        user=["This is the product: {product}."]
+    )
+    return (
+        structured_output("product_category", llm, response_model),
+        structured_output("product_category", llm_hedge, response_model),
+        prompt
+    )
+
+def is_classification_error(category) -> bool:
+    """Whether a result of `get_product_category` is its error message rather than a category."""
+    return isinstance(category, str) and category.startswith("Error: ")
+
+def get_product_category(product: str, tenant: str | None = None) -> str:
     """Classifies a product query into one of the predefined product categories.
     
     This function takes a product description as input and utilizes a language model 
@@ -84,21 +113,31 @@ def get_product_category(product: str) -> str:
     
     Args:
         product (str): The product description to classify.
+        tenant (str, optional): The tenant whose category schema is used (see tenants.py).
+            Defaults to the default tenant, classified into `product_categories`.
 
     Returns:
-        str: The classified category name if valid, otherwise an error message.
+        str: The classified category name if valid, None if the classification exceeded
+            its latency budget, otherwise an error message.
     
     Raises:
         Exception: If the LLM model fails to process the request or returns an invalid response.
     """
     
-    system_prompt = f"You are a fashion product classifier. Classify the following product into exactly one of the predefined product categories. Product categories: {product_categories_as_string}. Respond with only the category name, and nothing else."
-
     try:
-        response = llm_product_category.invoke(
-            [{"role": "system", "content": system_prompt},
-             {"role": "user", "content": f"This is the product: {product}."},
-            ])
+        classifier, classifier_hedge, prompt = llm_product_category, llm_product_category_hedge, product_category_prompt
+        if tenant is not None:
+            from tenants import get_tenant
+            categories = get_tenant(tenant).product_categories
+            if categories is not None:
+                classifier, classifier_hedge, prompt = _tenant_classifier(tuple(categories))
+        response = invoke_with_budget(
+            "product_category",
+            classifier,
+            prompt.messages(product=product),
+            hedge=classifier_hedge)
+        if response is None:
+            return None  # Skip the category filter when the classification is too slow
         return response.category  # Return the validated category
     except Exception as e:
         return f"Error: {str(e)}"
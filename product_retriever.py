@@ -3,18 +3,30 @@ This module provides functionality to query and retrieve product information
 from a Chroma vector store with custom embeddings using Ollama. The module includes
 a custom embeddings class, product search query representation, and product retrieval 
 functions based on product IDs or query metadata such as price and category.
+Retrieval can also be served from the memory-mapped quantized vector store
+(see quantized_store.py), depending on `config.vector_store_format`, or entirely from
+the read-only catalog snapshot (see catalog_snapshot.py), depending on
+`config.catalog_snapshot_path`. `search_with_facets` aggregates the products matching a
+query (category counts, price histogram) on the columnar metadata, next to its top results.
 
 Dependencies:
     - langchain_chroma (for Chroma integration)
     - langchain_ollama (for Ollama Embeddings)
     - chromadb (for persistent client and collection handling)
+    - numpy (for the quantized vector store)
     - config (for configuration settings)
 """
 
+from collections import OrderedDict
 from langchain_chroma import Chroma
 from langchain_ollama import OllamaEmbeddings
 import chromadb
 import config
+import json
+import numpy as np
+import os
+import threading
+import time
 
 # Custom class to fix the signature mismatch for the embeddings function
 class CustomOllamaEmbeddings(OllamaEmbeddings):
@@ -41,44 +53,274 @@ class CustomOllamaEmbeddings(OllamaEmbeddings):
 # Embeddings function
 embeddings = CustomOllamaEmbeddings(model="mxbai-embed-large")
 
-# Vector store connection
-collection_name = "soeur-products"
+# Vector store connection of the default tenant (the other tenants are opened by tenants.py)
+collection_name = config.tenants[config.default_tenant]["collection_name"]
+persist_directory = config.tenants[config.default_tenant]["persist_directory"]
 
-persistent_client = chromadb.PersistentClient(path="./chroma_products_souer")
-collection = persistent_client.get_collection(name=collection_name, embedding_function=embeddings)
+# The Chroma client is opened lazily, once per process. PersistentClient holds SQLite
+# connections and background threads that are not safe to share across a fork, so a
+# process that did not open the store itself (e.g. a pre-forked worker) opens its own.
+_client_pid = None
+_persistent_client = None
+_collection = None
+_vector_store_from_client = None
+_retriever = None
+_quantized_store = None
+_client_lock = threading.Lock()
 
-vector_store_from_client = Chroma(
-    client=persistent_client,
-    collection_name=collection_name,
-    embedding_function=embeddings
-)
+def _reset_client_lock():
+    global _client_lock
+    _client_lock = threading.Lock()
 
-retriever = vector_store_from_client.as_retriever()
+# A lock held by another thread at fork time would never be released in the child
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client_lock)
+
+def _open_vector_store():
+    """Opens the Chroma vector store for the current process, if not already opened."""
+    global _client_pid, _persistent_client, _collection, _vector_store_from_client, _retriever
+    if _client_pid == os.getpid():
+        return
+    with _client_lock:
+        if _client_pid == os.getpid():
+            return
+        _persistent_client = chromadb.PersistentClient(path=persist_directory)
+        _collection = _persistent_client.get_collection(name=collection_name, embedding_function=embeddings)
+        _vector_store_from_client = Chroma(
+            client=_persistent_client,
+            collection_name=collection_name,
+            embedding_function=embeddings
+        )
+        _retriever = _vector_store_from_client.as_retriever()
+        _client_pid = os.getpid()
+
+def get_collection(tenant: str | None = None):
+    """Returns the Chroma collection of products of a tenant, opening the store on first use.
+
+    Args:
+        tenant (str, optional): The tenant name (see tenants.py). Defaults to `config.default_tenant`.
+    """
+    if tenant is not None and tenant != config.default_tenant:
+        from tenants import get_tenant_collection
+        return get_tenant_collection(tenant)
+    _open_vector_store()
+    return _collection
+
+def get_retriever():
+    """Returns the LangChain retriever over the products, opening the store on first use."""
+    _open_vector_store()
+    return _retriever
+
+def __getattr__(name):
+    # Keep `persistent_client`, `collection`, `vector_store_from_client` and `retriever`
+    # available as module attributes while opening the store lazily
+    if name in ("persistent_client", "collection", "vector_store_from_client", "retriever"):
+        _open_vector_store()
+        return globals()["_" + name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_quantized_store():
+    """Returns the memory-mapped vector store, opening it on first use.
+
+    This is the catalog snapshot if `config.catalog_snapshot_path` is set, otherwise the
+    quantized vector store. The store files are memory-mapped read-only, so the pages are
+    shared by all the processes mapping them, including across a fork.
+    """
+    global _quantized_store
+    if _quantized_store is None:
+        with _client_lock:
+            if _quantized_store is None:
+                if config.catalog_snapshot_path is not None:
+                    from catalog_snapshot import CatalogSnapshot
+                    _quantized_store = CatalogSnapshot(config.catalog_snapshot_path)
+                else:
+                    from quantized_store import QuantizedVectorStore
+                    _quantized_store = QuantizedVectorStore(config.quantized_store_path)
+    return _quantized_store
+
+def use_quantized_store(tenant: str | None = None) -> bool:
+    """Whether retrieval is served from the memory-mapped vector store, which holds the catalog of the default tenant."""
+    if tenant is not None and tenant != config.default_tenant:
+        return False
+    return config.catalog_snapshot_path is not None or config.vector_store_format in ("int8", "float16")
+
+def use_catalog_snapshot(tenant: str | None = None) -> bool:
+    """Whether the documents are served from the catalog snapshot instead of Chroma."""
+    if tenant is not None and tenant != config.default_tenant:
+        return False
+    return config.catalog_snapshot_path is not None
+
+def open_catalog():
+    """Opens the stores retrieval is served from, to warm up a process before serving requests."""
+    if use_quantized_store():
+        get_quantized_store()
+    if not use_catalog_snapshot():
+        get_collection()
+
+# Called when the catalog changes in this process, e.g. to clear the memoized candidates of the pipeline
+_catalog_change_callbacks = []
+
+def on_catalog_change(callback):
+    """Registers a function called without arguments when the catalog changes in this process."""
+    _catalog_change_callbacks.append(callback)
+
+def notify_catalog_change():
+    """Calls the functions registered with `on_catalog_change`, e.g. after a re-index or a snapshot swap."""
+    for callback in list(_catalog_change_callbacks):
+        callback()
+
+def reset_catalog():
+    """Closes the memory-mapped store and clears the cached query embeddings.
+
+    The next query opens the store of the current configuration again, e.g. after a
+    change of `config.catalog_snapshot_path` or of the embeddings model.
+    """
+    global _quantized_store
+    with _client_lock:
+        _quantized_store = None
+    with _query_vectors_lock:
+        _query_vectors.clear()
+    notify_catalog_change()
+
+# Query embeddings of the previous queries, kept as float16 to halve their memory
+_query_vectors = OrderedDict()
+_query_vectors_lock = threading.Lock()
+
+def embed_queries(queries: list) -> list:
+    """Embeds query strings, reusing the cached embeddings of previous queries.
+
+    The queries missing from the cache are embedded in a single call. The cache keeps
+    the `config.query_embedding_cache_size` most recently used queries.
+
+    Args:
+        queries (list): The query strings.
+
+    Returns:
+        list: The float32 embedding of each query, as NumPy arrays.
+    """
+    vectors = {}
+    with _query_vectors_lock:
+        for query in dict.fromkeys(queries):
+            if query in _query_vectors:
+                _query_vectors.move_to_end(query)
+                vectors[query] = _query_vectors[query].astype(np.float32)
+
+    missing = [query for query in dict.fromkeys(queries) if query not in vectors]
+    if missing:
+        embedded = embeddings.embed_documents(missing)
+        with _query_vectors_lock:
+            for query, vector in zip(missing, embedded):
+                _query_vectors[query] = np.asarray(vector, dtype=np.float16)
+                vectors[query] = np.asarray(vector, dtype=np.float32)
+            while len(_query_vectors) > config.query_embedding_cache_size:
+                _query_vectors.popitem(last=False)
+    return [vectors[query] for query in queries]
 
 from typing import Dict
 
 class ProductQuery:
-    """Represents a product search query with optional metadata.
+    """Represents a product search query with its extracted filters.
+
+    A ProductQuery is immutable and hashable, so it can be shared by concurrent pipeline
+    stages and used directly as a cache key. The stages derive updated queries with
+    `replace`, a shallow copy of a few slots.
 
     Attributes:
         query (str): The search query string. Defaults to an empty string.
-        metadata (dict): Additional metadata for the query. Defaults to an empty dictionary.
+        price_amount (str | None): The price the products are compared to, e.g. "250".
+        comparison_operator (str | None): The comparison of the product price with `price_amount`,
+            one of "$eq", "$ne", "$gt", "$gte", "$lt", "$lte".
+        category (str | None): The product category to filter on.
+        tenant (str | None): The brand catalog to search (see tenants.py). Defaults to None,
+            for `config.default_tenant`.
+        metadata (dict): The filters set, as a new dict keyed by field name, built on every
+            access. Kept for compatibility: the hot paths read the fields above directly.
     """
 
-    def __init__(self, query: str = "", metadata: Dict[str, str] | None = None):
+    __slots__ = ("query", "price_amount", "comparison_operator", "category", "tenant", "_hash")
+
+    # The fields exposed as metadata, in order
+    metadata_fields = ("price_amount", "comparison_operator", "category")
+
+    def __init__(self, query: str = "", metadata: Dict[str, str] | None = None, tenant: str | None = None,
+                 price_amount: str | None = None, comparison_operator: str | None = None, category: str | None = None):
         """Initializes a ProductQuery instance.
 
         Args:
             query (str, optional): The search query string. Defaults to an empty string.
-            metadata (dict, optional): Additional metadata for the query. Defaults to an empty dictionary.
+            metadata (dict, optional): The filters, keyed by field name (`price_amount`,
+                `comparison_operator`, `category`). Defaults to no filter.
+            tenant (str, optional): The brand catalog to search. Defaults to the default tenant.
+            price_amount (str, optional): The price the products are compared to.
+            comparison_operator (str, optional): The price comparison operator.
+            category (str, optional): The product category to filter on.
+
+        Raises:
+            TypeError: If `metadata` has a key that is not a ProductQuery field.
+        """
+        fields = {"price_amount": price_amount, "comparison_operator": comparison_operator, "category": category}
+        if metadata:
+            unknown = set(metadata) - set(fields)
+            if unknown:
+                raise TypeError(f"Unknown ProductQuery metadata: {', '.join(sorted(unknown))}")
+            fields.update(metadata)
+        if fields["price_amount"] is not None:
+            fields["price_amount"] = str(fields["price_amount"])
+        set_slot = object.__setattr__
+        set_slot(self, "query", query)
+        set_slot(self, "tenant", tenant)
+        for name, value in fields.items():
+            set_slot(self, name, value)
+        set_slot(self, "_hash", hash((query, fields["price_amount"], fields["comparison_operator"], fields["category"], tenant)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"ProductQuery is immutable, use replace({name}=...)")
+
+    def __delattr__(self, name):
+        raise AttributeError("ProductQuery is immutable")
+
+    @property
+    def metadata(self) -> dict:
+        return {name: getattr(self, name) for name in self.metadata_fields if getattr(self, name) is not None}
+
+    def replace(self, **changes) -> "ProductQuery":
+        """Returns a copy of the query with some fields changed.
+
+        Args:
+            **changes: The new values, by field name (`query`, `tenant`, `price_amount`,
+                `comparison_operator`, `category`).
+
+        Returns:
+            ProductQuery: The updated query.
         """
-        self.query = query
-        self.metadata = metadata if metadata is not None else {}
+        fields = {name: getattr(self, name) for name in ("query", "tenant") + self.metadata_fields}
+        fields.update(changes)
+        return ProductQuery(**fields)
+
+    def _key(self) -> tuple:
+        return (self.query, self.price_amount, self.comparison_operator, self.category, self.tenant)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ProductQuery):
+            return NotImplemented
+        return self._hash == other._hash and self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __reduce__(self):
+        # Slots without a __dict__ are restored through the constructor (e.g. in worker processes)
+        return (_product_query_from_fields, self._key())
 
     def __repr__(self) -> str:
         """Returns a string representation of the ProductQuery instance."""
+        if self.tenant is not None:
+            return f"ProductQuery(query={self.query!r}, metadata={self.metadata!r}, tenant={self.tenant!r})"
         return f"ProductQuery(query={self.query!r}, metadata={self.metadata!r})"
 
+def _product_query_from_fields(query, price_amount, comparison_operator, category, tenant) -> ProductQuery:
+    return ProductQuery(query, tenant=tenant, price_amount=price_amount, comparison_operator=comparison_operator, category=category)
+
 def retrieve_product_by_ids(product_ids: list) -> list:
     """
     Retrieves products from the vector store by their IDs.
@@ -91,12 +333,265 @@ def retrieve_product_by_ids(product_ids: list) -> list:
     """
     if len(product_ids) == 0:
         return []
-    result = collection.query(
+    if use_catalog_snapshot():
+        snapshot = get_quantized_store()
+        return snapshot.documents(snapshot.rows_by_key(product_ids))
+    result = get_collection().query(
         query_texts="",
         where={"key": { "$in": product_ids }}
     )
     return result['documents'][0]
 
+def retrieve_product_metadata_by_ids(product_ids: list) -> dict:
+    """
+    Retrieves the metadata of products by their IDs.
+
+    Args:
+        product_ids (list): A list of product IDs.
+
+    Returns:
+        dict: The metadata dict of each product found, by product ID.
+    """
+    if len(product_ids) == 0:
+        return {}
+    if use_catalog_snapshot():
+        snapshot = get_quantized_store()
+        metadatas = [snapshot.metadata(row) for row in snapshot.rows_by_key(product_ids).tolist()]
+    else:
+        metadatas = get_collection().get(where={"key": {"$in": list(product_ids)}}, include=["metadatas"])['metadatas']
+    return {metadata["key"]: metadata for metadata in metadatas if metadata and "key" in metadata}
+
+def retrieve_product_embeddings_by_ids(product_ids: list) -> dict:
+    """
+    Retrieves the embeddings of products by their IDs.
+
+    Args:
+        product_ids (list): A list of product IDs.
+
+    Returns:
+        dict: The embedding of each product found, as a float32 NumPy array, by product ID.
+    """
+    if len(product_ids) == 0:
+        return {}
+    if use_quantized_store():
+        store = get_quantized_store()
+        rows = np.flatnonzero(store.where_mask({"key": {"$in": list(product_ids)}}))
+        return dict(zip(store.columns["key"][rows].tolist(), np.asarray(store.vectors[rows], dtype=np.float32)))
+    result = get_collection().get(where={"key": {"$in": list(product_ids)}}, include=["embeddings", "metadatas"])
+    return {
+        metadata["key"]: np.asarray(embedding, dtype=np.float32)
+        for embedding, metadata in zip(result['embeddings'], result['metadatas'])
+        if metadata and "key" in metadata
+    }
+
+def build_where_clause(product_query: ProductQuery) -> dict | None:
+    """
+    Builds the Chroma metadata filter for a given product query.
+
+    Args:
+        product_query (ProductQuery): A ProductQuery instance that defines the search parameters.
+
+    Returns:
+        dict | None: The `where` clause combining the price and category filters with the
+            gender filter of the tenant, or None if the query carries no filterable metadata.
+    """
+    from tenants import get_tenant
+    conditions = []
+    if product_query.price_amount is not None and product_query.comparison_operator is not None:
+        conditions.append({"price_regular": {product_query.comparison_operator: float(product_query.price_amount)}})
+    if product_query.category is not None:
+        conditions.append({"category": product_query.category})
+    if not conditions:
+        return None
+    gender = get_tenant(product_query.tenant).gender
+    if gender is not None:
+        conditions.insert(0, {"gender": gender})
+    # Chroma requires at least two conditions in an `$and`
+    return {"$and": conditions} if len(conditions) > 1 else conditions[0]
+
+def _search_target(product_query: ProductQuery) -> tuple:
+    """Returns the Chroma collection to search for a product query and its `where` clause.
+
+    With `config.enable_category_partitions`, a category-filtered query searches the partition
+    of its category (see category_partitions.py) with its other filters only.
+
+    Returns:
+        tuple: The partition category (None for the global collection), the collection and the `where` clause.
+    """
+    if config.enable_category_partitions and product_query.category is not None:
+        from category_partitions import get_category_partitions
+        partition = get_category_partitions(product_query.tenant).get(product_query.category)
+        if partition is not None:
+            return product_query.category, partition, build_where_clause(product_query.replace(category=None))
+    return None, get_collection(product_query.tenant), build_where_clause(product_query)
+
+def _blend_query_vector(query_vector, affinity_vector) -> np.ndarray:
+    """Blends a query vector with a unit customer affinity vector (`config.customer_affinity_weight`)."""
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    if affinity_vector is None:
+        return query_vector
+    weight = config.customer_affinity_weight
+    # The affinity vector is scaled to the query vector norm, so the weight is a pure direction mix
+    return (1 - weight) * query_vector + weight * np.linalg.norm(query_vector) * np.asarray(affinity_vector, dtype=np.float32)
+
+class Candidates:
+    """Products retrieved for a query, with the features used to re-rank them.
+
+    Attributes:
+        documents (list): The product documents, most similar first.
+        scores (np.ndarray): The similarity of each product to the query (higher is more similar).
+        prices (np.ndarray): The regular price of each product, NaN if unknown.
+        categories (list): The category of each product, None if unknown.
+        ids (list | None): The id of each product, if known.
+    """
+
+    def __init__(self, documents: list, scores, prices, categories: list, ids: list | None = None):
+        self.documents = documents
+        self.scores = np.asarray(scores, dtype=np.float32)
+        self.prices = np.asarray(prices, dtype=np.float32)
+        self.categories = categories
+        self.ids = ids
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def __repr__(self) -> str:
+        return f"Candidates(documents={len(self.documents)})"
+
+def _retrieve_from_quantized_store(product_queries: list, max_results: int, affinity_vectors: list) -> list:
+    """Retrieves candidates for product queries from the quantized vector store.
+
+    The candidates are scored on the quantized vectors, re-scored exactly, then the
+    documents of the selected products are read from the catalog snapshot, or fetched
+    from Chroma by id.
+    """
+    store = get_quantized_store()
+    query_vectors = embed_queries([product_query.query for product_query in product_queries])
+
+    masks = {}
+    selected = []
+    for product_query, query_vector, affinity_vector in zip(product_queries, query_vectors, affinity_vectors):
+        where_clause = build_where_clause(product_query)
+        group_key = json.dumps(where_clause, sort_keys=True)
+        if group_key not in masks:
+            masks[group_key] = store.where_mask(where_clause)
+        selected.append(store.search(_blend_query_vector(query_vector, affinity_vector), max_results, masks[group_key]))
+    return _quantized_store_candidates(store, selected)
+
+def _quantized_store_candidates(store, selected: list) -> list:
+    """Builds the Candidates of rows selected in the quantized vector store.
+
+    Args:
+        store (QuantizedVectorStore): The store the rows were selected in.
+        selected (list): The (rows, scores) of each query.
+
+    Returns:
+        list: The Candidates of each query, without the products deleted from Chroma.
+    """
+    def candidates(rows, scores, documents):
+        categories = [category or None for category in store.columns["category"][rows].tolist()]
+        return Candidates(documents, scores, store.columns["price_regular"][rows], categories, store.ids[rows].tolist())
+
+    if use_catalog_snapshot():
+        return [candidates(rows, scores, store.documents(rows)) for rows, scores in selected]
+
+    ids = list(dict.fromkeys(product_id for rows, _ in selected for product_id in store.ids[rows].tolist()))
+    documents = {}
+    if ids:
+        result = get_collection().get(ids=ids, include=["documents"])
+        documents = dict(zip(result['ids'], result['documents']))
+    results = []
+    for rows, scores in selected:
+        # Skip the products deleted from Chroma since the store was exported
+        found = np.array([product_id in documents for product_id in store.ids[rows].tolist()], dtype=bool)
+        rows, scores = rows[found], scores[found]
+        results.append(candidates(rows, scores, [documents[product_id] for product_id in store.ids[rows].tolist()]))
+    return results
+
+def retrieve_candidates_batch(product_queries: list, max_candidates: int, affinity_vectors: list | None = None) -> list:
+    """
+    Retrieves candidate products for several product queries at once, with their features.
+
+    All query strings are embedded in a single call to the embeddings model, then the
+    queries are grouped by tenant and metadata filter so that each filter group is served
+    by one multi-query `collection.query` call. Category-filtered queries are served by the
+    partition of their category when `config.enable_category_partitions` is set.
+
+    Args:
+        product_queries (list): A list of ProductQuery instances, possibly of several tenants.
+        max_candidates (int): The maximum number of candidates per query.
+        affinity_vectors (list, optional): The affinity vector of the customer of each query
+            (see customer_affinity.py), or None, blended into the query vectors to personalize retrieval.
+
+    Returns:
+        list: The Candidates of each product query, in input order.
+    """
+    if len(product_queries) == 0:
+        return []
+    if affinity_vectors is None:
+        affinity_vectors = [None] * len(product_queries)
+
+    # The queries of the default tenant may be served by the memory-mapped store
+    results = [None] * len(product_queries)
+    quantized = [position for position, product_query in enumerate(product_queries) if use_quantized_store(product_query.tenant)]
+    if quantized:
+        quantized_results = _retrieve_from_quantized_store(
+            [product_queries[position] for position in quantized], max_candidates, [affinity_vectors[position] for position in quantized]
+        )
+        for position, candidates in zip(quantized, quantized_results):
+            results[position] = candidates
+    remaining = sorted(set(range(len(product_queries))) - set(quantized))
+    if not remaining:
+        return results
+
+    # Embed every distinct query string once
+    query_texts = list(dict.fromkeys(product_queries[position].query for position in remaining))
+    query_vectors = dict(zip(query_texts, embeddings.embed_documents(query_texts)))
+
+    # Group the queries sharing the same tenant, collection (global or category partition) and metadata filter
+    groups = {}
+    for position in remaining:
+        product_query = product_queries[position]
+        partition, collection, where_clause = _search_target(product_query)
+        group_key = (product_query.tenant or config.default_tenant, partition, json.dumps(where_clause, sort_keys=True))
+        groups.setdefault(group_key, (collection, where_clause, []))[2].append(position)
+
+    for collection, where_clause, positions in groups.values():
+        retriever_output = collection.query(
+            query_embeddings=[
+                _blend_query_vector(query_vectors[product_queries[position].query], affinity_vectors[position]).tolist()
+                for position in positions
+            ],
+            n_results=max_candidates,
+            where=where_clause,
+            include=["documents", "metadatas", "distances"]
+        )
+        for position, ids, documents, metadatas, distances in zip(positions, retriever_output['ids'], retriever_output['documents'], retriever_output['metadatas'], retriever_output['distances']):
+            metadatas = [metadata or {} for metadata in metadatas]
+            results[position] = Candidates(
+                documents,
+                # Squared L2 distances between unit vectors: the cosine similarity is 1 - d / 2
+                [1 - distance / 2 for distance in distances],
+                [metadata.get("price_regular", np.nan) for metadata in metadatas],
+                [metadata.get("category") for metadata in metadatas],
+                ids
+            )
+    return results
+
+def retrieve_candidates(product_query: ProductQuery, max_candidates: int, affinity_vector=None) -> Candidates:
+    """
+    Retrieves candidate products for a product query, with the features used to re-rank them.
+
+    Args:
+        product_query (ProductQuery): A ProductQuery instance that defines the search parameters.
+        max_candidates (int): The maximum number of candidates.
+        affinity_vector (optional): The affinity vector of the customer, blended into the query vector.
+
+    Returns:
+        Candidates: The candidate products, most similar first.
+    """
+    return retrieve_candidates_batch([product_query], max_candidates, [affinity_vector])[0]
+
 def retrieve_products(product_query: ProductQuery, max_results=4) -> list:
     """
     Retrieves products from the vector store based on a given product query.
@@ -108,19 +603,13 @@ def retrieve_products(product_query: ProductQuery, max_results=4) -> list:
     Returns:
         list: A list of product documents or content matching the query and metadata filters.
     """
-    where_clause = None
-    if 'price_amount' in product_query.metadata and 'comparison_operator' in product_query.metadata:
-        price_amount = product_query.metadata['price_amount']
-        comparison_operator = product_query.metadata['comparison_operator']
-        where_clause = {"$and":[{"gender": "women"},{"price_regular": {comparison_operator:float(price_amount)}}]}
-    if 'category' in product_query.metadata:
-        category = product_query.metadata['category']
-        if where_clause is None:
-             where_clause = {"$and":[{"gender": "women"},{"category": category}]}
-        else:
-            where_clause['$and'].append({"category": category})
+    if use_quantized_store(product_query.tenant):
+        return _retrieve_from_quantized_store([product_query], max_results, [None])[0].documents
+
+    _, collection, where_clause = _search_target(product_query)
             
-    if where_clause is not None:
+    # The LangChain retriever only searches the global collection of the default tenant, unfiltered
+    if where_clause is not None or collection is not get_collection():
         retriever_output = collection.query(
             query_texts=product_query.query,
             n_results=max_results,
@@ -128,5 +617,144 @@ def retrieve_products(product_query: ProductQuery, max_results=4) -> list:
         )
         return retriever_output['documents'][0]
     else:
-        retriever_output = retriever.invoke(product_query.query)[:max_results]
-        return [doc.page_content for doc in retriever_output]
\ No newline at end of file
+        retriever_output = get_retriever().invoke(product_query.query)[:max_results]
+        return [doc.page_content for doc in retriever_output]
+
+def retrieve_products_batch(product_queries: list, max_results=4) -> list:
+    """
+    Retrieves products for several product queries at once.
+
+    All query strings are embedded in a single call to the embeddings model, and each
+    metadata filter group is served by one multi-query request (see `retrieve_candidates_batch`).
+
+    Args:
+        product_queries (list): A list of ProductQuery instances.
+        max_results (int, optional): The maximum number of results per query. Defaults to 4.
+
+    Returns:
+        list: One list of product documents per product query, in input order.
+    """
+    return [candidates.documents for candidates in retrieve_candidates_batch(product_queries, max_results)]
+
+class Facets:
+    """The top results of a product query with the aggregations of the matching products.
+
+    Attributes:
+        candidates (Candidates): The top results, most similar first.
+        total (int): The number of products matching the query filters.
+        category_counts (dict): The number of products in each category, most frequent first.
+            The category filter of the query is ignored, so that the other categories show.
+        price_min (float | None): The lowest price, ignoring the price filter of the query.
+        price_max (float | None): The highest price, ignoring the price filter of the query.
+        price_buckets (list): The (low, high, count) of each bucket of `config.facet_price_buckets`,
+            ignoring the price filter of the query. `high` is None for the last bucket.
+    """
+
+    def __init__(self, candidates: Candidates, total: int, category_counts: dict, price_min, price_max, price_buckets: list):
+        self.candidates = candidates
+        self.total = total
+        self.category_counts = category_counts
+        self.price_min = price_min
+        self.price_max = price_max
+        self.price_buckets = price_buckets
+
+    def __repr__(self) -> str:
+        return f"Facets(total={self.total}, categories={len(self.category_counts)}, price_range=({self.price_min}, {self.price_max}))"
+
+# Facet columns built from the Chroma metadata, by tenant: tenant -> (columns, size, build time)
+_facet_columns_cache = {}
+_facet_columns_generation = 0  # Incremented when the catalog changes, so that a build started before is not cached
+_facet_columns_lock = threading.Lock()
+
+def _facet_columns(tenant: str | None = None) -> tuple:
+    """Returns the metadata columns the facets are computed from, and their number of rows.
+
+    These are the memory-mapped columns of the quantized store (or catalog snapshot) if
+    retrieval is served from it, otherwise columns built from the Chroma metadata of the
+    tenant, read in a single request. The built columns are reused until the catalog changes
+    in the process, or for `config.facet_columns_ttl` seconds.
+    """
+    if use_quantized_store(tenant):
+        store = get_quantized_store()
+        return store.columns, len(store)
+    with _facet_columns_lock:
+        entry = _facet_columns_cache.get(tenant)
+        generation = _facet_columns_generation
+    if entry is not None and time.monotonic() - entry[2] < config.facet_columns_ttl:
+        return entry[0], entry[1]
+
+    from quantized_store import filter_columns, metadata_column
+    metadatas = [metadata or {} for metadata in get_collection(tenant).get(include=["metadatas"])['metadatas']]
+    columns = {field: metadata_column([metadata.get(field) for metadata in metadatas], dtype) for field, dtype in filter_columns.items()}
+    with _facet_columns_lock:
+        if generation == _facet_columns_generation:
+            _facet_columns_cache[tenant] = (columns, len(metadatas), time.monotonic())
+    return columns, len(metadatas)
+
+def _clear_facet_columns():
+    global _facet_columns_generation
+    with _facet_columns_lock:
+        _facet_columns_cache.clear()
+        _facet_columns_generation += 1
+
+on_catalog_change(_clear_facet_columns)
+
+def _without_metadata(product_query: ProductQuery, *fields) -> ProductQuery:
+    return product_query.replace(**dict.fromkeys(fields))
+
+def search_with_facets(product_query: ProductQuery, max_results: int = 4, affinity_vector=None) -> Facets:
+    """
+    Retrieves the top products for a product query together with the category counts and
+    price histogram of the products matching its filters.
+
+    The aggregations are computed with NumPy on the metadata columns, without fetching any
+    document, and the top results are searched within the same filter mask.
+
+    Args:
+        product_query (ProductQuery): A ProductQuery instance that defines the search parameters.
+        max_results (int, optional): The maximum number of results to return. Defaults to 4.
+        affinity_vector (optional): The affinity vector of the customer, blended into the query vector.
+
+    Returns:
+        Facets: The top results and the aggregations.
+    """
+    from quantized_store import where_mask
+    columns, size = _facet_columns(product_query.tenant)
+
+    def mask(query: ProductQuery) -> np.ndarray | None:
+        return where_mask(columns, build_where_clause(query), size)
+
+    def select(column: np.ndarray, rows_mask: np.ndarray | None) -> np.ndarray:
+        return np.asarray(column) if rows_mask is None else np.asarray(column)[rows_mask]
+
+    result_mask = mask(product_query)
+    total = size if result_mask is None else int(np.count_nonzero(result_mask))
+
+    categories, counts = np.unique(select(columns["category"], mask(_without_metadata(product_query, "category"))), return_counts=True)
+    category_counts = {
+        category: count
+        for category, count in sorted(zip(categories.tolist(), counts.tolist()), key=lambda item: -item[1])
+        if category
+    }
+
+    prices = select(columns["price_regular"], mask(_without_metadata(product_query, "price_amount", "comparison_operator")))
+    prices = prices[~np.isnan(prices)].astype(np.float64)
+    edges = [float(edge) for edge in config.facet_price_buckets]
+    bucket_counts = np.histogram(prices, bins=edges + [np.inf])[0].tolist() if edges else []
+    price_buckets = [(low, high, count) for low, high, count in zip(edges, edges[1:] + [None], bucket_counts)]
+
+    if use_quantized_store(product_query.tenant):
+        store = get_quantized_store()
+        query_vector = _blend_query_vector(embed_queries([product_query.query])[0], affinity_vector)
+        candidates = _quantized_store_candidates(store, [store.search(query_vector, max_results, result_mask)])[0]
+    else:
+        candidates = retrieve_candidates(product_query, max_results, affinity_vector)
+
+    return Facets(
+        candidates,
+        total,
+        category_counts,
+        float(prices.min()) if prices.size else None,
+        float(prices.max()) if prices.size else None,
+        price_buckets
+    )
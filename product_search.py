@@ -0,0 +1,195 @@
+"""
+Product search entry points for the modular RAG pipeline.
+
+This module wires the pre-retrieval, retrieval, personalization and generation modules
+together. It provides the interactive search used by the notebook and a batch API for
+offline jobs that replay logged queries.
+
+Functions:
+    prepare_query(query: str, tenant: str | None = None) -> ProductQuery:
+        Runs the enabled pre-retrieval stages on a raw query string.
+
+    recommend_products(customer_id: int, query: str, tenant: str | None = None) -> str:
+        Searches for products and personalizes the recommendation for one query,
+        running the stage graph of `pipeline`.
+
+    search_batch(queries: list, customer_ids: list, tenant: str | None = None) -> Iterator[dict]:
+        Searches for many queries at once, yielding one result per query in input order.
+
+    search_batch_to_jsonl(queries: list, customer_ids: list, output_path: str) -> int:
+        Streams the results of `search_batch` to a JSONL file.
+
+Example Usage:
+    ```python
+    queries = ["Elegant navy evening gown below 250", "Black leather belt"]
+    search_batch_to_jsonl(queries, [3, 5], "results.jsonl")
+    ```
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+from pre_retrieval_metadata import extract_metadata
+from product_retriever import ProductQuery, retrieve_candidates_batch
+from pipeline import run_pipeline
+from reranking import candidate_count
+from pre_retrieval_query_transformation import remove_price_from_query
+from llm_scheduler import record_shed, should_shed
+import config
+import json
+
+def prepare_query(query: str, tenant: str | None = None) -> ProductQuery:
+    """Runs the enabled pre-retrieval stages on a raw query string.
+
+    Args:
+        query (str): The user search query.
+        tenant (str, optional): The brand catalog to search (see tenants.py). Defaults to the default tenant.
+
+    Returns:
+        ProductQuery: The product query with extracted metadata and transformed query string.
+    """
+    # Create the query object with the original query
+    product_query = ProductQuery(query, tenant=tenant)
+
+    # Extract price metadata for hybrid retrieval, if enabled
+    if config.enable_metadata_extraction:
+        product_query = extract_metadata(product_query)
+
+    # Transforms the original query string to remove price information, if enabled
+    if config.enable_query_transformation:
+        product_query = remove_price_from_query(product_query)
+
+    return product_query
+
+def recommend_products(customer_id, query, tenant=None):
+    """Search for products and personalize recommendation."""
+
+    # Run the stage graph: pre-retrieval, retrieval and personalization, then generation
+    outputs = run_pipeline({"query": query, "customer_id": customer_id, "tenant": tenant})
+
+    print("\n---Query for retrieval---\n")
+    print(outputs["product_query"])
+    print("\n---Retrieval results---\n")
+    print("\n\n".join(outputs["search_results"]))
+    if config.enable_purchase_history:
+        print("\n---Customer preferences---\n")
+        print(outputs["customer_preferences"])
+
+    return outputs["response"]
+
+def search_batch(queries: list, customer_ids: list, max_results=4, max_concurrency: int | None = None, tenant: str | None = None) -> Iterator[dict]:
+    """Searches for products for many (query, customer) pairs at once.
+
+    The searches run the stage graph of `pipeline`, in three steps. The pre-retrieval stages
+    run once per distinct query and the affinity and personalization stages once per distinct
+    customer. Retrieval is then batched outside the graph, since the graph retrieves one query
+    at a time: all distinct queries are embedded in a single call, and retrieval issues one
+    multi-query request per metadata filter group. Last, the ranking and generation stages run
+    for each distinct (query, customer) pair from the retrieved candidates. The pipeline runs
+    with bounded concurrency, and the LLM stages of the whole batch are shed or not together
+    (see llm_scheduler.py).
+
+    Args:
+        queries (list): The user search queries.
+        customer_ids (list): The customer id for each query, aligned with `queries`.
+        max_results (int, optional): The maximum number of products per query. Defaults to 4.
+        max_concurrency (int, optional): The maximum number of concurrent pipeline runs.
+            Defaults to `config.batch_max_concurrency`.
+        tenant (str, optional): The brand catalog the queries search (see tenants.py).
+            Defaults to the default tenant.
+
+    Yields:
+        dict: One result per input query, in input order, with the query, the customer id,
+            the retrieval query, the retrieved products, the generated response and whether
+            the LLM stages were shed (`degraded`).
+
+    Raises:
+        ValueError: If `queries` and `customer_ids` have different lengths.
+    """
+    if len(queries) != len(customer_ids):
+        raise ValueError("queries and customer_ids must have the same length")
+    if max_concurrency is None:
+        max_concurrency = config.batch_max_concurrency
+
+    unique_queries = list(dict.fromkeys(queries))
+    unique_customer_ids = list(dict.fromkeys(customer_ids))
+    shed = should_shed()
+    if shed:
+        record_shed()
+
+    def run(inputs, outputs):
+        return run_pipeline({"tenant": tenant, "max_results": max_results, **inputs}, outputs=outputs, shed=shed)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        # --- Pre-retrieval and personalization ---
+        query_runs = executor.map(run, [{"query": query} for query in unique_queries], [("product_query",)] * len(unique_queries))
+        customer_runs = executor.map(run, [{"customer_id": customer_id} for customer_id in unique_customer_ids], [("customer_affinity", "customer_preferences")] * len(unique_customer_ids))
+        product_queries = {query: values["product_query"] for query, values in zip(unique_queries, query_runs)}
+        customers = dict(zip(unique_customer_ids, customer_runs))
+
+        # --- Retrieval ---
+        # Queries are retrieved once per customer with affinity data, once otherwise
+        retrieval_keys = {
+            (query, customer_id): (query, customer_id if customers[customer_id]["customer_affinity"] is not None else None)
+            for query, customer_id in zip(queries, customer_ids)
+        }
+        unique_retrieval_keys = list(dict.fromkeys(retrieval_keys.values()))
+        candidates = retrieve_candidates_batch(
+            [product_queries[query] for query, _ in unique_retrieval_keys],
+            candidate_count(max_results),
+            [customers[customer_id]["customer_affinity"].vector if customer_id is not None else None for _, customer_id in unique_retrieval_keys]
+        )
+        candidates = dict(zip(unique_retrieval_keys, candidates))
+
+        # --- Ranking and generation ---
+        runs = {}
+        for (query, customer_id), retrieval_key in retrieval_keys.items():
+            runs[(query, customer_id)] = executor.submit(run, {
+                "query": query,
+                "customer_id": customer_id,
+                "product_query": product_queries[query],
+                "customer_affinity": customers[customer_id]["customer_affinity"],
+                "customer_preferences": customers[customer_id]["customer_preferences"],
+                "candidates": candidates[retrieval_key],
+            }, ("search_results", "response"))
+
+        # Stream the results out in input order as soon as each one is ready
+        for index, (query, customer_id) in enumerate(zip(queries, customer_ids)):
+            result = {
+                "index": index,
+                "customer_id": customer_id,
+                "query": query,
+                "product_query": {"query": product_queries[query].query, "metadata": product_queries[query].metadata},
+                "degraded": shed,
+            }
+            try:
+                values = runs[(query, customer_id)].result()
+                result["search_results"] = values["search_results"]
+                result["response"] = values["response"]
+            except Exception as e:
+                print(f"Error searching for query {index}: {e}")
+                result["search_results"] = None
+                result["response"] = None
+                result["error"] = str(e)
+            yield result
+
+def search_batch_to_jsonl(queries: list, customer_ids: list, output_path: str, max_results=4, max_concurrency: int | None = None, tenant: str | None = None) -> int:
+    """Runs `search_batch` and streams the results to a JSONL file in input order.
+
+    Args:
+        queries (list): The user search queries.
+        customer_ids (list): The customer id for each query, aligned with `queries`.
+        output_path (str): The path of the JSONL file to write.
+        max_results (int, optional): The maximum number of products per query. Defaults to 4.
+        max_concurrency (int, optional): The maximum number of concurrent LLM calls.
+        tenant (str, optional): The brand catalog the queries search. Defaults to the default tenant.
+
+    Returns:
+        int: The number of results written.
+    """
+    count = 0
+    with open(output_path, "w", encoding="utf-8") as f:
+        for result in search_batch(queries, customer_ids, max_results, max_concurrency, tenant):
+            f.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            count += 1
+    return count
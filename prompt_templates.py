@@ -0,0 +1,176 @@
+"""
+Prompt templates and Ollama client settings laid out for prompt-prefix reuse.
+
+The Ollama runner keeps the KV cache of the previous prompt of a loaded model and only
+evaluates (prefills) the tokens after the longest prefix shared with it. A prompt whose
+first message changes with every request, e.g. a system prompt embedding the search
+results, is prefilled entirely on every call. This module provides:
+
+- `PromptTemplate`: a static system prompt, built once, followed by the user messages
+  holding the variable content, ordered from the most stable (e.g. the customer
+  preferences) to the most variable (the query). Requests of a stage then share the longest
+  possible prefix.
+- `stage_llm_kwargs`: the ChatOllama options of a stage from `config.stage_llm_options`
+  (model, context size, output token cap), overridden by `config.routed_stage_llm_options`
+  when `config.enable_stage_model_routing` is set, with `keep_alive` (`config.llm_keep_alive`) so
+  that the models stay loaded between bursts, and, when `config.enable_llm_cache` is set,
+  the persistent response cache for the temperature-0 stages of `config.llm_cache_stages`
+  (see llm_cache.py).
+- `structured_output`: the structured output of the classification stages, decoded under
+  the JSON schema of the response (`config.structured_output_method`), so the model can
+  only produce a valid answer.
+- Prefill and decode timing per stage, from the durations reported by Ollama in the
+  response metadata (`record_timing`, `timing_summary`). Ollama only counts the prompt
+  tokens it evaluated, so the prompt tokens served from the cache show as a drop of the
+  prefill tokens and time. The responses served from the LLM response cache are not counted.
+
+Example Usage:
+    ```python
+    prompt = PromptTemplate("You are a fashion assistant.", ["Query: {query}"])
+    llm = ChatOllama(**stage_llm_kwargs("query_transformation", model="llama3.2", temperature=0))
+    response = llm.invoke(prompt.messages(query="black wool coat"))
+    record_timing("query_transformation", response)
+    print(timing_summary())
+    ```
+"""
+
+from collections import Counter
+from langchain_core.runnables import RunnableLambda
+from llm_cache import get_llm_cache
+from string import Formatter
+import threading
+import config
+
+class PromptTemplate:
+    """A chat prompt with a static system prompt and the variable content at the end.
+
+    Attributes:
+        system (str): The static system prompt, identical for every request.
+        user (list): The user message templates, in `str.format` syntax, from the most stable
+            to the most variable content. A message is left out when one of its variables is None.
+        assistant (str | None): An optional assistant message ending the prompt.
+    """
+
+    def __init__(self, system: str, user: list, assistant: str | None = None):
+        self.system = system
+        self.user = list(user)
+        self.assistant = assistant
+        self._fields = [[name for _, name, _, _ in Formatter().parse(template) if name] for template in self.user]
+
+    def messages(self, **variables) -> list:
+        """Builds the chat messages for the given variables.
+
+        Args:
+            **variables: The values of the template variables.
+
+        Returns:
+            list: The system message, the user messages and the optional assistant message.
+        """
+        messages = [{"role": "system", "content": self.system}]
+        for template, fields in zip(self.user, self._fields):
+            if any(variables.get(name) is None for name in fields):
+                continue
+            messages.append({"role": "user", "content": template.format(**variables)})
+        if self.assistant is not None:
+            messages.append({"role": "assistant", "content": self.assistant})
+        return messages
+
+    def __repr__(self) -> str:
+        return f"PromptTemplate(system={self.system[:40]!r}..., user={self.user!r})"
+
+def stage_llm_kwargs(stage: str, **defaults) -> dict:
+    """Returns the ChatOllama parameters of a stage.
+
+    Args:
+        stage (str): The stage name, a key of `config.stage_llm_options`.
+        **defaults: The parameters used unless the stage options override them. The options
+            of `config.routed_stage_llm_options` override both when `config.enable_stage_model_routing` is set.
+
+    Returns:
+        dict: The ChatOllama parameters, with `keep_alive` set, and `cache` set if the
+            responses of the stage are cached.
+    """
+    kwargs = {"keep_alive": config.llm_keep_alive, **defaults}
+    kwargs.update(config.stage_llm_options.get(stage, {}))
+    if config.enable_stage_model_routing:
+        kwargs.update(config.routed_stage_llm_options.get(stage, {}))
+    # Only deterministic calls are cached
+    if config.enable_llm_cache and stage in config.llm_cache_stages and kwargs.get("temperature") == 0:
+        kwargs["cache"] = get_llm_cache()
+    return kwargs
+
+# Ollama durations (in nanoseconds) and token counts accumulated per stage
+_timing_keys = ("prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration", "load_duration", "total_duration")
+_timings = {}
+_timings_lock = threading.Lock()
+
+def record_timing(stage: str, response):
+    """Accumulates the prefill and decode timing of an Ollama response for a stage.
+
+    Args:
+        stage (str): The stage name.
+        response: The AIMessage (or final stream chunk) returned by ChatOllama. Responses
+            without Ollama timing metadata, or served from the LLM response cache, are ignored.
+    """
+    metadata = getattr(response, "response_metadata", None) or {}
+    if metadata.get("llm_cache_hit") or ("eval_duration" not in metadata and "prompt_eval_duration" not in metadata):
+        return
+    with _timings_lock:
+        timings = _timings.setdefault(stage, Counter())
+        timings["calls"] += 1
+        for key in _timing_keys:
+            timings[key] += metadata.get(key) or 0
+
+def timing_summary() -> dict:
+    """Returns the average prefill and decode timing of each stage since the last reset.
+
+    Returns:
+        dict: For each stage, the number of calls and the average prompt tokens evaluated,
+            prefill time (ms), generated tokens, decode time (ms), model load time (ms),
+            and the decode rate (tokens/s).
+    """
+    with _timings_lock:
+        timings = {stage: Counter(values) for stage, values in _timings.items()}
+    summary = {}
+    for stage, values in timings.items():
+        calls = values["calls"]
+        summary[stage] = {
+            "calls": calls,
+            "prefill_tokens": values["prompt_eval_count"] / calls,
+            "prefill_ms": values["prompt_eval_duration"] / calls / 1e6,
+            "decode_tokens": values["eval_count"] / calls,
+            "decode_ms": values["eval_duration"] / calls / 1e6,
+            "load_ms": values["load_duration"] / calls / 1e6,
+            "decode_tokens_per_second": values["eval_count"] / (values["eval_duration"] / 1e9) if values["eval_duration"] else 0.0,
+        }
+    return summary
+
+def reset_timings():
+    """Clears the accumulated timing."""
+    with _timings_lock:
+        _timings.clear()
+
+def structured_output(stage: str, llm, schema):
+    """Wraps `llm.with_structured_output(schema)`, recording the timing of the raw response.
+
+    With the "json_schema" method (`config.structured_output_method`), Ollama constrains the
+    decoding to the JSON schema of `schema`, e.g. to the values of a Literal field.
+
+    Args:
+        stage (str): The stage name.
+        llm (ChatOllama | None): The LLM client.
+        schema: The pydantic model of the output.
+
+    Returns:
+        The runnable returning the parsed output, or None if `llm` is None.
+    """
+    if llm is None:
+        return None
+
+    def parse(output: dict):
+        record_timing(stage, output["raw"])
+        if output.get("parsing_error") is not None:
+            raise output["parsing_error"]
+        return output["parsed"]
+
+    return llm.with_structured_output(schema, method=config.structured_output_method, include_raw=True) | RunnableLambda(parse)
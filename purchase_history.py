@@ -6,16 +6,52 @@ formats the purchase history, and then uses an AI model to generate insights int
 Functions:
     get_product_ids_by_customer(customer_id: int) -> list:
         Retrieves all product IDs for a given customer based on their purchase history.
+
+    get_purchased_items(customer_id: int) -> list:
+        Retrieves the product ID, price and quantity of each item purchased by a customer.
+
+    compact_purchase_history(customer_id: int) -> str:
+        Summarizes the purchase history by category (items, average price, colors, fabrics)
+        within a token budget.
         
     extract_fashion_preferences(customer_id: int) -> str:
         Analyzes a customer's purchase history and extracts their fashion preferences 
         using a language model to identify patterns across different fashion categories.
+
+    cached_fashion_preferences(customer_id: int) -> str | None:
+        Returns the preferences of a customer extracted earlier, if they are still fresh.
+
+The extracted preferences are kept in a per-process cache (`config.preference_cache_size`,
+`config.preference_cache_ttl`), keyed by the purchased products so that a new purchase
+invalidates them. The cache is filled by the searches and ahead of them by the background
+worker of preference_worker.py.
 """
 
+from collections import Counter, OrderedDict
 from langchain_ollama import ChatOllama
-from product_retriever import retrieve_product_by_ids
+from product_attributes import extract_colors, extract_fabrics
+from product_retriever import retrieve_product_by_ids, retrieve_product_metadata_by_ids
+from stage_budget import invoke_with_budget, hedge_llm
+from prompt_templates import PromptTemplate, stage_llm_kwargs
+import threading
+import time
+import config
+
+llm = ChatOllama(**stage_llm_kwargs("purchase_history", model="llama3.2", temperature=0))
+llm_hedge = hedge_llm(**stage_llm_kwargs("purchase_history", model="llama3.2", temperature=0))
 
-llm = ChatOllama(model="llama3.2", temperature=0, num_ctx = 24576)
+# Static system prompt first, the purchase history last, for prompt-prefix reuse
+purchase_history_prompt = PromptTemplate(
+    system=(
+        "You are an expert fashion analyst. Your task is to analyze a list of purchased fashion products "
+        "and extract the user's fashion preferences. Identify patterns based on the following categories: "
+        "Styles, Colors, Fabrics, Fit, Occasion-Based Preferences, Accessory Preferences, "
+        "Cultural & Subcultural Influences, Sustainability & Ethical Preferences, Budget, "
+        "Functional & Practical Choices, and Trend Adoption. "
+        "Return a comma-separated list of preferences, sorted by category."
+    ),
+    user=["Purchase History: {purchase_history}"]
+)
 
 def get_product_ids_by_customer(customer_id: int) -> int:
     """Retrieve all product IDs for a given customer ID.
@@ -31,35 +67,161 @@ def get_product_ids_by_customer(customer_id: int) -> int:
             return [product["product_id"] for order in customer["purchase_orders"] for product in order["products"]]
     return []  # Return an empty list if customer ID is not found
 
-def extract_fashion_preferences(customer_id: int) -> str:
+def get_purchased_items(customer_id: int) -> list:
+    """Retrieve the purchased items of a given customer ID.
+
+    Args:
+        customer_id (int): The ID of the customer whose purchased items are to be retrieved.
+
+    Returns:
+        list: The (product_id, price, quantity) tuple of each purchased item. Returns an empty list if the customer ID is not found.
+    """
+    for customer in customer_purchase_orders:
+        if customer["customer_id"] == customer_id:
+            return [
+                (product["product_id"], product["price"], product.get("quantity", 1))
+                for order in customer["purchase_orders"] for product in order["products"]
+            ]
+    return []
+
+def _estimate_tokens(text: str) -> int:
+    # About 4 characters per token for English text
+    return len(text) // 4 + 1
+
+def _plural(count: int, noun: str) -> str:
+    return f"{count} {noun}" if count == 1 else f"{count} {noun}s"
+
+def _attribute_counts(attribute_values: list) -> str:
+    return ", ".join(f"{value} ({count})" for value, count in attribute_values)
+
+def compact_purchase_history(customer_id: int, token_budget: int | None = None) -> str:
+    """Summarizes the purchase history of a customer within a token budget.
+
+    The purchased products are deduplicated and aggregated by category, with the number of
+    items, the number of distinct products, the average purchase price and the most frequent
+    colors and fabrics (from the `colors` and `fabrics` metadata extracted at index time, or
+    from the product title for the products indexed without them). The categories with the
+    most items come first, and the summary stops before exceeding the token budget.
+
+    Args:
+        customer_id (int): The ID of the customer.
+        token_budget (int, optional): The approximate maximum number of tokens of the summary.
+            Defaults to `config.purchase_history_token_budget`.
+
+    Returns:
+        str: One line per category, or an empty string if the customer has no purchases.
+    """
+    token_budget = token_budget or config.purchase_history_token_budget
+    items = get_purchased_items(customer_id)
+    if not items:
+        return ""
+    product_metadata = retrieve_product_metadata_by_ids(list(dict.fromkeys(product_id for product_id, _, _ in items)))
+
+    categories = {}
+    for product_id, price, quantity in items:
+        metadata = product_metadata.get(product_id, {})
+        category = categories.setdefault(metadata.get("category", "Other"), {
+            "items": 0, "spent": 0.0, "products": set(), "colors": Counter(), "fabrics": Counter()
+        })
+        category["items"] += quantity
+        category["spent"] += price * quantity
+        category["products"].add(product_id)
+        colors = metadata["colors"].split(", ") if "colors" in metadata else extract_colors(metadata.get("title", ""))
+        fabrics = metadata["fabrics"].split(", ") if "fabrics" in metadata else extract_fabrics(metadata.get("title", ""))
+        for color in colors:
+            category["colors"][color] += quantity
+        for fabric in fabrics:
+            category["fabrics"][fabric] += quantity
+
+    lines = []
+    used_tokens = 0
+    ranked_categories = sorted(categories.items(), key=lambda entry: entry[1]["items"], reverse=True)
+    for position, (name, category) in enumerate(ranked_categories):
+        line = (
+            f"{name}: {_plural(category['items'], 'item')} ({_plural(len(category['products']), 'distinct product')}), "
+            f"average price {category['spent'] / category['items']:.2f} €"
+        )
+        if category["colors"]:
+            line += f"; colors: {_attribute_counts(category['colors'].most_common(config.purchase_history_top_attributes))}"
+        if category["fabrics"]:
+            line += f"; fabrics: {_attribute_counts(category['fabrics'].most_common(config.purchase_history_top_attributes))}"
+        if used_tokens + _estimate_tokens(line) > token_budget:
+            lines.append(f"... and {len(ranked_categories) - position} more categories")
+            break
+        lines.append(line)
+        used_tokens += _estimate_tokens(line)
+    return "\n".join(lines)
+
+# Extracted preferences by customer: (purchased products, preferences, expiry time)
+_preference_profiles = OrderedDict()
+_preference_profiles_lock = threading.Lock()
+
+def cached_fashion_preferences(customer_id: int, product_ids: list | None = None) -> str | None:
+    """Returns the preferences of a customer extracted earlier, if still fresh.
+
+    Args:
+        customer_id (int): The customer id.
+        product_ids (list, optional): The purchased product ids. Defaults to the purchase history.
+
+    Returns:
+        str | None: The cached preferences, or None if they expired, the customer purchased
+            products since, or they were never extracted.
+    """
+    if product_ids is None:
+        product_ids = get_product_ids_by_customer(customer_id)
+    with _preference_profiles_lock:
+        profile = _preference_profiles.get(customer_id)
+        if profile is None:
+            return None
+        purchased, preferences, expires_at = profile
+        if purchased != tuple(product_ids) or expires_at <= time.monotonic():
+            del _preference_profiles[customer_id]
+            return None
+        _preference_profiles.move_to_end(customer_id)
+        return preferences
+
+def _cache_fashion_preferences(customer_id: int, product_ids: list, preferences: str):
+    with _preference_profiles_lock:
+        _preference_profiles[customer_id] = (tuple(product_ids), preferences, time.monotonic() + config.preference_cache_ttl)
+        _preference_profiles.move_to_end(customer_id)
+        while len(_preference_profiles) > config.preference_cache_size:
+            _preference_profiles.popitem(last=False)
+
+def extract_fashion_preferences(customer_id: int, background: bool = False) -> str:
     """Extracts user fashion preferences from the customer purchase history.
 
     Args:
         customer_id (int): the customer id.
+        background (bool, optional): Whether the extraction runs ahead of the searches, without
+            latency budget (see preference_worker.py). Defaults to False.
 
     Returns:
         str: A comma-separated list of user fashion preferences, sorted by category.
     """
-    system_instruction = (
-        "You are an expert fashion analyst. Your task is to analyze a list of purchased fashion products "
-        "and extract the user's fashion preferences. Identify patterns based on the following categories: "
-        "Styles, Colors, Fabrics, Fit, Occasion-Based Preferences, Accessory Preferences, "
-        "Cultural & Subcultural Influences, Sustainability & Ethical Preferences, Budget, "
-        "Functional & Practical Choices, and Trend Adoption. "
-        "Return a comma-separated list of preferences, sorted by category."
-    )
-
     product_ids = get_product_ids_by_customer(customer_id)
+    preferences = cached_fashion_preferences(customer_id, product_ids)
+    if preferences is not None:
+        return preferences
     if len(product_ids) > 0:
-        purchase_history = retrieve_product_by_ids(product_ids)
-        purchase_history_formatted = "\n\n".join(purchase_history)
+        if config.compact_purchase_history:
+            # Aggregated by category within a token budget, to bound the prompt prefill
+            purchase_history_formatted = compact_purchase_history(customer_id)
+        else:
+            purchase_history = retrieve_product_by_ids(product_ids)
+            purchase_history_formatted = "\n\n".join(purchase_history)
         print("\n---Purchase history---\n")
         print(purchase_history_formatted)
         try:
-            response = llm.invoke([
-                {"role": "system", "content": system_instruction},
-                {"role": "user", "content": f"Purchase History: {purchase_history_formatted}"}
-            ])
+            response = invoke_with_budget(
+                "purchase_history",
+                llm,
+                purchase_history_prompt.messages(purchase_history=purchase_history_formatted),
+                hedge=llm_hedge,
+                background=background
+            )
+            if response is None:
+                return None  # Skip personalization when the extraction is too slow
+            _cache_fashion_preferences(customer_id, product_ids, response.content)
             return response.content
     
         except Exception as e:
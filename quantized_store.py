@@ -0,0 +1,289 @@
+"""
+Compact, memory-mapped storage of the product embeddings.
+
+mxbai-embed-large produces 1024-dim float32 vectors. This module exports the product
+embeddings of the Chroma collection into a directory of NumPy files that every worker
+memory-maps, so the operating system shares a single physical copy across processes:
+
+- `codes.npy`: the normalized vectors quantized to int8 (with `scales.npy`, the per-vector
+  scale of the int8 codes), or stored as float16. Retrieval scans these compact codes to
+  compute approximate cosine similarities (4x or 2x less memory than float32).
+- `vectors.npy`: the full-precision float32 vectors. Only the rows of the top candidates
+  are read, to re-score them exactly, so the file stays mostly out of memory.
+- `ids.npy` and one `.npy` file per filterable metadata field (`key`, `price_regular`,
+  `gender`, `category`), to apply the Chroma `where` filters without the Chroma client.
+
+mxbai-embed-large is trained so that its embeddings can be truncated (Matryoshka
+representation). With `config.retrieval_truncate_dim`, the first stage only reads the first
+dimensions of the codes (e.g. 256 of 1024), so its cost grows with the truncated width
+rather than the full vector width, and the full vectors only re-rank the top candidates.
+
+Retrieval is served from this store when `config.vector_store_format` is "int8" or
+"float16" (see `product_retriever.retrieve_products`).
+
+Dependencies:
+    - numpy
+    - product_retriever.py (for the export from the Chroma collection)
+
+Example Usage:
+    ```python
+    export_quantized_store("./catalog_vectors", "int8")
+    store = QuantizedVectorStore("./catalog_vectors")
+    rows, scores = store.search(query_vector, k=4)
+    ```
+"""
+
+import json
+import os
+import numpy as np
+import config
+
+# Metadata fields stored as columns to evaluate the `where` filters
+filter_columns = {"key": np.int64, "price_regular": np.float32, "gender": str, "category": str}
+
+_comparison_operators = {
+    "$eq": np.equal,
+    "$ne": np.not_equal,
+    "$gt": np.greater,
+    "$gte": np.greater_equal,
+    "$lt": np.less,
+    "$lte": np.less_equal,
+}
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scales vectors (one per row) to unit length."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+def quantize_int8(vectors: np.ndarray) -> tuple:
+    """Quantizes normalized vectors to int8 with a symmetric per-vector scale.
+
+    Args:
+        vectors (np.ndarray): The normalized vectors, one per row.
+
+    Returns:
+        tuple: The int8 codes and the float32 scale of each vector, such that
+            `codes * scales[:, None]` approximates the vectors.
+    """
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales = np.maximum(scales, np.finfo(np.float32).tiny).astype(np.float32)
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+def metadata_column(values: list, dtype) -> np.ndarray:
+    """Builds the column array of a metadata field.
+
+    Missing values are stored as "" for strings, NaN for floats and -1 for integers.
+
+    Args:
+        values (list): The value of the field for each product, None if missing.
+        dtype: str, or the NumPy dtype of the column.
+
+    Returns:
+        np.ndarray: The column.
+    """
+    if dtype is str:
+        return np.array(["" if value is None else str(value) for value in values], dtype=str)
+    if np.issubdtype(dtype, np.floating):
+        return np.array([np.nan if value is None else value for value in values], dtype=dtype)
+    return np.array([-1 if value is None else value for value in values], dtype=dtype)
+
+def where_mask(columns: dict, where: dict | None, size: int) -> np.ndarray | None:
+    """Evaluates a Chroma `where` filter on metadata columns.
+
+    Supports `$and`, `$or`, equality shorthand and the operators `$eq`, `$ne`, `$gt`,
+    `$gte`, `$lt`, `$lte`, `$in` and `$nin`. A field without a column matches nothing.
+
+    Args:
+        columns (dict): The metadata arrays by field name.
+        where (dict | None): The Chroma `where` clause.
+        size (int): The number of rows.
+
+    Returns:
+        np.ndarray | None: The boolean mask of the matching rows, or None if there is no filter.
+    """
+    if where is None:
+        return None
+    mask = np.ones(size, dtype=bool)
+    for field, condition in where.items():
+        if field == "$and":
+            for clause in condition:
+                mask &= where_mask(columns, clause, size)
+        elif field == "$or":
+            any_mask = np.zeros(size, dtype=bool)
+            for clause in condition:
+                any_mask |= where_mask(columns, clause, size)
+            mask &= any_mask
+        elif field not in columns:
+            mask[:] = False
+        else:
+            column = columns[field]
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for operator, value in condition.items():
+                if operator == "$in":
+                    mask &= np.isin(column, value)
+                elif operator == "$nin":
+                    mask &= ~np.isin(column, value)
+                else:
+                    mask &= _comparison_operators[operator](column, value)
+    return mask
+
+def write_quantized_store(path: str, ids: list, vectors: np.ndarray, metadatas: list, vector_format: str = "int8"):
+    """Writes the vectors, ids and filter columns of a catalog to a store directory.
+
+    Args:
+        path (str): The store directory, created if needed.
+        ids (list): The Chroma id of each product.
+        vectors (np.ndarray): The full-precision vectors, one per row.
+        metadatas (list): The metadata dict of each product.
+        vector_format (str, optional): "int8" or "float16". Defaults to "int8".
+
+    Raises:
+        ValueError: If the vector format is not supported.
+    """
+    if vector_format not in ("int8", "float16"):
+        raise ValueError(f"Unsupported vector format: {vector_format}")
+    os.makedirs(path, exist_ok=True)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    unit_vectors = normalize(vectors)
+    if vector_format == "int8":
+        codes, scales = quantize_int8(unit_vectors)
+        np.save(os.path.join(path, "scales.npy"), scales)
+    else:
+        codes = unit_vectors.astype(np.float16)
+    np.save(os.path.join(path, "codes.npy"), codes)
+    np.save(os.path.join(path, "vectors.npy"), vectors)
+    np.save(os.path.join(path, "ids.npy"), np.array(ids, dtype=str))
+
+    for field, dtype in filter_columns.items():
+        values = [metadata.get(field) if metadata else None for metadata in metadatas]
+        np.save(os.path.join(path, f"{field}.npy"), metadata_column(values, dtype))
+
+    with open(os.path.join(path, "format.json"), "w", encoding="utf-8") as f:
+        json.dump({"format": vector_format, "count": len(ids), "dim": int(vectors.shape[1]) if len(ids) else 0}, f)
+
+def export_quantized_store(path: str | None = None, vector_format: str | None = None) -> int:
+    """Exports the product embeddings of the Chroma collection to a quantized store.
+
+    Args:
+        path (str, optional): The store directory. Defaults to `config.quantized_store_path`.
+        vector_format (str, optional): "int8" or "float16". Defaults to `config.vector_store_format`
+            if it is one of them, otherwise "int8".
+
+    Returns:
+        int: The number of exported products.
+    """
+    from product_retriever import get_collection
+
+    path = path or config.quantized_store_path
+    if vector_format is None:
+        vector_format = config.vector_store_format if config.vector_store_format in ("int8", "float16") else "int8"
+    catalog = get_collection().get(include=["embeddings", "metadatas"])
+    write_quantized_store(path, catalog["ids"], np.asarray(catalog["embeddings"]), catalog["metadatas"], vector_format)
+    return len(catalog["ids"])
+
+class QuantizedVectorStore:
+    """A read-only, memory-mapped quantized vector store.
+
+    Attributes:
+        path (str): The store directory.
+        vector_format (str): "int8" or "float16".
+        ids (np.ndarray): The Chroma id of each row.
+        columns (dict): The metadata filter columns by field name.
+    """
+
+    # Rows scored per block, to bound the temporary float32 copy of the codes
+    block_size = 65536
+
+    def __init__(self, path: str):
+        """Memory-maps a store directory written by `write_quantized_store`.
+
+        Args:
+            path (str): The store directory.
+        """
+        self.path = path
+        with open(os.path.join(path, "format.json"), encoding="utf-8") as f:
+            self.vector_format = json.load(f)["format"]
+        self.codes = np.load(os.path.join(path, "codes.npy"), mmap_mode="r")
+        self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r") if self.vector_format == "int8" else None
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self.columns = {field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r") for field in filter_columns}
+        self._norms = None
+        self._norms_dim = None
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    def where_mask(self, where: dict | None) -> np.ndarray | None:
+        """Returns the boolean mask of the rows matching a Chroma `where` filter."""
+        return where_mask(self.columns, where, len(self))
+
+    def _truncated_norms(self, dim: int) -> np.ndarray:
+        """Returns the norm of the first `dim` components of the codes, computed once per process."""
+        if self._norms_dim != dim:
+            norms = np.empty(len(self), dtype=np.float32)
+            for start in range(0, len(self), self.block_size):
+                end = min(start + self.block_size, len(self))
+                norms[start:end] = np.linalg.norm(self.codes[start:end, :dim].astype(np.float32), axis=1)
+            self._norms, self._norms_dim = np.maximum(norms, np.finfo(np.float32).tiny), dim
+        return self._norms
+
+    def _approximate_scores(self, query: np.ndarray, rows: np.ndarray | None, dim: int | None = None) -> np.ndarray:
+        """Scores rows on the quantized codes, optionally truncated to their first `dim` components."""
+        if dim is not None:
+            query = normalize(query[:dim])
+        count = len(self) if rows is None else rows.size
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, self.block_size):
+            end = min(start + self.block_size, count)
+            block = slice(start, end) if rows is None else rows[start:end]
+            codes = self.codes[block] if dim is None else self.codes[block, :dim]
+            scores[start:end] = codes.astype(np.float32) @ query
+        if dim is not None:
+            # The truncated vectors are re-normalized, which also cancels the int8 scales
+            norms = self._truncated_norms(dim)
+            scores /= norms if rows is None else norms[rows]
+        elif self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+    def _exact_scores(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        return normalize(self.vectors[rows]) @ query
+
+    def search(self, query_vector, k: int, mask: np.ndarray | None = None) -> tuple:
+        """Finds the rows most similar to a query vector.
+
+        The approximate cosine similarities are computed on the quantized codes, then the
+        top `config.quantized_rescore_candidates` rows are re-scored with the full-precision vectors.
+        If `config.retrieval_truncate_dim` is set, the first stage only compares the first
+        dimensions of the vectors (Matryoshka truncation), re-normalized.
+
+        Args:
+            query_vector: The query embedding.
+            k (int): The number of rows to return.
+            mask (np.ndarray, optional): The boolean mask of the candidate rows. Defaults to all rows.
+
+        Returns:
+            tuple: The row indices and their cosine similarities, most similar first.
+        """
+        query = normalize(query_vector)
+        rows = np.flatnonzero(mask) if mask is not None else None
+        count = len(self) if rows is None else rows.size
+        if count == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        dim = config.retrieval_truncate_dim
+        if dim is not None and dim >= self.codes.shape[1]:
+            dim = None
+        approximate = self._approximate_scores(query, rows, dim)
+        rescore_count = min(max(k, config.quantized_rescore_candidates), count)
+        top = np.argpartition(-approximate, rescore_count - 1)[:rescore_count]
+        candidates = top if rows is None else rows[top]
+
+        exact = self._exact_scores(query, candidates)
+        order = np.argsort(-exact)[:k]
+        return candidates[order], exact[order]
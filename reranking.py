@@ -0,0 +1,251 @@
+"""
+Post-retrieval re-ranking with a cheap feature model, without LLM calls.
+
+Vector similarity alone decides which products are retrieved, and personalization only
+happens in the generation prompt. This module over-fetches candidates
+(`config.rerank_candidates`) and re-ranks them with a weighted sum of features
+(`config.rerank_weights`), computed with NumPy over all the candidates at once:
+
+- `vector`: the similarity of the product to the query embedding.
+- `bm25`: the BM25 score of the product document for the query terms, with the document
+  frequencies computed over the candidates.
+- `price`: the closeness of the product price to the price mentioned in the query.
+- `category`: the share of the product category in the customer's purchases.
+- `price_band`: the closeness of the product price to the customer's usual price band
+  (the interquartile range of their purchase prices).
+
+The customer features come from `customer_purchase_orders` and the product metadata. They
+are cached per customer for `config.preference_cache_ttl` seconds, like the customer
+preferences, and invalidated by a purchase (`invalidate_customer_profile`). Re-ranking is enabled with `config.enable_reranking`.
+
+Example Usage:
+    ```python
+    product_query = ProductQuery("evening gown", {"price_amount": "250", "comparison_operator": "$lt"})
+    documents = retrieve_ranked_products(product_query, customer_id=3)
+    ```
+"""
+
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from product_retriever import Candidates, ProductQuery, retrieve_candidates, retrieve_product_metadata_by_ids
+from purchase_history import get_purchased_items
+import re
+import threading
+import time
+import numpy as np
+import config
+
+_TOKEN = re.compile(r"\w+")
+
+class CustomerProfile:
+    """The category and price preferences of a customer, from their purchase orders.
+
+    Attributes:
+        category_shares (dict): The share of the purchased items in each category.
+        price_low (float): The first quartile of the purchase prices.
+        price_high (float): The third quartile of the purchase prices.
+    """
+
+    def __init__(self, category_shares: dict, price_low: float, price_high: float):
+        self.category_shares = category_shares
+        self.price_low = price_low
+        self.price_high = price_high
+
+    def __repr__(self) -> str:
+        return f"CustomerProfile(category_shares={self.category_shares!r}, price_band=({self.price_low:.2f}, {self.price_high:.2f}))"
+
+def profile_from_purchases(items: list, product_metadata: dict) -> CustomerProfile | None:
+    """Computes the category and price preferences from purchased items.
+
+    Args:
+        items (list): The (product_id, price, quantity) tuple of each purchased item.
+        product_metadata (dict): The metadata of the purchased products, by product id.
+
+    Returns:
+        CustomerProfile | None: The customer profile, or None if there are no items.
+    """
+    if not items:
+        return None
+    categories = Counter()
+    for product_id, _, quantity in items:
+        category = product_metadata.get(product_id, {}).get("category")
+        if category is not None:
+            categories[category] += quantity
+    total = sum(quantity for _, _, quantity in items)
+    prices = np.repeat([price for _, price, _ in items], [quantity for _, _, quantity in items])
+    price_low, price_high = np.percentile(prices, [25, 75])
+    return CustomerProfile({category: count / total for category, count in categories.items()}, float(price_low), float(price_high))
+
+def build_customer_profile(customer_id) -> CustomerProfile | None:
+    """Builds the category and price preferences of a customer from their purchase orders.
+
+    Args:
+        customer_id (int): The customer id.
+
+    Returns:
+        CustomerProfile | None: The customer profile, or None if the customer has no purchases.
+    """
+    items = get_purchased_items(customer_id)
+    if not items:
+        return None
+    product_metadata = retrieve_product_metadata_by_ids(list(dict.fromkeys(product_id for product_id, _, _ in items)))
+    return profile_from_purchases(items, product_metadata)
+
+# Customer id -> (profile, expiry time), least recently used first
+_customer_profiles = OrderedDict()
+_customer_profiles_lock = threading.Lock()
+
+def get_customer_profile(customer_id) -> CustomerProfile | None:
+    """Returns the profile of a customer, from the precomputed affinity store if enabled,
+    otherwise built from their purchases and cached for `config.preference_cache_ttl` seconds."""
+    with _customer_profiles_lock:
+        cached = _customer_profiles.get(customer_id)
+        if cached is not None and cached[1] > time.monotonic():
+            _customer_profiles.move_to_end(customer_id)
+            return cached[0]
+
+    profile = None
+    if config.enable_customer_affinity:
+        from customer_affinity import get_customer_affinity
+        affinity = get_customer_affinity(customer_id)
+        if affinity is not None:
+            profile = affinity.profile
+    if profile is None:
+        profile = build_customer_profile(customer_id)
+
+    with _customer_profiles_lock:
+        _customer_profiles[customer_id] = (profile, time.monotonic() + config.preference_cache_ttl)
+        _customer_profiles.move_to_end(customer_id)
+        while len(_customer_profiles) > config.preference_cache_size:
+            _customer_profiles.popitem(last=False)
+    return profile
+
+def invalidate_customer_profile(customer_id):
+    """Drops the cached profile of a customer, e.g. after a purchase."""
+    with _customer_profiles_lock:
+        _customer_profiles.pop(customer_id, None)
+
+@lru_cache(maxsize=16384)
+def _term_counts(document: str) -> Counter:
+    return Counter(_TOKEN.findall(document.lower()))
+
+def bm25_scores(query: str, documents: list, k1: float = 1.2, b: float = 0.75) -> np.ndarray:
+    """Scores documents for a query with BM25, with document frequencies over the given documents.
+
+    Args:
+        query (str): The query.
+        documents (list): The documents to score.
+        k1 (float, optional): The term frequency saturation. Defaults to 1.2.
+        b (float, optional): The document length normalization. Defaults to 0.75.
+
+    Returns:
+        np.ndarray: The BM25 score of each document.
+    """
+    terms = list(dict.fromkeys(_TOKEN.findall(query.lower())))
+    if not terms or not documents:
+        return np.zeros(len(documents), dtype=np.float32)
+
+    counts = [_term_counts(document) for document in documents]
+    term_frequencies = np.array([[count.get(term, 0) for term in terms] for count in counts], dtype=np.float32)
+    lengths = np.array([sum(count.values()) for count in counts], dtype=np.float32)
+
+    document_frequencies = (term_frequencies > 0).sum(axis=0)
+    idf = np.log1p((len(documents) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+    length_norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+    return (idf * term_frequencies * (k1 + 1) / (term_frequencies + length_norm[:, None])).sum(axis=1)
+
+def _min_max(values: np.ndarray) -> np.ndarray:
+    span = values.max() - values.min() if values.size else 0
+    return (values - values.min()) / span if span > 0 else np.zeros_like(values)
+
+def _price_closeness(prices: np.ndarray, low: float, high: float) -> np.ndarray:
+    """Returns 1 for the prices within [low, high], decreasing with the price ratio outside. 0 for unknown prices."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distance = np.maximum(np.log(max(low, 1e-6) / prices), 0) + np.maximum(np.log(prices / max(high, 1e-6)), 0)
+    return np.nan_to_num(np.exp(-distance), nan=0.0)
+
+def rerank_scores(product_query: ProductQuery, candidates: Candidates, customer_profile: CustomerProfile | None = None) -> np.ndarray:
+    """Computes the re-ranking score of each candidate.
+
+    Args:
+        product_query (ProductQuery): The product query the candidates were retrieved for.
+        candidates (Candidates): The retrieved candidates.
+        customer_profile (CustomerProfile, optional): The customer preferences, if known.
+
+    Returns:
+        np.ndarray: The score of each candidate (higher is better).
+    """
+    weights = config.rerank_weights
+    scores = weights.get("vector", 0) * _min_max(candidates.scores)
+    scores += weights.get("bm25", 0) * _min_max(bm25_scores(product_query.query, candidates.documents))
+
+    if product_query.price_amount is not None:
+        price_amount = float(product_query.price_amount)
+        scores += weights.get("price", 0) * _price_closeness(candidates.prices, price_amount, price_amount)
+
+    if customer_profile is not None:
+        shares = np.array([customer_profile.category_shares.get(category, 0.0) for category in candidates.categories], dtype=np.float32)
+        if shares.size and shares.max() > 0:
+            scores += weights.get("category", 0) * shares / shares.max()
+        scores += weights.get("price_band", 0) * _price_closeness(candidates.prices, customer_profile.price_low, customer_profile.price_high)
+    return scores
+
+def rerank(product_query: ProductQuery, candidates: Candidates, customer_profile: CustomerProfile | None = None, max_results: int = 4) -> list:
+    """Re-ranks candidates and returns the documents of the best ones.
+
+    Args:
+        product_query (ProductQuery): The product query the candidates were retrieved for.
+        candidates (Candidates): The retrieved candidates.
+        customer_profile (CustomerProfile, optional): The customer preferences, if known.
+        max_results (int, optional): The maximum number of documents to return. Defaults to 4.
+
+    Returns:
+        list: The documents of the best candidates, best first.
+    """
+    if len(candidates) == 0:
+        return []
+    order = np.argsort(-rerank_scores(product_query, candidates, customer_profile), kind="stable")[:max_results]
+    return [candidates.documents[index] for index in order.tolist()]
+
+def candidate_count(max_results: int = 4) -> int:
+    """Returns the number of candidates to retrieve for `max_results` results."""
+    return max(config.rerank_candidates, max_results) if config.enable_reranking else max_results
+
+def rank_candidates(product_query: ProductQuery, candidates: Candidates, customer_id=None, max_results: int = 4) -> list:
+    """Selects the documents to show among candidates, re-ranking them if enabled.
+
+    Args:
+        product_query (ProductQuery): The product query the candidates were retrieved for.
+        candidates (Candidates): The retrieved candidates.
+        customer_id (int, optional): The customer id, for the personalized features.
+        max_results (int, optional): The maximum number of documents to return. Defaults to 4.
+
+    Returns:
+        list: The documents to show, best first.
+    """
+    if not config.enable_reranking:
+        return candidates.documents[:max_results]
+    customer_profile = get_customer_profile(customer_id) if customer_id is not None else None
+    return rerank(product_query, candidates, customer_profile, max_results)
+
+def get_affinity_vector(customer_id) -> np.ndarray | None:
+    """Returns the affinity vector of a customer to blend into the query vector, if personalized retrieval is enabled."""
+    if not config.enable_customer_affinity or customer_id is None:
+        return None
+    from customer_affinity import get_customer_affinity
+    affinity = get_customer_affinity(customer_id)
+    return affinity.vector if affinity is not None else None
+
+def retrieve_ranked_products(product_query: ProductQuery, customer_id=None, max_results: int = 4) -> list:
+    """Retrieves products for a product query, personalized and re-ranked for the customer if enabled.
+
+    Args:
+        product_query (ProductQuery): A ProductQuery instance that defines the search parameters.
+        customer_id (int, optional): The customer id, for the personalized features.
+        max_results (int, optional): The maximum number of results to return. Defaults to 4.
+
+    Returns:
+        list: The product documents, best first.
+    """
+    candidates = retrieve_candidates(product_query, candidate_count(max_results), get_affinity_vector(customer_id))
+    return rank_candidates(product_query, candidates, customer_id, max_results)
@@ -1,29 +1,63 @@
 import config
 from product_retriever import ProductQuery
 from langchain_ollama import ChatOllama
+from prompt_templates import PromptTemplate, record_timing, stage_llm_kwargs
+from stage_budget import interactive_call
+from llm_scheduler import llm_slot
+from typing import Iterator
 
 # Initialize the Ollama LLM with the Llama 3 model
-llm = ChatOllama(model="llama3.2", temperature=0, num_ctx = 24576)
+llm = ChatOllama(**stage_llm_kwargs("response", model="llama3.2", temperature=0))
 
-def generate_response(product_query: ProductQuery, search_results: str, customer_preferences: str) -> str:
-    
-    # System prompt
-    system_prompt = f"You are a personal fashion stylist. Your task is to explain how each of the recommended products match the user query. Include the name, color, material of each product. Do not forget to mention the price for each product. Recommended products: {search_results}."
-    generate_user_message_query = f"User query: {product_query.query}."
+# The system prompt is static, and the variable content comes last, from the most stable
+# (the customer preferences) to the most variable (the query), for prompt-prefix reuse
+response_prompt = PromptTemplate(
+    system=(
+        "You are a personal fashion stylist. Your task is to explain how each of the recommended products match the user query. "
+        "Include the name, color, material of each product. Do not forget to mention the price for each product. "
+        "When customer preferences are given, personalise the answer by using customer preferences. Do not mention the categories."
+    ),
+    user=[
+        "Here are the customer preferences: {customer_preferences}. ",
+        "Recommended products: {search_results}.",
+        "User query: {query}.",
+    ],
+    assistant="Your answer:"
+)
+
+def build_messages(product_query: ProductQuery, search_results: str, customer_preferences: str) -> list:
 
-    # User messages
-    user_messages = [{"role": "user", "content": generate_user_message_query}]
+    # If enabled, personalise the results using customer preferences from purchase history
+    if not config.enable_purchase_history:
+        customer_preferences = None
 
-    # If enabled, personalise the results using customer preferences from purchase history 
-    if config.enable_purchase_history and customer_preferences is not None:
-        generate_user_message_customer_preferences = f"Here are the customer preferences: {customer_preferences}. "
-        user_messages.append({"role": "user", "content": generate_user_message_customer_preferences})
-        system_prompt = system_prompt + "\n\nPersonalise the answer by using customer preferences. Do not mention the categories."
+    return response_prompt.messages(
+        customer_preferences=customer_preferences,
+        search_results=search_results,
+        query=product_query.query
+    )
+
+def generate_response(product_query: ProductQuery, search_results: str, customer_preferences: str) -> str:
 
     # Generate response
-    response = llm.invoke(
-        [{"role": "system", "content": system_prompt}] 
-        + user_messages 
-        + [{"role": "assistant", "content": "Your answer:"}])
+    with llm_slot("response"), interactive_call():
+        response = llm.invoke(build_messages(product_query, search_results, customer_preferences))
+    record_timing("response", response)
+
+    return response.content
+
+def retrieval_only_response(product_query: ProductQuery, search_results: str, customer_preferences: str | None = None) -> str:
+
+    # Degraded response without generation, when the LLM backend sheds load (see llm_scheduler.py)
+    if not search_results:
+        return "No products match your search."
+    return f"Here are the products matching your search:\n\n{search_results}"
+
+def stream_response(product_query: ProductQuery, search_results: str, customer_preferences: str) -> Iterator[str]:
 
-    return response.content
\ No newline at end of file
+    # Generate response, yielding the text as it is decoded
+    with llm_slot("response"), interactive_call():
+        for chunk in llm.stream(build_messages(product_query, search_results, customer_preferences)):
+            # The final chunk carries the timing metadata
+            record_timing("response", chunk)
+            yield chunk.content
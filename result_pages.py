@@ -0,0 +1,122 @@
+"""
+Cursor-based pagination of the search results.
+
+`retrieve_products` returns a single page of `max_results` products. Showing the next page
+by re-querying with a larger `n_results` re-embeds the query and re-searches the catalog
+for every page, and the cost grows with the page number. This module retrieves and ranks
+the candidates of a query once, up to `config.page_max_results`, and caches the ranked list
+under an opaque cursor. The following pages are sliced from the cached list, without
+embedding or searching again.
+
+A ranked list is kept `config.page_cache_ttl` seconds after its last page was served, and
+at most `config.page_cache_size` lists are kept (least recently used first out). The cache
+is local to the process: the cursors are meant for the long-running search service.
+
+Dependencies:
+    - product_retriever.py (ProductQuery, retrieve_candidates)
+    - reranking.py (candidate ranking and customer affinity)
+
+Example Usage:
+    ```python
+    page = first_page(ProductQuery("black wool coat"), customer_id=3)
+    while page.cursor is not None:
+        page = next_page(page.cursor)
+    ```
+"""
+
+from collections import OrderedDict
+from product_retriever import ProductQuery, retrieve_candidates
+from reranking import get_affinity_vector, rank_candidates
+import secrets
+import threading
+import time
+import config
+
+class ResultPage:
+    """A page of ranked search results.
+
+    Attributes:
+        documents (list): The product documents of the page.
+        offset (int): The rank of the first product of the page, from 0.
+        total (int): The number of ranked products available across the pages.
+        cursor (str | None): The cursor of the next page, or None if this is the last page.
+    """
+
+    def __init__(self, documents: list, offset: int, total: int, cursor: str | None):
+        self.documents = documents
+        self.offset = offset
+        self.total = total
+        self.cursor = cursor
+
+    def __repr__(self) -> str:
+        return f"ResultPage(offset={self.offset}, documents={len(self.documents)}, total={self.total}, cursor={self.cursor!r})"
+
+# Ranked documents by cursor token, with the time they expire at, least recently used first
+_ranked_lists = OrderedDict()
+_ranked_lists_lock = threading.Lock()
+
+def _store(documents: list) -> str:
+    token = secrets.token_urlsafe(12)
+    with _ranked_lists_lock:
+        _ranked_lists[token] = (documents, time.monotonic() + config.page_cache_ttl)
+        while len(_ranked_lists) > config.page_cache_size:
+            _ranked_lists.popitem(last=False)
+    return token
+
+def _load(token: str) -> list | None:
+    now = time.monotonic()
+    with _ranked_lists_lock:
+        entry = _ranked_lists.get(token)
+        if entry is None:
+            return None
+        documents, expires_at = entry
+        if expires_at <= now:
+            del _ranked_lists[token]
+            return None
+        _ranked_lists[token] = (documents, now + config.page_cache_ttl)
+        _ranked_lists.move_to_end(token)
+        return documents
+
+def _page(token: str, documents: list, offset: int, page_size: int) -> ResultPage:
+    end = offset + page_size
+    cursor = f"{token}:{end}" if end < len(documents) else None
+    return ResultPage(documents[offset:end], offset, len(documents), cursor)
+
+def first_page(product_query: ProductQuery, customer_id=None, page_size: int | None = None) -> ResultPage:
+    """Retrieves and ranks the products of a query, and returns the first page.
+
+    Args:
+        product_query (ProductQuery): A ProductQuery instance that defines the search parameters.
+        customer_id (int, optional): The customer id, for the personalized ranking.
+        page_size (int, optional): The number of products per page. Defaults to `config.page_size`.
+
+    Returns:
+        ResultPage: The first page, with the cursor of the next page.
+    """
+    page_size = page_size or config.page_size
+    candidates = retrieve_candidates(product_query, max(config.page_max_results, page_size), get_affinity_vector(customer_id))
+    documents = rank_candidates(product_query, candidates, customer_id, len(candidates))
+    token = _store(documents) if len(documents) > page_size else None
+    return _page(token, documents, 0, page_size)
+
+def next_page(cursor: str, page_size: int | None = None) -> ResultPage | None:
+    """Returns the page of a cursor, sliced from the cached ranked list.
+
+    Args:
+        cursor (str): The cursor returned with the previous page.
+        page_size (int, optional): The number of products per page. Defaults to `config.page_size`.
+
+    Returns:
+        ResultPage | None: The page, or None if the cursor has expired.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    page_size = page_size or config.page_size
+    token, _, offset = cursor.rpartition(":")
+    if not token or not offset.isdigit():
+        raise ValueError(f"Malformed cursor: {cursor!r}")
+    documents = _load(token)
+    if documents is None:
+        return None
+    return _page(token, documents, int(offset), page_size)
@@ -0,0 +1,290 @@
+"""
+Offline evaluation of the retrieval quality and latency.
+
+This module replays a labelled query set against the retrieval and reports, for a
+configuration or several configuration variants (e.g. metadata extraction on and off,
+another `max_results` or vector store format):
+
+- `recall@k`: the share of the relevant products of a query found in its top k results.
+- `ndcg@k`: the normalized discounted cumulative gain of the top k results (binary relevance).
+- `filter_precision`: the share of the results of the filtered queries that satisfy the
+  filters of the product query, e.g. whether their `price_regular` respects the extracted
+  comparison operator and price.
+- `metadata_accuracy`: the share of the queries whose extracted metadata equals the labelled
+  metadata, for the cases labelled with it.
+- The 50th, 95th and 99th percentile latency (ms) of the pre-retrieval and retrieval stages.
+
+Retrieval is served from a catalog snapshot (see catalog_snapshot.py), whose vector format
+(int8 or float16) is the one it was written with. For offline runs without Ollama,
+`build_evaluation_snapshot` writes a snapshot of a catalog file with the deterministic
+`HashingEmbeddings`, and the same embeddings replace the Ollama model while evaluating. With
+the LLM stages disabled (or `use_labelled_metadata`), no model is called. On the command line,
+the variants overriding `vector_store_format` are evaluated on a snapshot of the catalog
+written in that format. The results are matched to the labelled products by id, so products
+with the same document are told apart.
+
+Input files (JSON lines):
+    - Labelled queries: {"query": "...", "relevant_keys": [12, 40], "metadata": {"price_amount":
+      "250", "comparison_operator": "$lt", "category": "Dresses"}}, with `metadata` optional.
+    - Catalog: {"id": "...", "document": "...", "metadata": {"key": 12, "price_regular": 250.0,
+      "gender": "women", "category": "Dresses"}}.
+
+Example Usage:
+    ```bash
+    python retrieval_evaluation.py --queries eval_queries.jsonl --catalog eval_catalog.jsonl \\
+        --snapshot ./eval_snapshot --stub-embeddings --labelled-metadata \\
+        --variant baseline={} --variant int8='{"vector_store_format": "int8"}'
+    ```
+"""
+
+from contextlib import contextmanager
+from product_retriever import ProductQuery, build_where_clause, get_quantized_store, reset_catalog, retrieve_candidates
+from product_search import prepare_query
+from catalog_snapshot import write_catalog_snapshot
+import argparse
+import json
+import time
+import zlib
+import re
+import numpy as np
+import product_retriever
+import config
+
+_TOKEN = re.compile(r"\w+")
+
+class HashingEmbeddings:
+    """Deterministic bag-of-words embeddings, for offline evaluation without an embeddings model.
+
+    Each token is hashed (CRC32) to a dimension and a sign, so texts sharing tokens have
+    similar vectors, and the vectors are the same across runs and processes.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _embed(self, text: str) -> list:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in _TOKEN.findall(text.lower()):
+            digest = zlib.crc32(token.encode("utf-8"))
+            vector[digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self._embed(text)
+
+class EvaluationCase:
+    """A labelled query.
+
+    Attributes:
+        query (str): The user search query.
+        relevant_keys (set): The keys of the relevant products.
+        metadata (dict | None): The expected metadata of the product query, if labelled.
+    """
+
+    def __init__(self, query: str, relevant_keys, metadata: dict | None = None):
+        self.query = query
+        self.relevant_keys = set(relevant_keys)
+        self.metadata = metadata
+
+    def __repr__(self) -> str:
+        return f"EvaluationCase(query={self.query!r}, relevant_keys={len(self.relevant_keys)})"
+
+def _read_jsonl(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def load_cases(path: str) -> list:
+    """Loads the labelled queries of a JSON lines file.
+
+    Args:
+        path (str): The file path.
+
+    Returns:
+        list: The EvaluationCase of each line.
+    """
+    return [EvaluationCase(row["query"], row.get("relevant_keys", []), row.get("metadata")) for row in _read_jsonl(path)]
+
+def build_evaluation_snapshot(catalog_path: str, snapshot_path: str, embeddings=None, vector_format: str = "float16") -> int:
+    """Writes a catalog snapshot of a JSON lines catalog file.
+
+    Args:
+        catalog_path (str): The catalog file, one product per line.
+        snapshot_path (str): The snapshot directory.
+        embeddings (optional): The embeddings model of the documents. Defaults to `HashingEmbeddings()`.
+        vector_format (str, optional): "int8" or "float16". Defaults to "float16".
+
+    Returns:
+        int: The number of products in the snapshot.
+    """
+    embeddings = embeddings or HashingEmbeddings()
+    products = _read_jsonl(catalog_path)
+    documents = [product["document"] for product in products]
+    write_catalog_snapshot(
+        snapshot_path,
+        [str(product.get("id", index)) for index, product in enumerate(products)],
+        np.asarray(embeddings.embed_documents(documents), dtype=np.float32),
+        documents,
+        [product.get("metadata", {}) for product in products],
+        vector_format
+    )
+    return len(products)
+
+@contextmanager
+def evaluation_settings(overrides: dict | None = None, embeddings=None):
+    """Applies configuration overrides and an embeddings model while evaluating, then restores them.
+
+    Args:
+        overrides (dict, optional): The `config` settings to override.
+        embeddings (optional): The embeddings model of the queries. Defaults to the Ollama model.
+    """
+    overrides = overrides or {}
+    previous = {name: getattr(config, name) for name in overrides}
+    previous_embeddings = product_retriever.embeddings
+    try:
+        for name, value in overrides.items():
+            setattr(config, name, value)
+        if embeddings is not None:
+            product_retriever.embeddings = embeddings
+        reset_catalog()
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(config, name, value)
+        product_retriever.embeddings = previous_embeddings
+        reset_catalog()
+
+def _ndcg(relevance: list, relevant_count: int, k: int) -> float:
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    ideal = discounts[:min(relevant_count, k)].sum()
+    return float(np.dot(relevance[:k], discounts[:len(relevance[:k])]) / ideal) if ideal > 0 else 0.0
+
+def _percentiles(latencies: list) -> dict:
+    if not latencies:
+        return {}
+    return {f"p{q}_ms": float(np.percentile(latencies, q)) for q in (50, 95, 99)}
+
+def evaluate(cases: list, k: int = 4, use_labelled_metadata: bool = False) -> dict:
+    """Replays labelled queries against the retrieval and computes the quality and latency metrics.
+
+    Retrieval must be served from a catalog snapshot (`config.catalog_snapshot_path`).
+
+    Args:
+        cases (list): The EvaluationCase of each query.
+        k (int, optional): The number of results per query. Defaults to 4.
+        use_labelled_metadata (bool, optional): Whether to search with the labelled metadata
+            of the cases instead of running the pre-retrieval stages. Defaults to False.
+
+    Returns:
+        dict: The mean recall@k, nDCG@k, filter precision and metadata accuracy, and the
+            latency percentiles of the pre-retrieval and retrieval stages.
+
+    Raises:
+        ValueError: If no catalog snapshot is configured.
+    """
+    if config.catalog_snapshot_path is None:
+        raise ValueError("The evaluation needs a catalog snapshot: set config.catalog_snapshot_path")
+    snapshot = get_quantized_store()
+    row_by_id = {product_id: row for row, product_id in enumerate(snapshot.ids.tolist())}
+    keys = np.asarray(snapshot.columns["key"])
+
+    recalls, ndcgs, metadata_matches = [], [], []
+    filtered_results, filtered_correct = 0, 0
+    prepare_latencies, retrieve_latencies = [], []
+    for case in cases:
+        start = time.perf_counter()
+        if use_labelled_metadata and case.metadata is not None:
+            product_query = ProductQuery(case.query, case.metadata)
+        else:
+            product_query = prepare_query(case.query)
+            if case.metadata is not None:
+                metadata_matches.append(product_query.metadata == ProductQuery(case.query, case.metadata).metadata)
+        prepared = time.perf_counter()
+        candidates = retrieve_candidates(product_query, k)
+        retrieved = time.perf_counter()
+        prepare_latencies.append((prepared - start) * 1000)
+        retrieve_latencies.append((retrieved - prepared) * 1000)
+
+        rows = [row_by_id[product_id] for product_id in candidates.ids if product_id in row_by_id]
+        relevance = [1.0 if int(keys[row]) in case.relevant_keys else 0.0 for row in rows]
+        if case.relevant_keys:
+            recalls.append(sum(relevance) / len(case.relevant_keys))
+            ndcgs.append(_ndcg(relevance, len(case.relevant_keys), k))
+
+        mask = snapshot.where_mask(build_where_clause(product_query))
+        if mask is not None:
+            filtered_results += len(rows)
+            filtered_correct += int(mask[rows].sum()) if rows else 0
+
+    return {
+        "queries": len(cases),
+        "k": k,
+        f"recall@{k}": float(np.mean(recalls)) if recalls else None,
+        f"ndcg@{k}": float(np.mean(ndcgs)) if ndcgs else None,
+        "filter_precision": filtered_correct / filtered_results if filtered_results else None,
+        "metadata_accuracy": float(np.mean(metadata_matches)) if metadata_matches else None,
+        "pre_retrieval": _percentiles(prepare_latencies),
+        "retrieval": _percentiles(retrieve_latencies),
+    }
+
+def compare(cases: list, variants: dict, k: int = 4, use_labelled_metadata: bool = False, embeddings=None) -> dict:
+    """Evaluates several configuration variants on the same labelled queries.
+
+    Args:
+        cases (list): The EvaluationCase of each query.
+        variants (dict): The `config` overrides of each variant, by name.
+        k (int, optional): The number of results per query. Defaults to 4.
+        use_labelled_metadata (bool, optional): Whether to search with the labelled metadata.
+        embeddings (optional): The embeddings model of the queries. Defaults to the Ollama model.
+
+    Returns:
+        dict: The report of `evaluate` for each variant, by name.
+    """
+    reports = {}
+    for name, overrides in variants.items():
+        with evaluation_settings(overrides, embeddings):
+            reports[name] = evaluate(cases, k, use_labelled_metadata)
+    return reports
+
+def _parse_variant(value: str) -> tuple:
+    name, _, overrides = value.partition("=")
+    return name, json.loads(overrides) if overrides else {}
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline evaluation of the retrieval quality and latency")
+    parser.add_argument("--queries", required=True, help="JSON lines file of labelled queries")
+    parser.add_argument("--snapshot", default=config.catalog_snapshot_path, help="Catalog snapshot directory")
+    parser.add_argument("--catalog", help="JSON lines catalog to build the snapshot from")
+    parser.add_argument("--stub-embeddings", action="store_true", help="Use deterministic hashing embeddings instead of Ollama")
+    parser.add_argument("--labelled-metadata", action="store_true", help="Search with the labelled metadata instead of the LLM stages")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--variant", action="append", type=_parse_variant,
+                        help='Configuration variant as name=JSON overrides, e.g. fast=\'{"enable_metadata_extraction": false}\'')
+    args = parser.parse_args()
+    if args.snapshot is None:
+        parser.error("--snapshot is required")
+
+    embeddings = HashingEmbeddings() if args.stub_embeddings else None
+    variants = dict(args.variant or [("current", {})])
+    # The vector format of a snapshot is fixed when it is written: one snapshot per format
+    formats = {overrides["vector_store_format"] for overrides in variants.values() if overrides.get("vector_store_format") in ("int8", "float16")}
+    if formats and not args.catalog:
+        parser.error("--catalog is required to build a snapshot for the vector_store_format variants")
+    if args.catalog:
+        count = build_evaluation_snapshot(args.catalog, args.snapshot, embeddings or product_retriever.embeddings)
+        print(f"Built a snapshot of {count} products in {args.snapshot}")
+        for vector_format in sorted(formats):
+            build_evaluation_snapshot(args.catalog, f"{args.snapshot}-{vector_format}", embeddings or product_retriever.embeddings, vector_format)
+            print(f"Built a {vector_format} snapshot in {args.snapshot}-{vector_format}")
+
+    for overrides in variants.values():
+        vector_format = overrides.get("vector_store_format")
+        overrides.setdefault("catalog_snapshot_path", f"{args.snapshot}-{vector_format}" if vector_format in formats else args.snapshot)
+    reports = compare(load_cases(args.queries), variants, args.k, args.labelled_metadata, embeddings)
+    print(json.dumps(reports, indent=2))
+
+if __name__ == "__main__":
+    main()
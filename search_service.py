@@ -0,0 +1,387 @@
+"""
+Long-running asynchronous HTTP service for the product search.
+
+The service keeps the LLM clients, the embeddings model and the Chroma vector store warm
+across requests, and runs the pipeline stages asynchronously so that concurrent requests
+overlap. It is built on the standard library only (`asyncio` streams), and exposes:
+
+- `GET|POST /search?customer_id=3&query=...`: runs the full search and returns a JSON object.
+- `GET|POST /search/stream?customer_id=3&query=...`: runs the search and streams newline-delimited
+  JSON events as each stage completes, then the generated response as it is decoded.
+- `GET /search/page?customer_id=3&query=...&page_size=4`: returns the first page of the ranked
+  products, without generating a response, with the `cursor` of the next page. The next
+  pages are requested with `GET /search/page?cursor=...` (see result_pages.py).
+- `GET /preferences/{customer_id}`: returns the fashion preferences of a customer.
+- `POST /preferences/{customer_id}?event=purchase|activity`: queues the customer for the
+  background extraction of their preferences, ahead of their searches (see preference_worker.py).
+  The first page requests of a customer queue them too. A purchase also drops the cached
+  re-ranking profile of the customer (see reranking.py).
+
+The search endpoints accept a `tenant` parameter to search another brand catalog than
+`config.default_tenant` (see tenants.py).
+
+When the LLM queue is deep (see llm_scheduler.py), new searches shed load: they skip the LLM
+stages and respond with the retrieved products only, flagged `degraded`.
+
+The searches run the stage graph of pipeline.py from a bounded thread pool
+(`config.service_max_workers`), so that they share its configuration, stage swaps and
+memoization. Customer preferences are extracted concurrently with pre-retrieval and retrieval.
+A streamed response is generated outside the graph, from the stage outputs, since a stage
+produces a single value. Every request is
+bounded by `config.service_request_timeout`, and is cancelled if the client disconnects, so
+that no further stage is started for it.
+
+Example Usage:
+    ```bash
+    python search_service.py --port 8000
+    curl "http://127.0.0.1:8000/search?customer_id=3&query=Elegant+navy+evening+gown+below+250"
+    ```
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from product_search import prepare_query
+from product_retriever import ProductQuery, open_catalog, embeddings
+from reranking import invalidate_customer_profile
+from result_pages import ResultPage, first_page, next_page
+from purchase_history import extract_fashion_preferences
+from preference_worker import get_preference_worker, notify_activity, notify_purchase
+from response_generation import retrieval_only_response, stream_response
+from pipeline import iter_pipeline
+from llm_scheduler import record_shed, should_shed
+from typing import AsyncIterator
+import argparse
+import asyncio
+import functools
+import json
+import threading
+import config
+
+_executor = ThreadPoolExecutor(max_workers=config.service_max_workers, thread_name_prefix="search-stage")
+
+_HTTP_STATUS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 410: "Gone", 500: "Internal Server Error", 504: "Gateway Timeout"}
+
+_END_OF_STREAM = object()
+
+# The stage outputs sent as search events, in graph order
+_STAGE_EVENTS = ("product_query", "search_results", "customer_preferences", "response")
+
+async def _run_stage(function, *args):
+    """Runs a blocking pipeline stage in the stage thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(function, *args))
+
+async def _stream_stage(function, *args) -> AsyncIterator:
+    """Runs a blocking generator stage in the stage thread pool, yielding its items."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = threading.Event()
+
+    def produce():
+        try:
+            for item in function(*args):
+                if cancelled.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+            loop.call_soon_threadsafe(queue.put_nowait, (_END_OF_STREAM, None))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (_END_OF_STREAM, e))
+
+    loop.run_in_executor(_executor, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _END_OF_STREAM:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        cancelled.set()
+
+async def get_preferences(customer_id, degraded: bool = False) -> str | None:
+    """Extracts the customer preferences, if personalization is enabled and the search is not degraded."""
+    if not config.enable_purchase_history or degraded:
+        return None
+    return await _run_stage(extract_fashion_preferences, customer_id)
+
+def _product_query_as_dict(product_query: ProductQuery) -> dict:
+    return {"query": product_query.query, "metadata": product_query.metadata}
+
+async def search_events(customer_id, query: str, stream: bool = False, tenant: str | None = None) -> AsyncIterator[dict]:
+    """Runs the search pipeline asynchronously, yielding an event as each stage completes.
+
+    Args:
+        customer_id (int): The customer id.
+        query (str): The user search query.
+        stream (bool, optional): Whether to yield the response in chunks as it is decoded.
+            Defaults to False.
+        tenant (str, optional): The brand catalog to search. Defaults to the default tenant.
+
+    Yields:
+        dict: The events `product_query`, `search_results` and `customer_preferences` in the
+            order their stages complete, then either one `response` event or several
+            `response_chunk` events. When the LLM queue is deep (see llm_scheduler.py), a
+            `degraded` event comes first, and the search skips the LLM stages and responds
+            with the retrieved products only.
+    """
+    # A streamed response is generated outside the stage graph, whose stages produce one value
+    outputs = _STAGE_EVENTS[:-1] if stream else _STAGE_EVENTS
+    values = {}
+    async for name, value in _stream_stage(iter_pipeline, {"query": query, "customer_id": customer_id, "tenant": tenant}, None, outputs):
+        values[name] = value
+        if name == "degraded" and value:
+            yield {"event": "degraded", "degraded": True}
+        elif name == "product_query":
+            yield {"event": name, name: _product_query_as_dict(value)}
+        elif name in _STAGE_EVENTS:
+            yield {"event": name, name: value}
+    if not stream:
+        return
+
+    # --- Generation ---
+    search_results = "\n\n".join(values["search_results"])
+    if values["degraded"]:
+        yield {"event": "response_chunk", "content": retrieval_only_response(values["product_query"], search_results)}
+    else:
+        async for chunk in _stream_stage(stream_response, values["product_query"], search_results, values["customer_preferences"]):
+            yield {"event": "response_chunk", "content": chunk}
+
+async def search(customer_id, query: str, tenant: str | None = None) -> dict:
+    """Runs the search pipeline asynchronously and returns all the stage outputs.
+
+    Args:
+        customer_id (int): The customer id.
+        query (str): The user search query.
+        tenant (str, optional): The brand catalog to search. Defaults to the default tenant.
+
+    Returns:
+        dict: The retrieval query, search results, customer preferences and generated response.
+    """
+    result = {"customer_id": customer_id, "query": query}
+    async for event in search_events(customer_id, query, tenant=tenant):
+        event.pop("event")
+        result.update(event)
+    return result
+
+async def search_page(customer_id, query: str | None, cursor: str | None = None, page_size: int | None = None, tenant: str | None = None) -> ResultPage | None:
+    """Returns a page of ranked products: the first page of a query, or the page of a cursor.
+
+    Args:
+        customer_id (int): The customer id, for the personalized ranking of the first page.
+        query (str | None): The user search query, for the first page.
+        cursor (str, optional): The cursor of the page, returned with the previous page.
+        page_size (int, optional): The number of products per page. Defaults to `config.page_size`.
+        tenant (str, optional): The brand catalog to search, for the first page. Defaults to the default tenant.
+
+    Returns:
+        ResultPage | None: The page, or None if the cursor has expired.
+    """
+    if cursor is not None:
+        return next_page(cursor, page_size)
+    # A browsing customer is likely to search next
+    notify_activity(customer_id)
+    if should_shed():
+        record_shed()
+        product_query = ProductQuery(query, tenant=tenant)
+    else:
+        product_query = await _run_stage(prepare_query, query, tenant)
+    return await _run_stage(first_page, product_query, customer_id, page_size)
+
+async def _read_request(reader: asyncio.StreamReader) -> tuple | None:
+    """Reads an HTTP request, returning its method, path and parameters."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    url = urlsplit(target)
+    params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+    content_length = int(headers.get("content-length", 0))
+    if content_length > 0:
+        body = await reader.readexactly(content_length)
+        if headers.get("content-type", "").startswith("application/json"):
+            payload = json.loads(body)
+            if not isinstance(payload, dict):
+                raise ValueError("The JSON body must be an object")
+            params.update(payload)
+        else:
+            params.update({name: values[-1] for name, values in parse_qs(body.decode("utf-8")).items()})
+    return method.upper(), url.path, params
+
+def _write_head(writer: asyncio.StreamWriter, status: int, content_type: str, content_length: int | None = None):
+    head = [f"HTTP/1.1 {status} {_HTTP_STATUS[status]}", f"Content-Type: {content_type}", "Connection: close"]
+    if content_length is None:
+        head.append("Transfer-Encoding: chunked")
+    else:
+        head.append(f"Content-Length: {content_length}")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+
+async def _send_json(writer: asyncio.StreamWriter, status: int, payload: dict):
+    body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+    _write_head(writer, status, "application/json; charset=utf-8", len(body))
+    writer.write(body)
+    await writer.drain()
+
+async def _send_chunk(writer: asyncio.StreamWriter, payload: dict):
+    data = (json.dumps(payload, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+    writer.write(f"{len(data):X}\r\n".encode("latin-1") + data + b"\r\n")
+    await writer.drain()
+
+def _parse_customer_id(value):
+    """Parses the customer id of a request, None for an anonymous request.
+
+    Raises:
+        ValueError: If the customer id is not an integer.
+    """
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid customer_id: {value!r}") from None
+
+async def _route(method: str, path: str, params: dict, writer: asyncio.StreamWriter):
+    """Dispatches a request to its endpoint and writes the response."""
+    timeout = config.service_request_timeout
+    tenant = params.get("tenant") or None
+    if tenant is not None and tenant not in config.tenants:
+        return await _send_json(writer, 404, {"error": f"Unknown tenant: {tenant}"})
+
+    if path.startswith("/preferences/"):
+        if method not in ("GET", "POST"):
+            return await _send_json(writer, 405, {"error": "Method not allowed"})
+        try:
+            customer_id = _parse_customer_id(path[len("/preferences/"):])
+        except ValueError as e:
+            return await _send_json(writer, 400, {"error": str(e)})
+        if method == "POST":
+            event = params.get("event", "activity")
+            if event not in ("purchase", "activity"):
+                return await _send_json(writer, 400, {"error": f"Unknown event: {event}"})
+            if event == "purchase":
+                invalidate_customer_profile(customer_id)
+            queued = notify_purchase(customer_id) if event == "purchase" else notify_activity(customer_id)
+            return await _send_json(writer, 202, {"customer_id": customer_id, "queued": queued})
+        preferences = await asyncio.wait_for(get_preferences(customer_id), timeout)
+        return await _send_json(writer, 200, {"customer_id": customer_id, "preferences": preferences})
+
+    if path == "/search/page":
+        if method != "GET":
+            return await _send_json(writer, 405, {"error": "Method not allowed"})
+        if not params.get("query") and not params.get("cursor"):
+            return await _send_json(writer, 400, {"error": "Missing query or cursor"})
+        try:
+            page_size = int(params["page_size"]) if params.get("page_size") else None
+            if page_size is not None and page_size < 1:
+                raise ValueError("page_size must be positive")
+            page = await asyncio.wait_for(
+                search_page(_parse_customer_id(params.get("customer_id")), params.get("query"), params.get("cursor"), page_size, tenant),
+                timeout
+            )
+        except ValueError as e:
+            return await _send_json(writer, 400, {"error": str(e)})
+        if page is None:
+            return await _send_json(writer, 410, {"error": "Cursor expired"})
+        return await _send_json(writer, 200, {
+            "search_results": page.documents, "offset": page.offset, "total": page.total, "cursor": page.cursor
+        })
+
+    if path not in ("/search", "/search/stream"):
+        return await _send_json(writer, 404, {"error": "Not found"})
+    if method not in ("GET", "POST"):
+        return await _send_json(writer, 405, {"error": "Method not allowed"})
+    if not params.get("query"):
+        return await _send_json(writer, 400, {"error": "Missing query"})
+    try:
+        customer_id = _parse_customer_id(params.get("customer_id"))
+    except ValueError as e:
+        return await _send_json(writer, 400, {"error": str(e)})
+
+    if path == "/search":
+        result = await asyncio.wait_for(search(customer_id, params["query"], tenant), timeout)
+        return await _send_json(writer, 200, result)
+
+    # The headers are sent before the first stage completes, so a failure ends the stream with an error event
+    _write_head(writer, 200, "application/x-ndjson; charset=utf-8")
+    try:
+        async with asyncio.timeout(timeout):
+            async for event in search_events(customer_id, params["query"], stream=True, tenant=tenant):
+                await _send_chunk(writer, event)
+    except TimeoutError:
+        await _send_chunk(writer, {"event": "error", "error": "Request timed out"})
+    except Exception as e:
+        print(f"Error streaming search: {e}")
+        await _send_chunk(writer, {"event": "error", "error": str(e)})
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Serves one HTTP request, cancelling it if the client disconnects first."""
+    try:
+        try:
+            request = await _read_request(reader)
+        except (ValueError, json.JSONDecodeError):
+            return await _send_json(writer, 400, {"error": "Malformed request"})
+        if request is None:
+            return
+
+        handler = asyncio.ensure_future(_route(*request, writer))
+        disconnected = asyncio.ensure_future(reader.read())
+        await asyncio.wait({handler, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        disconnected.cancel()
+        if not handler.done():
+            handler.cancel()
+            return
+
+        try:
+            handler.result()
+        except (TimeoutError, asyncio.TimeoutError):
+            await _send_json(writer, 504, {"error": "Request timed out"})
+        except Exception as e:
+            print(f"Error handling request: {e}")
+            await _send_json(writer, 500, {"error": str(e)})
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+def warm_up():
+    """Opens the vector store and loads the embeddings model before serving requests."""
+    open_catalog()
+    embeddings.embed_query("warm up")
+
+async def serve(host: str | None = None, port: int | None = None):
+    """Starts the HTTP service and serves requests until cancelled.
+
+    Args:
+        host (str, optional): The interface to listen on. Defaults to `config.service_host`.
+        port (int, optional): The port to listen on. Defaults to `config.service_port`.
+    """
+    host = host if host is not None else config.service_host
+    port = port if port is not None else config.service_port
+    await _run_stage(warm_up)
+    if config.enable_preference_precompute:
+        get_preference_worker()
+    server = await asyncio.start_server(_handle_connection, host, port)
+    print(f"Serving product search on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Product search HTTP service")
+    parser.add_argument("--host", default=config.service_host)
+    parser.add_argument("--port", type=int, default=config.service_port)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Process-pool worker mode for multi-core serving of the product search.
+
+The pipeline modules hold global singletons (LLM clients, the embeddings client and the
+Chroma vector store), and the retrieval-side post-processing is Python-bound, so a single
+process only uses one core. This module pre-forks a fixed number of worker processes that
+each serve searches independently:
+
+- Each worker opens its own connection to the Chroma store after the fork (see
+  `product_retriever.get_collection`, which reopens the client in a new process), or maps
+  the shared catalog snapshot (see catalog_snapshot.py). Chroma has no read-only mode, so
+  the workers must not write to the store.
+- The LLM and embedding clients are module-level objects. A worker imports the pipeline
+  modules itself, and creates its own clients, only if the parent has not imported them:
+  under fork, a worker inherits the clients the parent already created. Their connection
+  pools open sockets on the first request only, so start the pool before the parent calls
+  the LLM or the embeddings model, otherwise the workers share the parent's connections.
+- The dispatcher hands requests to the workers through a shared task queue, so an idle
+  worker always picks up the next request, and bounds the number of in-flight requests
+  (`config.worker_max_pending`) to apply backpressure to the callers.
+
+Example Usage:
+    ```python
+    with SearchWorkerPool(processes=4) as pool:
+        response = pool.search(3, "Elegant navy evening gown below 250")
+    ```
+"""
+
+import multiprocessing
+import multiprocessing.pool
+import threading
+import config
+
+def _init_worker():
+    """Initializes a search worker process after the fork."""
+    # Under fork, the clients the parent already created are inherited rather than created here
+    import product_search
+    import product_retriever
+
+    # Open this worker's own connection to the vector store, or map the catalog snapshot,
+    # before serving requests
+    product_retriever.open_catalog()
+
+def _search(customer_id, query):
+    """Runs one search in a worker process."""
+    import product_search
+    return product_search.recommend_products(customer_id, query)
+
+class SearchWorkerPool:
+    """A pool of pre-forked search worker processes with a bounded request queue.
+
+    Attributes:
+        processes (int): The number of worker processes.
+        max_pending (int): The maximum number of in-flight requests.
+    """
+
+    def __init__(self, processes: int | None = None, max_pending: int | None = None, start_method: str | None = None):
+        """Starts the worker processes.
+
+        Args:
+            processes (int, optional): The number of worker processes. Defaults to `config.worker_processes`.
+            max_pending (int, optional): The maximum number of in-flight requests. Defaults to `config.worker_max_pending`.
+            start_method (str, optional): The multiprocessing start method. Defaults to "fork" where available.
+        """
+        self.processes = processes if processes is not None else config.worker_processes
+        self.max_pending = max_pending if max_pending is not None else config.worker_max_pending
+        if start_method is None:
+            start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        context = multiprocessing.get_context(start_method)
+        self._pool = context.Pool(processes=self.processes, initializer=_init_worker)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _release(self, _):
+        self._slots.release()
+
+    def submit(self, customer_id, query: str, timeout: float | None = None) -> multiprocessing.pool.AsyncResult:
+        """Dispatches a search to the workers.
+
+        Blocks while `max_pending` requests are already in flight.
+
+        Args:
+            customer_id (int): The customer id.
+            query (str): The user search query.
+            timeout (float, optional): The maximum number of seconds to wait for a free slot.
+                Waits indefinitely if None.
+
+        Returns:
+            AsyncResult: The pending search response.
+
+        Raises:
+            TimeoutError: If no slot became free within `timeout` seconds.
+        """
+        if not self._slots.acquire(timeout=timeout if timeout is not None else -1):
+            raise TimeoutError("All search workers are busy")
+        try:
+            return self._pool.apply_async(_search, (customer_id, query), callback=self._release, error_callback=self._release)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def search(self, customer_id, query: str, timeout: float | None = None) -> str:
+        """Runs a search on the workers and waits for the response.
+
+        Args:
+            customer_id (int): The customer id.
+            query (str): The user search query.
+            timeout (float, optional): The maximum number of seconds to wait for a free slot
+                and then for the response. Waits indefinitely if None.
+
+        Returns:
+            str: The generated response.
+        """
+        return self.submit(customer_id, query, timeout).get(timeout)
+
+    def close(self):
+        """Stops accepting requests and waits for the workers to finish."""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
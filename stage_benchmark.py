@@ -0,0 +1,190 @@
+"""
+Latency and accuracy benchmark of the LLM configurations of the pipeline stages.
+
+Each stage can run on its own model and options (`config.stage_llm_options`, and
+`config.routed_stage_llm_options` for the classification stages). This module
+runs the labeled queries of the classification and query transformation stages against
+several configurations of a stage, and reports for each one the accuracy, the latency
+(median and 95th percentile) and the prefill and decode timing reported by Ollama.
+
+Configurations:
+    - `baseline`: the shared configuration of the generation stages (llama3.2, 24k context).
+    - `routed`: the small model configuration of the stage in `config.routed_stage_llm_options`,
+      to decide whether to set `config.enable_stage_model_routing`.
+    Further configurations can be given as JSON on the command line.
+
+Example Usage:
+    ```bash
+    python stage_benchmark.py --stage product_category --repeat 3
+    python stage_benchmark.py --config '{"1b-4k": {"model": "llama3.2:1b", "num_ctx": 4096}}'
+    ```
+"""
+
+from langchain_core.runnables import RunnableLambda
+from langchain_ollama import ChatOllama
+from pre_retrieval_metadata import ComparisonOperatorResponse, comparison_operator_prompt
+from pre_retrieval_query_transformation import query_transformation_prompt
+from product_category import CategoryResponse, product_category_prompt
+from prompt_templates import record_timing, reset_timings, stage_llm_kwargs, structured_output, timing_summary
+import argparse
+import json
+import time
+import numpy as np
+import config
+
+# Labeled queries of each stage: (input, expected output)
+benchmark_cases = {
+    "comparison_operator": [
+        ("Show me dresses under 300 euros", "$lt"),
+        ("Coats below 500", "$lt"),
+        ("Wool jumpers for less than 150 €", "$lt"),
+        ("Leather bags over 400 euros", "$gt"),
+        ("Trousers more expensive than 200", "$gt"),
+        ("Shoes at most 250 euros", "$lte"),
+        ("A shirt for no more than 90 €", "$lte"),
+        ("Jackets of at least 600 euros", "$gte"),
+        ("Scarf for exactly 80 euros", "$eq"),
+        ("A black silk blouse", None),
+        ("Denim jacket for the summer", None),
+    ],
+    "product_category": [
+        ("A long wool coat for the winter", "Coats & Jackets"),
+        ("Cashmere cardigan", "Pullovers & Cardigans"),
+        ("White cotton blouse", "Shirts & Tops"),
+        ("Black evening dress", "Dresses"),
+        ("Grey sweatshirt with a logo", "T-shirts & Sweatshirts"),
+        ("Wide-leg pleated trousers", "Trousers"),
+        ("Straight blue jeans", "Denim"),
+        ("Pleated midi skirt", "Skirts & Shorts"),
+        ("Leather ankle boots", "Shoes"),
+        ("A small leather shoulder bag", "Bags"),
+        ("Leather card holder", "Small leather goods"),
+        ("Wool beret", "Hats"),
+        ("Silk scarf with a print", "Scarves"),
+        ("Leather gloves", "Gloves"),
+        ("Gold hoop earrings", "Jewellery"),
+        ("Leather belt with a gold buckle", "Belts"),
+    ],
+    "query_transformation": [
+        ("Find jackets under 200 euros", "Find jackets"),
+        ("Black dress below 300 €", "Black dress"),
+        ("Wool coat for less than 500 euros", "Wool coat"),
+        ("Leather bag over 400", "Leather bag"),
+        ("Silk scarf", "Silk scarf"),
+    ],
+}
+
+def _normalize(text: str | None) -> str | None:
+    if text is None:
+        return None
+    return " ".join(text.strip().strip("'\".").lower().split())
+
+def _stage_runnable(stage: str, llm: ChatOllama):
+    """Returns the runnable, prompt builder and output reader of a stage, as used by the pipeline."""
+    if stage == "comparison_operator":
+        return (structured_output(stage, llm, ComparisonOperatorResponse),
+                lambda text: comparison_operator_prompt.messages(query=text),
+                lambda response: response.operator)
+    if stage == "product_category":
+        return (structured_output(stage, llm, CategoryResponse),
+                lambda text: product_category_prompt.messages(product=text),
+                lambda response: response.category)
+    if stage == "query_transformation":
+        def invoke_and_record(messages):
+            response = llm.invoke(messages)
+            record_timing(stage, response)
+            return response
+        return (RunnableLambda(invoke_and_record),
+                lambda text: query_transformation_prompt.messages(query=text),
+                lambda response: _normalize(response.content))
+    raise ValueError(f"No benchmark for stage {stage}")
+
+def benchmark_stage(stage: str, options: dict, repeat: int = 1) -> dict:
+    """Runs the labeled queries of a stage with the given LLM options.
+
+    Args:
+        stage (str): The stage name, a key of `benchmark_cases`.
+        options (dict): The ChatOllama options overriding those of the stage (e.g. model, num_ctx).
+        repeat (int, optional): The number of runs of each query. Defaults to 1.
+
+    Returns:
+        dict: The accuracy, the median and 95th percentile latency (ms), the prefill and decode
+            timing of Ollama, and the errors.
+    """
+    kwargs = stage_llm_kwargs(stage, model="llama3.2", temperature=0)
+    kwargs.update(options)
+    kwargs["cache"] = False  # Measure the model, not the response cache
+    runnable, build_messages, read_output = _stage_runnable(stage, ChatOllama(**kwargs))
+
+    # Load the model before measuring
+    try:
+        runnable.invoke(build_messages(benchmark_cases[stage][0][0]))
+    except Exception as e:
+        print(f"Error warming up {kwargs['model']}: {e}")
+    reset_timings()
+
+    latencies, correct, errors = [], 0, 0
+    for _ in range(repeat):
+        for text, expected in benchmark_cases[stage]:
+            start = time.perf_counter()
+            try:
+                output = read_output(runnable.invoke(build_messages(text)))
+            except Exception as e:
+                print(f"Error running {stage} on {text!r}: {e}")
+                errors += 1
+                continue
+            finally:
+                latencies.append((time.perf_counter() - start) * 1000)
+            if output == (_normalize(expected) if stage == "query_transformation" else expected):
+                correct += 1
+
+    runs = repeat * len(benchmark_cases[stage])
+    return {
+        "model": kwargs["model"],
+        "options": {key: value for key, value in kwargs.items() if key not in ("model", "keep_alive", "cache")},
+        "accuracy": correct / runs,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "errors": errors,
+        "ollama": timing_summary().get(stage, {}),
+    }
+
+def benchmark(stages: list | None = None, configurations: dict | None = None, repeat: int = 1) -> dict:
+    """Benchmarks each configuration on each stage.
+
+    Args:
+        stages (list, optional): The stages to benchmark. Defaults to every stage with labeled queries.
+        configurations (dict, optional): The ChatOllama options of each configuration, by name.
+            Defaults to the `baseline` and the `routed` configurations.
+        repeat (int, optional): The number of runs of each query. Defaults to 1.
+
+    Returns:
+        dict: The results of each configuration, by stage.
+    """
+    results = {}
+    for stage in stages or list(benchmark_cases):
+        stage_configurations = configurations or {
+            "baseline": {"model": "llama3.2", "num_ctx": 24576, "num_predict": None},
+            "routed": {**config.stage_llm_options.get(stage, {}), **config.routed_stage_llm_options.get(stage, {})},
+        }
+        results[stage] = {name: benchmark_stage(stage, options, repeat) for name, options in stage_configurations.items()}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and accuracy benchmark of the LLM stages")
+    parser.add_argument("--stage", action="append", choices=list(benchmark_cases), help="Stage to benchmark (repeatable)")
+    parser.add_argument("--config", help="JSON object of the ChatOllama options of each configuration, by name")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    results = benchmark(args.stage, json.loads(args.config) if args.config else None, args.repeat)
+    for stage, stage_results in results.items():
+        print(f"\n{stage}")
+        print(f"  {'configuration':<14}{'model':<14}{'accuracy':>9}{'p50 ms':>9}{'p95 ms':>9}{'prefill ms':>12}{'decode ms':>11}")
+        for name, result in stage_results.items():
+            ollama = result["ollama"]
+            print(f"  {name:<14}{result['model']:<14}{result['accuracy']:>9.0%}{result['p50_ms']:>9.0f}{result['p95_ms']:>9.0f}"
+                  f"{ollama.get('prefill_ms', 0):>12.1f}{ollama.get('decode_ms', 0):>11.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Latency budgets, hedged requests and graceful degradation for the LLM stages.
+
+The exception handlers of the pipeline stages only catch errors, so a slow Ollama backend
+stalls the whole search. This module runs an LLM call within the latency budget of its stage
+(`config.stage_timeouts`). When the budget is exceeded, the stage degrades to its fallback
+instead of waiting, e.g. skipping the category filter or the personalization.
+
+If a second backend is configured (`config.hedge_base_url`), the call is hedged: when the
+primary backend has not answered after `config.hedge_delay` seconds, the same request is sent
+to the second backend and the first answer wins.
+
+Each call first waits for its turn in the LLM queue (see llm_scheduler.py); a call still
+queued when its budget is exceeded is dropped without reaching the backend.
+
+The interactive LLM calls are tracked while they run on the backends, late calls included,
+so that background work (see preference_worker.py) only uses the idle backend capacity.
+
+A call that degraded (budget exceeded or backend error) is recorded in the `track_degradation()`
+block of its thread, so that the pipeline does not memoize the fallback output of its stage.
+
+Example Usage:
+    ```python
+    response = invoke_with_budget(
+        "product_category", llm_product_category, messages,
+        hedge=llm_product_category_hedge, fallback=lambda: None
+    )
+    ```
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+from langchain_ollama import ChatOllama
+from prompt_templates import record_timing
+from llm_scheduler import PRIORITY_BACKGROUND, acquire, release, stage_priority
+import threading
+import time
+import config
+
+# Late calls keep running after their budget is exceeded, so the pool leaves room for them
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="stage-budget")
+
+# Interactive LLM calls running on the backends, and when the last one ended
+_interactive_calls = 0
+_last_interactive_call = 0.0
+_interactive_lock = threading.Lock()
+
+@contextmanager
+def interactive_call():
+    """Counts an LLM call as interactive while it runs, so that background calls yield to it."""
+    global _interactive_calls, _last_interactive_call
+    with _interactive_lock:
+        _interactive_calls += 1
+    try:
+        yield
+    finally:
+        with _interactive_lock:
+            _interactive_calls -= 1
+            _last_interactive_call = time.monotonic()
+
+# Degradation record of the current thread (see track_degradation)
+_local = threading.local()
+
+@contextmanager
+def track_degradation():
+    """Records whether an LLM call of the current thread degraded to its fallback or failed.
+
+    Yields:
+        dict: The record, whose "degraded" key is set to True by a degraded call of the block.
+    """
+    previous = getattr(_local, "record", None)
+    record = {"degraded": False}
+    _local.record = record
+    try:
+        yield record
+    finally:
+        _local.record = previous
+        if previous is not None and record["degraded"]:
+            previous["degraded"] = True
+
+def _record_degradation():
+    record = getattr(_local, "record", None)
+    if record is not None:
+        record["degraded"] = True
+
+def seconds_since_interactive_call() -> float:
+    """Returns the seconds elapsed since the last interactive LLM call ended, 0 while one is running."""
+    with _interactive_lock:
+        if _interactive_calls > 0:
+            return 0.0
+        return time.monotonic() - _last_interactive_call
+
+def hedge_llm(**kwargs) -> ChatOllama | None:
+    """Creates an LLM client for the hedging backend.
+
+    Args:
+        **kwargs: The ChatOllama parameters of the primary LLM client.
+
+    Returns:
+        ChatOllama | None: The client for `config.hedge_base_url`, or None if hedging is disabled.
+    """
+    if not config.hedge_base_url:
+        return None
+    return ChatOllama(base_url=config.hedge_base_url, **kwargs)
+
+# Result of a call whose budget was exceeded while it waited in the LLM queue
+_NOT_ADMITTED = object()
+
+def _invoke(stage: str, runnable, messages: list, priority: int, deadline: float | None = None, scheduled: bool = True):
+    """Invokes a runnable once admitted by the LLM scheduler, recording the Ollama timing of its response.
+
+    Returns `_NOT_ADMITTED`, without invoking the runnable, if the deadline passes while queued.
+    The calls to the hedging backend (`scheduled=False`) are not queued.
+    """
+    if scheduled and not acquire(priority, deadline - time.monotonic() if deadline is not None else None):
+        return _NOT_ADMITTED
+    try:
+        with nullcontext() if priority == PRIORITY_BACKGROUND else interactive_call():
+            response = runnable.invoke(messages)
+    finally:
+        if scheduled:
+            release(priority)
+    record_timing(stage, response)
+    return response
+
+def invoke_with_budget(stage: str, runnable, messages: list, hedge=None, fallback=None, background: bool = False):
+    """Invokes an LLM runnable within the latency budget of a pipeline stage.
+
+    The call waits for its turn in the LLM queue (see llm_scheduler.py), within the budget.
+    Background calls (e.g. the preference precomputation, see preference_worker.py, or the
+    calls of a `background_calls()` block) have no budget and are not counted as interactive calls.
+
+    Args:
+        stage (str): The stage name, a key of `config.stage_timeouts`.
+        runnable: The LLM runnable to invoke on the primary backend.
+        messages (list): The chat messages.
+        hedge (optional): The same runnable bound to the hedging backend, if any.
+        fallback (callable, optional): Called to produce the stage output when the budget
+            is exceeded. Defaults to returning None.
+        background (bool, optional): Whether the call is a background call. Defaults to False.
+
+    Returns:
+        The first response received within the budget, otherwise the fallback output.
+
+    Raises:
+        Exception: The error raised by the backends, if every backend failed within the budget.
+    """
+    priority = stage_priority(stage, background)
+    budget = config.stage_timeouts.get(stage)
+    if priority == PRIORITY_BACKGROUND or (budget is None and hedge is None):
+        try:
+            return _invoke(stage, runnable, messages, priority)
+        except Exception:
+            _record_degradation()
+            raise
+
+    deadline = time.monotonic() + budget if budget is not None else None
+    pending = {_executor.submit(_invoke, stage, runnable, messages, priority, deadline)}
+    error = None
+
+    if hedge is not None:
+        hedge_delay = config.hedge_delay if budget is None else min(config.hedge_delay, budget)
+        done, pending = wait(pending, timeout=hedge_delay)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+            elif future.result() is not _NOT_ADMITTED:
+                return future.result()
+        # Hedge when the primary backend is slow, queued or failed
+        pending.add(_executor.submit(_invoke, stage, hedge, messages, priority, deadline, scheduled=False))
+
+    while pending:
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+            elif future.result() is not _NOT_ADMITTED:
+                return future.result()
+
+    _record_degradation()
+    if not pending and error is not None:
+        raise error
+
+    print(f"Stage {stage} exceeded its latency budget of {budget}s, degrading")
+    return fallback() if fallback is not None else None
@@ -0,0 +1,170 @@
+"""
+Brand catalogs (tenants) served by a single process.
+
+Each brand catalog is a tenant of `config.tenants`, with its own Chroma collection, gender
+filter and category schema. The embeddings model and the LLM clients are module-level and
+shared by all the tenants. A product query is served from the catalog of its tenant
+(`ProductQuery.tenant`), or of `config.default_tenant` when it has none.
+
+The collections of the default tenant are opened by product_retriever.py as before. The
+collections of the other tenants are opened lazily on their first query, and at most
+`config.max_open_tenants` of them are kept open per process: the least recently used one
+is closed when another one is opened. Chroma caches the client system (SQLite connections,
+segments, HNSW indexes) of each persist directory for the life of the process, so closing a
+tenant stops the system of its directory, unless another open catalog shares it, and the
+objects holding it (e.g. its category partitions) are told with `on_tenant_close`. The memory-mapped stores (quantized store, catalog
+snapshot, customer affinity) only hold the catalog of the default tenant.
+
+Example Usage:
+    ```python
+    config.tenants["maison"] = {
+        "collection_name": "maison-products",
+        "persist_directory": "./chroma_products_maison",
+        "gender": None,
+        "product_categories": ["Sofas", "Tables", "Lighting"],
+    }
+    candidates = retrieve_candidates(ProductQuery("oak dining table", tenant="maison"), 4)
+    ```
+"""
+
+from collections import OrderedDict
+from product_retriever import embeddings
+import chromadb
+import os
+import threading
+import config
+
+class Tenant:
+    """The catalog settings of a brand.
+
+    Attributes:
+        name (str): The tenant name, a key of `config.tenants`.
+        collection_name (str): The name of the Chroma collection of its products.
+        persist_directory (str): The directory of its Chroma store.
+        gender (str | None): The gender filter added to the filtered queries, or None for no gender filter.
+        product_categories (list | None): Its product categories, or None for the categories
+            of product_category.py.
+    """
+
+    def __init__(self, name: str, collection_name: str, persist_directory: str, gender: str | None = None, product_categories: list | None = None):
+        self.name = name
+        self.collection_name = collection_name
+        self.persist_directory = persist_directory
+        self.gender = gender
+        self.product_categories = list(product_categories) if product_categories is not None else None
+
+    def __repr__(self) -> str:
+        return f"Tenant(name={self.name!r}, collection_name={self.collection_name!r})"
+
+def get_tenant(name: str | None = None) -> Tenant:
+    """Returns the settings of a tenant.
+
+    Args:
+        name (str, optional): The tenant name. Defaults to `config.default_tenant`.
+
+    Returns:
+        Tenant: The tenant settings.
+
+    Raises:
+        ValueError: If the tenant is not in `config.tenants`.
+    """
+    name = name if name is not None else config.default_tenant
+    settings = config.tenants.get(name)
+    if settings is None:
+        raise ValueError(f"Unknown tenant: {name!r}")
+    return Tenant(name, **settings)
+
+def is_default_tenant(name: str | None) -> bool:
+    """Whether a tenant name refers to the default tenant."""
+    return name is None or name == config.default_tenant
+
+# Open (client, collection) of the non-default tenants, least recently used first. Like the
+# Chroma client of product_retriever.py, they are opened again in a forked process.
+_collections = OrderedDict()
+_collections_pid = None
+_collections_lock = threading.Lock()
+
+def _reset_collections_lock():
+    global _collections_lock
+    _collections_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_collections_lock)
+
+# Called with the tenant name when a tenant is closed, e.g. to drop its category partitions
+_close_callbacks = []
+
+def on_tenant_close(callback):
+    """Registers a function called with the name of a tenant when its store is closed."""
+    _close_callbacks.append(callback)
+
+def _shared_systems() -> dict:
+    """Returns the Chroma client systems cached per persist directory (SharedSystemClient)."""
+    try:
+        from chromadb.api.shared_system_client import SharedSystemClient
+    except ImportError:
+        try:
+            from chromadb.api.client import SharedSystemClient  # Chroma < 0.5.6
+        except ImportError:
+            return {}
+    return SharedSystemClient._identifier_to_system
+
+def _close_client(name: str, client):
+    """Stops the Chroma system of a closed tenant, unless another open catalog shares its directory."""
+    for callback in list(_close_callbacks):
+        callback(name)
+    persist_directory = get_tenant(name).persist_directory
+    in_use = {get_tenant(config.default_tenant).persist_directory} | {get_tenant(other).persist_directory for other in _collections}
+    identifier = getattr(client, "_identifier", None)
+    if persist_directory in in_use or identifier is None:
+        return
+    system = _shared_systems().pop(identifier, None)
+    if system is not None:
+        system.stop()
+
+def open_tenant_stores() -> list:
+    """Returns the persist directories of the tenants whose Chroma system is running in this process.
+
+    A closed tenant whose directory is listed still holds its memory and file handles.
+    """
+    systems = _shared_systems()
+    return sorted({
+        settings["persist_directory"] for settings in config.tenants.values()
+        if any(identifier == settings["persist_directory"] or identifier == os.path.abspath(settings["persist_directory"]) for identifier in systems)
+    })
+
+def get_tenant_collection(name: str):
+    """Returns the Chroma collection of a tenant, opening it on first use.
+
+    Args:
+        name (str): The tenant name.
+
+    Returns:
+        The Chroma collection of the tenant's products.
+
+    Raises:
+        ValueError: If the tenant is not in `config.tenants`.
+    """
+    global _collections_pid
+    with _collections_lock:
+        if _collections_pid != os.getpid():
+            _collections.clear()
+            _collections_pid = os.getpid()
+        opened = _collections.get(name)
+        if opened is not None:
+            _collections.move_to_end(name)
+            return opened[1]
+
+        tenant = get_tenant(name)
+        client = chromadb.PersistentClient(path=tenant.persist_directory)
+        collection = client.get_collection(name=tenant.collection_name, embedding_function=embeddings)
+        _collections[name] = (client, collection)
+        while len(_collections) > config.max_open_tenants:
+            closed, (closed_client, _) = _collections.popitem(last=False)
+            _close_client(closed, closed_client)
+        return collection
+
+def open_tenants() -> list:
+    """Returns the names of the tenants whose collections are open in this process, least recently used first."""
+    with _collections_lock:
+        return list(_collections) if _collections_pid == os.getpid() else []
@@ -0,0 +1,93 @@
+import threading
+import time
+import pytest
+import config
+import llm_scheduler
+from llm_scheduler import PRIORITY_BACKGROUND, PRIORITY_GENERATION, PRIORITY_QUERY_UNDERSTANDING, acquire, release, should_shed
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch):
+    monkeypatch.setattr(config, "llm_max_concurrency", 2)
+    monkeypatch.setattr(config, "llm_background_max_concurrency", 1)
+    monkeypatch.setattr(config, "llm_shed_queue_depth", 1)
+    llm_scheduler._reset_after_fork()
+    llm_scheduler.reset_queue_summary()
+    yield
+    llm_scheduler._reset_after_fork()
+    llm_scheduler.reset_queue_summary()
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def _queue(priority, admitted):
+    """Starts a thread waiting for a slot, which records its priority once admitted and releases it."""
+    def run():
+        assert acquire(priority, timeout=5)
+        admitted.append(priority)
+        release(priority)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def test_concurrency_cap():
+    assert acquire(PRIORITY_GENERATION, timeout=0)
+    assert acquire(PRIORITY_QUERY_UNDERSTANDING, timeout=0)
+    assert not acquire(PRIORITY_GENERATION, timeout=0.05)
+
+    release(PRIORITY_QUERY_UNDERSTANDING)
+    assert acquire(PRIORITY_GENERATION, timeout=0)
+    assert llm_scheduler.queue_summary()["running"] == {"generation": 2, "query_understanding": 0, "background": 0}
+
+def test_background_cap():
+    assert acquire(PRIORITY_BACKGROUND, timeout=0)
+    assert not acquire(PRIORITY_BACKGROUND, timeout=0.05)
+    # The interactive calls still use the remaining capacity
+    assert acquire(PRIORITY_QUERY_UNDERSTANDING, timeout=0)
+
+def test_timeout_removes_the_waiting_call():
+    assert acquire(PRIORITY_GENERATION, timeout=0)
+    assert acquire(PRIORITY_GENERATION, timeout=0)
+    assert not acquire(PRIORITY_GENERATION, timeout=0.05)
+    assert llm_scheduler._waiting == []
+    assert llm_scheduler.queue_summary()["waiting"] == {"generation": 0, "query_understanding": 0, "background": 0}
+
+    # The timed out call does not block the calls queued after it
+    release(PRIORITY_GENERATION)
+    assert acquire(PRIORITY_BACKGROUND, timeout=0)
+
+def test_queued_calls_are_served_by_priority():
+    assert acquire(PRIORITY_GENERATION, timeout=0)
+    assert acquire(PRIORITY_GENERATION, timeout=0)
+    admitted = []
+    threads = [_queue(PRIORITY_QUERY_UNDERSTANDING, admitted)]
+    _wait_until(lambda: len(llm_scheduler._waiting) == 1)
+    threads.append(_queue(PRIORITY_GENERATION, admitted))
+    _wait_until(lambda: len(llm_scheduler._waiting) == 2)
+
+    release(PRIORITY_GENERATION)
+    for thread in threads:
+        thread.join()
+    assert admitted == [PRIORITY_GENERATION, PRIORITY_QUERY_UNDERSTANDING]
+
+def test_should_shed_counts_the_waiting_interactive_calls():
+    assert acquire(PRIORITY_GENERATION, timeout=0)
+    assert acquire(PRIORITY_GENERATION, timeout=0)
+    admitted = []
+    threads = [_queue(PRIORITY_QUERY_UNDERSTANDING, admitted), _queue(PRIORITY_BACKGROUND, admitted), _queue(PRIORITY_BACKGROUND, admitted)]
+    _wait_until(lambda: len(llm_scheduler._waiting) == 3)
+    # One interactive call waiting is not beyond the depth, and the background calls do not count
+    assert not should_shed()
+
+    threads.append(_queue(PRIORITY_GENERATION, admitted))
+    _wait_until(lambda: len(llm_scheduler._waiting) == 4)
+    assert should_shed()
+
+    release(PRIORITY_GENERATION)
+    release(PRIORITY_GENERATION)
+    for thread in threads:
+        thread.join()
+    assert not should_shed()
+    assert len(admitted) == 4
@@ -0,0 +1,56 @@
+from preference_worker import PRIORITY_ACTIVE, PRIORITY_PURCHASE, PreferenceWorker
+
+def _drain(worker):
+    """Pops the queued customers in the order the worker serves them."""
+    customers = []
+    while (customer_id := worker._pop()) is not None:
+        customers.append(customer_id)
+    return customers
+
+def test_full_queue_rejects_a_customer_of_the_same_priority():
+    worker = PreferenceWorker(max_queued=2)
+    assert worker.submit(1, PRIORITY_ACTIVE)
+    assert worker.submit(2, PRIORITY_ACTIVE)
+    assert not worker.submit(3, PRIORITY_ACTIVE)
+    assert _drain(worker) == [1, 2]
+
+def test_full_queue_rejects_a_purchase_when_only_purchases_are_queued():
+    worker = PreferenceWorker(max_queued=2)
+    assert worker.submit(1, PRIORITY_PURCHASE)
+    assert worker.submit(2, PRIORITY_PURCHASE)
+    assert not worker.submit(3, PRIORITY_PURCHASE)
+    assert len(worker) == 2
+
+def test_full_queue_drops_the_most_recent_customer_of_the_lowest_priority():
+    worker = PreferenceWorker(max_queued=2)
+    worker.submit(1, PRIORITY_ACTIVE)
+    worker.submit(2, PRIORITY_ACTIVE)
+    assert worker.submit(3, PRIORITY_PURCHASE)
+    assert len(worker) == 2
+    assert _drain(worker) == [3, 1]
+
+def test_resubmitting_a_customer_keeps_the_highest_priority():
+    worker = PreferenceWorker(max_queued=2)
+    worker.submit(1, PRIORITY_ACTIVE)
+    worker.submit(2, PRIORITY_ACTIVE)
+    # Re-prioritizing a queued customer does not need a free slot, nor drop anyone
+    assert worker.submit(2, PRIORITY_PURCHASE)
+    assert worker.submit(2, PRIORITY_ACTIVE)
+    assert worker._queued[2][0] == PRIORITY_PURCHASE
+    assert len(worker) == 2
+    assert _drain(worker) == [2, 1]
+    assert worker._by_priority == {}
+
+def test_stale_heap_entries_are_compacted():
+    worker = PreferenceWorker(max_queued=2)
+    worker.submit(1, PRIORITY_ACTIVE)
+    worker.submit(2, PRIORITY_ACTIVE)
+    worker.submit(1, PRIORITY_PURCHASE)  # Leaves the first entry of 1 stale
+    worker.submit(3, PRIORITY_PURCHASE)  # Drops 2, leaving its entry stale
+    assert worker._pop() == 1
+    worker.submit(4, PRIORITY_ACTIVE)
+    assert len(worker._heap) == 4
+    worker.submit(4, PRIORITY_PURCHASE)  # Beyond twice the queue size: only the queued entries are kept
+    assert sorted(worker._heap) == sorted((*entry, customer_id) for customer_id, entry in worker._queued.items())
+    assert len(worker._heap) == 2
+    assert _drain(worker) == [3, 4]